@@ -0,0 +1,433 @@
+# End-to-end benchmark of commit_maker on synthetic repositories.
+# Builds repositories with staged changes from tiny to huge (renames,
+# binaries, lockfiles, many files), runs the CLI in dry-run mode against the
+# fake LLM server from fake_llm.py and reports latency, peak RSS, the number
+# of git/ollama subprocesses and bytes sent to the model. Results are saved
+# as JSON and can be compared with a previous run.
+#
+# Usage: python benchmarks/e2e.py [--runs 3] [--scale 1.0]
+#            [--scenario tiny huge] [--backend ollama|mistral]
+#            [--compare benchmarks/results/<commit>.json] [-- <cli options>]
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+from fake_llm import FakeLLMServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORDS = (
+    "value result items config handler request buffer index parser token "
+    "state cache client server update render load save apply check"
+).split()
+
+
+def _source(rng: random.Random, lines: int) -> str:
+    out = []
+    for i in range(lines):
+        if i % 12 == 0:
+            out.append(f"def {rng.choice(WORDS)}_{i}({rng.choice(WORDS)}):")
+        else:
+            out.append(
+                f"    {rng.choice(WORDS)} = {rng.choice(WORDS)}"
+                f"({rng.choice(WORDS)}, {rng.randint(0, 999)})"
+            )
+    return "\n".join(out) + "\n"
+
+
+def _edit(rng: random.Random, text: str, share: float) -> str:
+    lines = text.splitlines()
+    for i in range(len(lines)):
+        if rng.random() < share:
+            lines[i] = lines[i].rstrip() + f"  # {rng.choice(WORDS)}"
+    return "\n".join(lines) + "\n"
+
+
+def _write(repo: str, path: str, content, mode: str = "w") -> None:
+    full = os.path.join(repo, path)
+    os.makedirs(os.path.dirname(full), exist_ok=True)
+    with open(full, mode) as f:
+        f.write(content)
+
+
+def _git(repo: str, *args: str) -> None:
+    subprocess.run(
+        ["git", *args],
+        cwd=repo,
+        check=True,
+        capture_output=True,
+    )
+
+
+# Every scenario gets an empty repository: `base` writes the committed
+# files, `change` modifies the work tree before everything is staged
+def tiny_base(repo, rng, scale):
+    _write(repo, "app.py", _source(rng, 40))
+
+
+def tiny_change(repo, rng, scale):
+    with open(os.path.join(repo, "app.py")) as f:
+        text = f.read()
+    _write(repo, "app.py", _edit(rng, text, 0.05))
+
+
+def medium_base(repo, rng, scale):
+    for i in range(max(int(20 * scale), 1)):
+        _write(repo, f"src/module_{i}.py", _source(rng, 150))
+
+
+def medium_change(repo, rng, scale):
+    for i in range(max(int(20 * scale), 1)):
+        path = os.path.join(repo, f"src/module_{i}.py")
+        with open(path) as f:
+            text = f.read()
+        _write(repo, f"src/module_{i}.py", _edit(rng, text, 0.2))
+
+
+def huge_base(repo, rng, scale):
+    for i in range(max(int(300 * scale), 1)):
+        _write(repo, f"pkg/part_{i // 30}/file_{i}.py", _source(rng, 200))
+
+
+def huge_change(repo, rng, scale):
+    for i in range(max(int(300 * scale), 1)):
+        path = f"pkg/part_{i // 30}/file_{i}.py"
+        with open(os.path.join(repo, path)) as f:
+            text = f.read()
+        _write(repo, path, _edit(rng, text, 0.3))
+
+
+def renames_base(repo, rng, scale):
+    for i in range(max(int(50 * scale), 1)):
+        _write(repo, f"old/name_{i}.py", _source(rng, 60))
+
+
+def renames_change(repo, rng, scale):
+    for i in range(max(int(50 * scale), 1)):
+        old = os.path.join(repo, f"old/name_{i}.py")
+        with open(old) as f:
+            text = f.read()
+        os.remove(old)
+        _write(repo, f"new/name_{i}.py", _edit(rng, text, 0.02))
+
+
+def binaries_base(repo, rng, scale):
+    _write(repo, "README.md", "Assets\n")
+    for i in range(max(int(20 * scale), 1)):
+        _write(repo, f"assets/image_{i}.bin", os.urandom(64 * 1024), "wb")
+
+
+def binaries_change(repo, rng, scale):
+    for i in range(max(int(20 * scale), 1)):
+        _write(repo, f"assets/image_{i}.bin", os.urandom(64 * 1024), "wb")
+    _write(repo, "README.md", "Assets, regenerated\n")
+
+
+def lockfile_base(repo, rng, scale):
+    _write(repo, "index.js", "module.exports = {};\n")
+    _write(repo, "package-lock.json", "{}\n")
+
+
+def lockfile_change(repo, rng, scale):
+    packages = {
+        f"node_modules/{rng.choice(WORDS)}-{i}": {
+            "version": f"{rng.randint(0, 9)}.{rng.randint(0, 99)}.0",
+            "resolved": f"https://registry.npmjs.org/pkg-{i}.tgz",
+            "integrity": f"sha512-{os.urandom(32).hex()}",
+        }
+        for i in range(max(int(3000 * scale), 1))
+    }
+    _write(repo, "package-lock.json", json.dumps(packages, indent=2))
+    _write(repo, "index.js", "module.exports = { ready: true };\n")
+    _write(repo, "src/server.js", "const http = require('http');\n")
+
+
+def many_files_base(repo, rng, scale):
+    _write(repo, "README.md", "Many files\n")
+
+
+def many_files_change(repo, rng, scale):
+    for i in range(max(int(2000 * scale), 1)):
+        _write(repo, f"data/{i % 40}/item_{i}.txt", f"item {i}\n")
+
+
+SCENARIOS: Dict[str, tuple] = {
+    "tiny": (tiny_base, tiny_change),
+    "medium": (medium_base, medium_change),
+    "huge": (huge_base, huge_change),
+    "renames": (renames_base, renames_change),
+    "binaries": (binaries_base, binaries_change),
+    "lockfile": (lockfile_base, lockfile_change),
+    "many-files": (many_files_base, many_files_change),
+}
+
+
+def build_repo(
+    path: str,
+    base: Callable,
+    change: Callable,
+    scale: float,
+) -> None:
+    """Creates a repository with one commit and staged changes on top.
+    The same seed gives the same text content."""
+    rng = random.Random(42)
+    os.makedirs(path)
+    _git(path, "init", "-q")
+    _git(path, "config", "user.name", "bench")
+    _git(path, "config", "user.email", "bench@example.com")
+    base(path, rng, scale)
+    _git(path, "add", "-A")
+    _git(path, "commit", "-q", "-m", "Initial state")
+    change(path, rng, scale)
+    _git(path, "add", "-A")
+
+
+def make_shims(directory: str, log: str) -> None:
+    """`git` and `ollama` wrappers that count their invocations"""
+    os.makedirs(directory)
+    for tool in ("git", "ollama"):
+        real = shutil.which(tool)
+        target = f'exec "{real}" "$@"' if real else "exit 1"
+        path = os.path.join(directory, tool)
+        with open(path, "w") as f:
+            f.write(f'#!/bin/sh\necho {tool} >> "{log}"\n{target}\n')
+        os.chmod(path, 0o755)
+
+
+def run_once(
+    repo: str,
+    cli_args: List[str],
+    env: Dict[str, str],
+    log: str,
+    trace_file: str,
+) -> Dict:
+    """Runs the CLI once
+
+    Returns:
+        dict: Wall time, peak RSS, subprocess counts and phase times
+    """
+    open(log, "w").close()
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "commit_maker.main"]
+        + cli_args
+        + ["--trace", trace_file],
+        cwd=repo,
+        env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    # wait4 gives the resource usage of this child only
+    stderr = process.stderr.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = (
+        os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1
+    )
+    wall = time.perf_counter() - start
+    if process.returncode:
+        raise RuntimeError(stderr.decode("utf-8", errors="replace"))
+    rss_kb = usage.ru_maxrss
+    if sys.platform == "darwin":
+        rss_kb //= 1024
+    with open(log) as f:
+        calls = f.read().split()
+    phases: Dict[str, float] = {}
+    with open(trace_file, encoding="utf-8") as f:
+        for group in json.load(f)["summary"]:
+            if group["kind"] == "phase":
+                phases[group["name"]] = group["total"]
+    return {
+        "wall": wall,
+        "rss_kb": rss_kb,
+        "git": calls.count("git"),
+        "ollama": calls.count("ollama"),
+        "phases": phases,
+    }
+
+
+def current_commit() -> str:
+    result = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    dirty = subprocess.run(
+        ["git", "diff", "--quiet", "HEAD", "--", "src"],
+        cwd=ROOT,
+    ).returncode
+    return (result.stdout.strip() or "unknown") + ("-dirty" if dirty else "")
+
+
+def print_comparison(results: Dict, previous_path: str) -> None:
+    with open(previous_path, encoding="utf-8") as f:
+        previous = json.load(f)["scenarios"]
+    print(f"\ncompared with {previous_path}:")
+    for name, result in results.items():
+        old = previous.get(name)
+        if not old:
+            continue
+        for metric in ("wall_median", "rss_kb", "bytes_in"):
+            before, after = old[metric], result[metric]
+            change = (after - before) / before * 100 if before else 0.0
+            print(
+                f"{name:<11} {metric:<12} {before:>12.3f} -> "
+                f"{after:>12.3f} ({change:+.1f}%)"
+            )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="End-to-end benchmark of commit_maker"
+    )
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="Multiplier of the number of files in every scenario",
+    )
+    parser.add_argument(
+        "--scenario",
+        nargs="+",
+        choices=list(SCENARIOS),
+        default=list(SCENARIOS),
+    )
+    parser.add_argument(
+        "--backend", choices=["ollama", "mistral"], default="ollama"
+    )
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--tokens-per-second", type=float, default=100.0)
+    parser.add_argument(
+        "--prompt-tokens-per-second", type=float, default=4000.0
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="Results file. Default: benchmarks/results/<commit>.json",
+    )
+    parser.add_argument("--compare", default=None, help="Previous results")
+    parser.add_argument(
+        "cli_args",
+        nargs="*",
+        help="Extra commit_maker options, after `--`",
+    )
+    args = parser.parse_args()
+
+    server = FakeLLMServer(
+        latency=args.latency_ms / 1000,
+        tokens_per_second=args.tokens_per_second,
+        prompt_tokens_per_second=args.prompt_tokens_per_second,
+    ).start()
+    work = tempfile.mkdtemp(prefix="commit_maker_bench_")
+    log = os.path.join(work, "calls.log")
+    make_shims(os.path.join(work, "bin"), log)
+    env = dict(
+        os.environ,
+        PATH=os.path.join(work, "bin") + os.pathsep + os.environ["PATH"],
+        PYTHONPATH=os.path.join(ROOT, "src"),
+        XDG_CACHE_HOME=os.path.join(work, "cache"),
+        OLLAMA_HOST=server.url,
+        MISTRAL_BASE_URL=server.url,
+        MISTRAL_API_KEY="bench",
+    )
+    cli_args = ["-d", "--no-cache", "-L", "en"]
+    if args.backend == "ollama":
+        cli_args += ["-l", "-M", "bench-model"]
+    cli_args += args.cli_args
+
+    results: Dict[str, Dict] = {}
+    try:
+        for name in args.scenario:
+            repo = os.path.join(work, name)
+            build_repo(repo, *SCENARIOS[name], args.scale)
+            diff_bytes = len(
+                subprocess.run(
+                    ["git", "diff", "--staged"],
+                    cwd=repo,
+                    capture_output=True,
+                ).stdout
+            )
+            runs: List[Dict] = []
+            server.reset()
+            for i in range(args.runs):
+                runs.append(
+                    run_once(
+                        repo,
+                        cli_args,
+                        env,
+                        log,
+                        os.path.join(work, f"{name}-{i}.json"),
+                    )
+                )
+            walls = [run["wall"] for run in runs]
+            phases: Dict[str, List[float]] = {}
+            for run in runs:
+                for phase, seconds in run["phases"].items():
+                    phases.setdefault(phase, []).append(seconds)
+            results[name] = {
+                "diff_bytes": diff_bytes,
+                "wall_median": statistics.median(walls),
+                "wall_min": min(walls),
+                "wall_max": max(walls),
+                "rss_kb": max(run["rss_kb"] for run in runs),
+                "git": statistics.median(run["git"] for run in runs),
+                "ollama": statistics.median(run["ollama"] for run in runs),
+                "requests": server.stats["requests"] / args.runs,
+                "bytes_in": server.stats["bytes_in"] / args.runs,
+                "bytes_out": server.stats["bytes_out"] / args.runs,
+                "phases": {
+                    phase: statistics.median(values)
+                    for phase, values in phases.items()
+                },
+            }
+            result = results[name]
+            print(
+                f"{name:<11} diff {diff_bytes / 1024:8.1f} KiB  "
+                f"wall {result['wall_median'] * 1000:7.1f} ms "
+                f"[{result['wall_min'] * 1000:.0f}-"
+                f"{result['wall_max'] * 1000:.0f}]  "
+                f"rss {result['rss_kb'] / 1024:6.1f} MiB  "
+                f"git {result['git']:g}  "
+                f"requests {result['requests']:g}  "
+                f"sent {result['bytes_in'] / 1024:8.1f} KiB"
+            )
+    finally:
+        server.shutdown()
+        shutil.rmtree(work, ignore_errors=True)
+
+    output = args.output or os.path.join(
+        ROOT, "benchmarks", "results", f"{current_commit()}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "commit": current_commit(),
+                "python": sys.version.split()[0],
+                "settings": {
+                    key: value
+                    for key, value in vars(args).items()
+                    if key not in ("output", "compare")
+                },
+                "scenarios": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"results saved to {output}")
+    if args.compare:
+        print_comparison(results, args.compare)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
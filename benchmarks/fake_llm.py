@@ -0,0 +1,280 @@
+# Local stand-in for the Ollama and Mistral HTTP APIs used by the
+# benchmarks. Answers after a configurable latency (plus prompt processing
+# proportional to the request size) and streams tokens at a fixed rate.
+#
+# Usage: python benchmarks/fake_llm.py [--port 11435] [--latency-ms 50]
+#            [--tokens-per-second 100] [--prompt-tokens-per-second 4000]
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, Optional
+
+ANSWER = "Update synthetic benchmark files and refresh generated fixtures"
+
+
+class FakeLLMServer(ThreadingHTTPServer):
+    """HTTP server with counters of requests and payload bytes"""
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        port: int = 0,
+        latency: float = 0.05,
+        tokens_per_second: float = 100.0,
+        prompt_tokens_per_second: float = 4000.0,
+        models=("bench-model",),
+        context_length: int = 32768,
+    ):
+        """Initialization
+
+        Args:
+            port (int, optional): Port, 0 for a free one. Defaults to 0.
+            latency (float, optional): Seconds before the first token.
+                Defaults to 0.05.
+            tokens_per_second (float, optional): Rate of answer tokens.
+                Defaults to 100.
+            prompt_tokens_per_second (float, optional): Rate of prompt
+                processing, added to the latency. Defaults to 4000.
+            models (list[str], optional): Models reported by `/api/tags`
+            context_length (int, optional): Context reported by `/api/show`.
+                Defaults to 32768.
+        """
+        super().__init__(("127.0.0.1", port), FakeLLMHandler)
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.prompt_tokens_per_second = prompt_tokens_per_second
+        self.models = list(models)
+        self.context_length = context_length
+        self._lock = threading.Lock()
+        self.reset()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def reset(self) -> None:
+        """Resets the counters"""
+        with self._lock:
+            self.stats = {
+                "requests": 0,
+                "connections": 0,
+                "bytes_in": 0,
+                "bytes_out": 0,
+            }
+
+    def count(self, **deltas: int) -> None:
+        with self._lock:
+            for key, delta in deltas.items():
+                self.stats[key] += delta
+
+    def start(self) -> "FakeLLMServer":
+        """Serves in a daemon thread"""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: FakeLLMServer
+
+    def setup(self) -> None:
+        super().setup()
+        self.server.count(connections=1)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def _body(self) -> Dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length)
+        self.server.count(requests=1, bytes_in=len(raw))
+        return json.loads(raw or b"{}")
+
+    def _send(self, payload: Dict, status: int = 200) -> None:
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.count(bytes_out=len(data))
+
+    def _send_chunked(self, content_type: str, chunks: Iterator[bytes]):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for chunk in chunks:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.flush()
+            self.server.count(bytes_out=len(chunk))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _think(self, body: Dict) -> int:
+        """Waits as long as the model would before the first token
+
+        Returns:
+            int: Prompt tokens
+        """
+        prompt = "".join(
+            message.get("content") or ""
+            for message in body.get("messages", [])
+        )
+        prompt_tokens = (len(prompt) + 3) // 4
+        time.sleep(
+            self.server.latency
+            + prompt_tokens / self.server.prompt_tokens_per_second
+        )
+        return prompt_tokens
+
+    def _tokens(self) -> Iterator[str]:
+        for i, word in enumerate(ANSWER.split(" ")):
+            if i:
+                time.sleep(1 / self.server.tokens_per_second)
+            yield word if i == 0 else " " + word
+
+    def do_GET(self) -> None:
+        self.server.count(requests=1)
+        if self.path == "/":
+            data = b"Ollama is running"
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        elif self.path == "/api/tags":
+            self._send(
+                {
+                    "models": [
+                        {"name": model, "model": model}
+                        for model in self.server.models
+                    ]
+                }
+            )
+        else:
+            self._send({"error": "not found"}, 404)
+
+    def do_POST(self) -> None:
+        body = self._body()
+        if self.path == "/api/generate":
+            self._send({"model": body.get("model"), "done": True})
+        elif self.path == "/api/show":
+            self._send(
+                {
+                    "model_info": {
+                        "llama.context_length": self.server.context_length
+                    }
+                }
+            )
+        elif self.path == "/api/chat":
+            self._ollama_chat(body)
+        elif self.path == "/v1/chat/completions":
+            self._mistral_chat(body)
+        else:
+            self._send({"error": "not found"}, 404)
+
+    def _ollama_stats(self, prompt_tokens: int, started: float) -> Dict:
+        eval_count = len(ANSWER.split(" "))
+        return {
+            "done": True,
+            "load_duration": 0,
+            "prompt_eval_count": prompt_tokens,
+            "eval_count": eval_count,
+            "eval_duration": int(
+                eval_count / self.server.tokens_per_second * 1e9
+            ),
+            "total_duration": int((time.perf_counter() - started) * 1e9),
+        }
+
+    def _ollama_chat(self, body: Dict) -> None:
+        started = time.perf_counter()
+        prompt_tokens = self._think(body)
+        model = body.get("model")
+        if not body.get("stream", True):
+            self._send(
+                {
+                    "model": model,
+                    "message": {"role": "assistant", "content": ANSWER},
+                    **self._ollama_stats(prompt_tokens, started),
+                }
+            )
+            return
+
+        def chunks() -> Iterator[bytes]:
+            for token in self._tokens():
+                yield json.dumps(
+                    {
+                        "model": model,
+                        "message": {"role": "assistant", "content": token},
+                        "done": False,
+                    }
+                ).encode("utf-8") + b"\n"
+            yield json.dumps(
+                {
+                    "model": model,
+                    "message": {"role": "assistant", "content": ""},
+                    **self._ollama_stats(prompt_tokens, started),
+                }
+            ).encode("utf-8") + b"\n"
+
+        self._send_chunked("application/x-ndjson", chunks())
+
+    def _mistral_chat(self, body: Dict) -> None:
+        prompt_tokens = self._think(body)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(ANSWER.split(" ")),
+        }
+        usage["total_tokens"] = sum(usage.values())
+        if not body.get("stream"):
+            self._send(
+                {
+                    "choices": [
+                        {"message": {"role": "assistant", "content": ANSWER}}
+                    ],
+                    "usage": usage,
+                }
+            )
+            return
+
+        def event(payload: Optional[Dict]) -> bytes:
+            data = json.dumps(payload) if payload else "[DONE]"
+            return f"data: {data}\n\n".encode("utf-8")
+
+        def chunks() -> Iterator[bytes]:
+            for token in self._tokens():
+                yield event({"choices": [{"delta": {"content": token}}]})
+            yield event({"choices": [{"delta": {}}], "usage": usage})
+            yield event(None)
+
+        self._send_chunked("text/event-stream", chunks())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Fake Ollama/Mistral server for benchmarks"
+    )
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--tokens-per-second", type=float, default=100.0)
+    parser.add_argument(
+        "--prompt-tokens-per-second", type=float, default=4000.0
+    )
+    args = parser.parse_args()
+    server = FakeLLMServer(
+        port=args.port,
+        latency=args.latency_ms / 1000,
+        tokens_per_second=args.tokens_per_second,
+        prompt_tokens_per_second=args.prompt_tokens_per_second,
+    )
+    print(f"Serving on {server.url} (OLLAMA_HOST / MISTRAL_BASE_URL)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+# Cold-start benchmark of the commit_maker CLI.
+# Runs `--version` and `--help` under `python -X importtime` and fails when
+# the time spent on our imports exceeds the budget or when a heavy module
+# leaks into a path that must not need it. The help formatter needs rich, so
+# its import is reported for `--help` but not counted against the budget.
+#
+# Usage: python benchmarks/startup.py [--runs 10] [--budget-ms 60]
+import argparse
+import re
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+IMPORTTIME_RE = re.compile(
+    r"^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$"
+)
+
+# Modules that must not be imported on the given path
+FORBIDDEN = {
+    "--version": ["requests", "rich", "rich_argparse"],
+    "--help": ["requests", "commit_maker.ollama", "commit_maker.mistral"],
+}
+
+# Modules the path cannot do without, outside of the budget
+UNAVOIDABLE = {
+    "--version": [],
+    "--help": ["rich", "rich_argparse"],
+}
+
+
+def is_module(name: str, modules: List[str]) -> bool:
+    """Whether `name` is one of the modules or their submodules"""
+    return any(
+        name == module or name.startswith(module + ".") for module in modules
+    )
+
+
+def top_level_imports(stderr: str) -> Dict[str, int]:
+    """Cumulative import time (us) of every top-level import"""
+    imports = {}
+    for line in stderr.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if match and not match.group(3):
+            imports[match.group(4)] = int(match.group(2))
+    return imports
+
+
+def all_imports(stderr: str) -> List[str]:
+    """Names of all modules imported during the run"""
+    return [
+        match.group(4)
+        for match in map(IMPORTTIME_RE.match, stderr.splitlines())
+        if match
+    ]
+
+
+def run(args: List[str]) -> Tuple[float, str]:
+    """Runs the interpreter with -X importtime
+
+    Returns:
+        tuple[float, str]: Wall time in ms and stderr
+    """
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime"] + args,
+        capture_output=True,
+        text=True,
+    )
+    return (time.perf_counter() - start) * 1000, result.stderr
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Cold-start benchmark of the commit_maker CLI"
+    )
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=60.0,
+        help="Maximum median import time on top of bare interpreter startup",
+    )
+    args = parser.parse_args()
+
+    baseline_wall = []
+    baseline_imports = set()
+    for _ in range(args.runs):
+        wall, stderr = run(["-c", "pass"])
+        baseline_wall.append(wall)
+        baseline_imports.update(top_level_imports(stderr))
+    baseline = statistics.median(baseline_wall)
+    print(f"interpreter startup: {baseline:.1f} ms")
+
+    failed = False
+    for flag, forbidden in FORBIDDEN.items():
+        walls, import_times, unavoidable_times = [], [], []
+        stderr = ""
+        for _ in range(args.runs):
+            wall, stderr = run(["-m", "commit_maker.main", flag])
+            walls.append(wall)
+            imports = top_level_imports(stderr)
+            ours, unavoidable = 0, 0
+            for name, us in imports.items():
+                if name in baseline_imports:
+                    continue
+                if is_module(name, UNAVOIDABLE[flag]):
+                    unavoidable += us
+                else:
+                    ours += us
+            import_times.append(ours / 1000)
+            unavoidable_times.append(unavoidable / 1000)
+        import_ms = statistics.median(import_times)
+        print(
+            f"{flag:<10} wall {statistics.median(walls):7.1f} ms "
+            f"(+{statistics.median(walls) - baseline:.1f}), "
+            f"imports {import_ms:6.1f} ms / budget {args.budget_ms:.0f} ms"
+        )
+        if UNAVOIDABLE[flag]:
+            print(
+                f"{'':<10} + {statistics.median(unavoidable_times):.1f} ms "
+                f"of {', '.join(UNAVOIDABLE[flag])} (not budgeted)"
+            )
+        slowest = sorted(
+            (
+                (us, name)
+                for name, us in top_level_imports(stderr).items()
+                if name not in baseline_imports
+            ),
+            reverse=True,
+        )[:5]
+        for us, name in slowest:
+            print(f"    {us / 1000:7.1f} ms  {name}")
+
+        leaked = sorted(
+            {
+                module
+                for name in all_imports(stderr)
+                for module in forbidden
+                if is_module(name, [module])
+            }
+        )
+        if leaked:
+            print(f"    FAIL: {flag} imports {', '.join(leaked)}")
+            failed = True
+        if import_ms > args.budget_ms:
+            print(f"    FAIL: {flag} is over the import time budget")
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,16 @@
+# Library API (see api.py). It is imported on first use: the CLI imports this
+# package on every start and must stay fast
+__all__ = [
+    "GenerationOptions",
+    "GenerationResult",
+    "MessageGenerator",
+    "generate_message",
+]
+
+
+def __getattr__(name):
+    if name in __all__:
+        from . import api
+
+        return getattr(api, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,364 @@
+# Library API for bots and CI: messages for a diff generated in-process,
+# without prompts or terminal output, reusing backend sessions across calls.
+#
+#     from commit_maker import generate_message
+#
+#     result = generate_message(diff, backend="ollama:qwen2.5:7b")
+#     print(result.message)
+import copy
+import threading
+import time
+from dataclasses import asdict, dataclass, field, fields
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from .diff_packer import estimate_tokens
+from .generation import (
+    build_prompt,
+    finish_message,
+    output_limits,
+    resilient_client,
+)
+from .git_state import RepoState, state_from_diff
+from .hedging import DeadlineExceeded
+from .prompts import commit_prompt
+
+
+@dataclass
+class GenerationOptions:
+    """Generation options, named like the CLI options"""
+
+    language: str = "ru"
+    max_symbols: int = 200
+    wish: Optional[str] = None
+    temperature: float = 1.0
+    timeout: Optional[int] = None
+    max_input_tokens: int = 16000
+    compact: bool = False
+    # Full diffs of binaries, lockfiles and generated files instead of
+    # their stats
+    full_diff: bool = False
+    # Map-reduce summaries by `file` or `dir` for large diffs
+    split: Optional[str] = None
+    chunk_timeout: int = 60
+    concurrency: int = 4
+    retries: int = 2
+    deadline: Optional[float] = None
+    # Second backend as `BACKEND[:MODEL]`
+    fallback: Optional[str] = None
+    hedge_after: Optional[float] = None
+
+    @classmethod
+    def from_args(cls, args) -> "GenerationOptions":
+        """Options from parsed CLI options"""
+        return cls(
+            **{
+                option.name: getattr(args, option.name)
+                for option in fields(cls)
+                if hasattr(args, option.name)
+            }
+        )
+
+
+@dataclass
+class GenerationResult:
+    """Generated message and how it was obtained"""
+
+    message: Optional[str]
+    backend: str
+    model: Optional[str]
+    # Whether the answer was trimmed to `max_symbols`
+    trimmed: bool = False
+    # Tokens of the prompt and of the answer, as reported by the backend or
+    # estimated
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    # Which of `prompt_tokens` and `completion_tokens` are estimates
+    estimated: List[str] = field(
+        default_factory=lambda: ["prompt_tokens", "completion_tokens"]
+    )
+    # Estimated tokens of the packed diff, 0 if the diff fit as is
+    packed_tokens: int = 0
+    failed_chunks: List[str] = field(default_factory=list)
+    # Paths whose diff was cut by the diff size cap
+    truncated: List[str] = field(default_factory=list)
+    # Seconds of `prompt` building, to the `first_token`, of `generate`
+    # (including the rate limit `queue`) and in `total`
+    timings: Dict[str, float] = field(default_factory=dict)
+    # Why there is no message
+    error: Optional[str] = None
+
+    def to_dict(self) -> Dict:
+        data = asdict(self)
+        data["timings"] = {
+            name: round(seconds, 4) for name, seconds in self.timings.items()
+        }
+        return data
+
+
+def parse_backend(spec: str) -> Tuple[str, Optional[str]]:
+    """Splits `BACKEND[:MODEL]`
+
+    Raises:
+        ValueError: Unknown backend
+    """
+    name, _, model = spec.partition(":")
+    if name not in ("mistral", "ollama"):
+        raise ValueError(f"unknown backend {name!r}, use mistral or ollama")
+    return name, model or None
+
+
+class MessageGenerator:
+    """Generates messages without terminal output. Clients with their
+    keep-alive sessions are created once per backend and options and reused
+    by later calls; one generator can serve many threads."""
+
+    def __init__(self, options: Optional[GenerationOptions] = None):
+        """Initialization
+
+        Args:
+            options (GenerationOptions, optional): Options of calls that
+                give none. Defaults to `GenerationOptions()`.
+        """
+        self.options = options or GenerationOptions()
+        self._clients: Dict[Tuple, object] = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "MessageGenerator":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Closes the sessions of all clients"""
+        with self._lock:
+            clients, self._clients = self._clients, {}
+        for client in clients.values():
+            client.close()
+
+    def _backend(self, spec: str, pool_size: int):
+        from .backends import get_backend
+
+        name, model = parse_backend(spec)
+        client = get_backend(name).from_options(
+            model=model, pool_size=pool_size
+        )
+        client.quiet = True
+        if name == "mistral" and not client.api_key:
+            raise ValueError("MISTRAL_API_KEY is not set")
+        if name == "ollama" and not model:
+            if not client.is_served():
+                raise ValueError("Ollama server is not running")
+            models = client.list_models()
+            if len(models) != 1:
+                raise ValueError(
+                    "use ollama:MODEL, available models: " + ", ".join(models)
+                )
+            client.model = models[0]
+        return client
+
+    def client(
+        self, backend: str, options: Optional[GenerationOptions] = None
+    ):
+        """Client for the backend, with retries and --fallback as in the
+        options
+
+        Args:
+            backend (str): `BACKEND[:MODEL]`, e.g. `mistral` or
+                `ollama:qwen2.5:7b`. A model is needed unless Ollama has
+                only one.
+            options (GenerationOptions, optional): Options. Defaults to
+                those of the generator.
+
+        Returns:
+            Backend: Shared client
+
+        Raises:
+            ValueError: Unknown backend, no API key or no model
+        """
+        options = options or self.options
+        key = (
+            backend,
+            options.fallback,
+            options.retries,
+            options.deadline,
+            options.hedge_after,
+        )
+        with self._lock:
+            client = self._clients.get(key)
+        if client is not None:
+            return client
+        pool_size = max(4, options.concurrency)
+        client = self._backend(backend, pool_size)
+        secondary = None
+        if options.fallback:
+            secondary = self._backend(options.fallback, pool_size)
+        client = resilient_client(client, options, secondary)
+        with self._lock:
+            # Another thread may have created it meanwhile
+            if key in self._clients:
+                client.close()
+                return self._clients[key]
+            self._clients[key] = client
+        return client
+
+    def generate(
+        self,
+        diff: str,
+        status: str = "",
+        *,
+        backend="mistral",
+        options: Optional[GenerationOptions] = None,
+        excluded_files: Sequence[str] = (),
+    ) -> GenerationResult:
+        """Message for a diff
+
+        Args:
+            diff (str): Output of `git diff`
+            status (str, optional): `git status` text. Built from the file
+                headers of the diff by default.
+            backend (str | Backend, optional): `BACKEND[:MODEL]` or a ready
+                client. Defaults to "mistral".
+            options (GenerationOptions, optional): Options. Defaults to
+                those of the generator.
+            excluded_files (list[str], optional): Files whose diffs are left
+                out
+
+        Returns:
+            GenerationResult: Message, None with `error` if generation
+                failed
+        """
+        options = options or self.options
+        state = state_from_diff(
+            diff, status, excluded_files, plan=not options.full_diff
+        )
+        return self.generate_for_state(state, backend=backend, options=options)
+
+    def generate_for_state(
+        self,
+        state: RepoState,
+        *,
+        backend="mistral",
+        options: Optional[GenerationOptions] = None,
+    ) -> GenerationResult:
+        """Message for a collected repository state
+
+        Args:
+            state (RepoState): Repository state, e.g. from
+                `collect_repo_state`
+            backend (str | Backend, optional): `BACKEND[:MODEL]` or a ready
+                client. Defaults to "mistral".
+            options (GenerationOptions, optional): Options. Defaults to
+                those of the generator.
+
+        Returns:
+            GenerationResult: Message, None with `error` if generation
+                failed
+        """
+        options = options or self.options
+        started = time.perf_counter()
+        name = backend if isinstance(backend, str) else type(backend).__name__
+        result = GenerationResult(message=None, backend=name, model=None)
+        result.truncated = state.truncated
+        if not state.diff.strip():
+            result.error = "Empty diff"
+            return result
+        client = (
+            self.client(backend, options)
+            if isinstance(backend, str)
+            else backend
+        )
+        # Results of the request (`usage`, `last_error`, `queue_time`) are
+        # kept on the client, the shared one may serve other calls meanwhile
+        client = copy.copy(client)
+        result.model = client.model
+        system_prompt = commit_prompt(
+            options.language, options.max_symbols, options.wish
+        )
+        prompt = build_prompt(
+            client,
+            state,
+            system_prompt,
+            max_input_tokens=options.max_input_tokens,
+            split_by=options.split,
+            chunk_timeout=options.chunk_timeout,
+            concurrency=options.concurrency,
+            compact=options.compact,
+        )
+        result.packed_tokens = prompt.packed_tokens
+        result.failed_chunks = prompt.failed_chunks
+        result.prompt_tokens = estimate_tokens(
+            "".join(message["content"] for message in prompt.messages)
+        )
+        generating = time.perf_counter()
+        result.timings["prompt"] = generating - started
+        chunks = []
+        try:
+            for chunk in client.stream(
+                messages=prompt.messages,
+                temperature=options.temperature,
+                timeout=options.timeout,
+                **output_limits(options.max_symbols),
+            ):
+                if not chunks:
+                    result.timings["first_token"] = (
+                        time.perf_counter() - generating
+                    )
+                chunks.append(chunk)
+        except DeadlineExceeded as e:
+            # A partial answer is a failure, not a message
+            result.error = str(e)
+            result.timings["total"] = time.perf_counter() - started
+            return result
+        finished = time.perf_counter()
+        result.timings["generate"] = finished - generating
+        # Part of `generate` spent in the rate limit queue
+        result.timings["queue"] = getattr(client, "queue_time", 0.0)
+        result.timings["total"] = finished - started
+        answer = "".join(chunks)
+        result.completion_tokens = estimate_tokens(answer) if answer else 0
+        usage = getattr(client, "usage", None)
+        if usage:
+            result.prompt_tokens = usage["prompt_tokens"]
+            result.completion_tokens = usage["completion_tokens"]
+            result.estimated = []
+        result.message, result.trimmed = finish_message(
+            answer, options.max_symbols
+        )
+        if result.message is None:
+            result.error = (
+                getattr(client, "last_error", None) or "No message generated"
+            )
+        return result
+
+
+_default: Optional[MessageGenerator] = None
+_default_lock = threading.Lock()
+
+
+def default_generator() -> MessageGenerator:
+    """Generator shared by `generate_message` calls"""
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = MessageGenerator()
+        return _default
+
+
+def generate_message(
+    diff: str,
+    status: str = "",
+    *,
+    backend="mistral",
+    options: Optional[GenerationOptions] = None,
+    excluded_files: Sequence[str] = (),
+) -> GenerationResult:
+    """Message for a diff, see `MessageGenerator.generate`. Sessions of the
+    backends are kept for later calls of the process."""
+    return default_generator().generate(
+        diff,
+        status,
+        backend=backend,
+        options=options,
+        excluded_files=excluded_files,
+    )
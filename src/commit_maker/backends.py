@@ -0,0 +1,247 @@
+# Common interface of AI backends and their registry
+import asyncio
+import copy
+import threading
+from typing import (
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Protocol,
+    Type,
+)
+
+
+class Backend(Protocol):
+    """What every AI backend provides. Blocking methods are used by the
+    interactive CLI, asyncio ones by the concurrent modes."""
+
+    model: Optional[str]
+    # Errors of requests are not printed (library use, --json), only kept
+    quiet: bool
+    last_error: Optional[str]
+    # `prompt_tokens` and `completion_tokens` of the last answer as reported
+    # by the server, None if it did not report them
+    usage: Optional[Dict[str, int]]
+
+    @classmethod
+    def from_options(
+        cls,
+        model: Optional[str] = None,
+        pool_size: int = 4,
+    ) -> "Backend": ...
+
+    # `max_tokens` caps the answer, generation ends at any of `stop`
+    def message(
+        self,
+        messages: List[Dict[str, str]],
+        timeout: Optional[int],
+        temperature: float,
+        max_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+    ) -> Optional[str]: ...
+
+    def stream(
+        self,
+        messages: List[Dict[str, str]],
+        timeout: Optional[int],
+        temperature: float,
+        max_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+    ) -> Iterator[str]: ...
+
+    async def amessage(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        deadline: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+    ) -> Optional[str]: ...
+
+    def astream(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        deadline: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+    ) -> AsyncIterator[str]: ...
+
+    def connection_stats(self) -> Dict[str, int]: ...
+
+    def close(self) -> None: ...
+
+
+BACKENDS: Dict[str, Type] = {}
+
+
+def register_backend(name: str) -> Callable[[Type], Type]:
+    """Class decorator that registers a backend under the name
+
+    Args:
+        name (str): Backend name
+
+    Returns:
+        callable: Decorator
+    """
+
+    def decorator(cls: Type) -> Type:
+        BACKENDS[name] = cls
+        return cls
+
+    return decorator
+
+
+def get_backend(name: str) -> Type:
+    """Backend class by name
+
+    Raises:
+        KeyError: Unknown backend
+    """
+    if name not in BACKENDS:
+        # Built-in backends register themselves on import
+        from . import mistral, ollama  # noqa: F401
+
+    return BACKENDS[name]
+
+
+def report_error(
+    client, console, error: Exception, traceback: bool = True
+) -> None:
+    """Handles a failed request of a backend: keeps the error in
+    `client.last_error` and prints it unless `client.quiet` is set. Called
+    from the `except` block of the request.
+
+    Args:
+        client (Backend): Backend whose request failed
+        console (rich.console.Console): Console of the backend module
+        error (Exception): Error
+        traceback (bool, optional): Print the traceback, not just the
+            error. Defaults to True.
+    """
+    client.last_error = f"{type(error).__name__}: {error}"
+    if client.quiet:
+        return
+    if traceback:
+        console.print_exception()
+    else:
+        console.print(f"[red]{error}[/red]", highlight=False)
+
+
+class AsyncBackendMixin:
+    """asyncio entry points built on the blocking `stream()` of a backend.
+
+    The HTTP request runs in a background thread; cancelling the task (or
+    hitting the deadline) stops reading the response at the next chunk and
+    closes the connection."""
+
+    async def astream(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        deadline: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+    ) -> AsyncIterator[str]:
+        """Streams the answer
+
+        Args:
+            messages (list[dict[str]]): Messages
+            temperature (float): Model temperature
+            deadline (float, optional): Seconds for the whole request
+            max_tokens (int, optional): Cap of the answer
+            stop (list[str], optional): Stop sequences
+
+        Yields:
+            str: Chunks of the answer
+
+        Raises:
+            asyncio.TimeoutError: Deadline exceeded
+        """
+        loop = asyncio.get_event_loop()
+        # Concurrent requests share the client; each keeps the results of
+        # its request (`usage`, `last_error`) on its own copy
+        client = copy.copy(self)
+        queue: "asyncio.Queue" = asyncio.Queue()
+        cancelled = threading.Event()
+        end = object()
+
+        def put(item) -> None:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+            except RuntimeError:
+                # The event loop is closed, nobody reads the answer anymore
+                cancelled.set()
+
+        def produce() -> None:
+            chunks = client.stream(
+                messages=messages,
+                timeout=deadline,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stop=stop,
+            )
+            try:
+                for chunk in chunks:
+                    if cancelled.is_set():
+                        break
+                    put(chunk)
+            except TimeoutError as e:
+                # --deadline ran out mid-answer, see
+                # `http_session.DeadlineExceeded`
+                put(e)
+            finally:
+                chunks.close()
+                put(end)
+
+        # A daemon thread, not the default executor: a request that is
+        # still blocked after cancellation must not delay loop shutdown
+        threading.Thread(target=produce, daemon=True).start()
+        expires = loop.time() + deadline if deadline else None
+        try:
+            while True:
+                remaining = expires - loop.time() if expires else None
+                if remaining is not None and remaining <= 0:
+                    raise asyncio.TimeoutError()
+                chunk = await asyncio.wait_for(queue.get(), remaining)
+                if chunk is end:
+                    return
+                if isinstance(chunk, TimeoutError):
+                    raise asyncio.TimeoutError() from chunk
+                yield chunk
+        finally:
+            cancelled.set()
+
+    async def amessage(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        deadline: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+    ) -> Optional[str]:
+        """Whole answer
+
+        Args:
+            messages (list[dict[str]]): Messages
+            temperature (float): Model temperature
+            deadline (float, optional): Seconds for the whole request
+            max_tokens (int, optional): Cap of the answer
+            stop (list[str], optional): Stop sequences
+
+        Returns:
+            str | None: Answer, None if the backend failed
+
+        Raises:
+            asyncio.TimeoutError: Deadline exceeded
+        """
+        chunks = [
+            chunk
+            async for chunk in self.astream(
+                messages, temperature, deadline, max_tokens, stop
+            )
+        ]
+        return "".join(chunks).strip() or None
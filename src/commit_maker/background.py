@@ -0,0 +1,37 @@
+# Calls that run in the background while the main thread does other work
+import threading
+
+
+class BackgroundCall:
+    """Runs the function in a daemon thread. Exiting the program does not
+    wait for it, `result()` does."""
+
+    def __init__(self, function, *args, **kwargs):
+        self._result = None
+        self._error = None
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(function, args, kwargs),
+            daemon=True,
+        )
+        self._thread.start()
+
+    def _run(self, function, args, kwargs) -> None:
+        try:
+            self._result = function(*args, **kwargs)
+        except BaseException as e:
+            self._error = e
+
+    def done(self) -> bool:
+        return not self._thread.is_alive()
+
+    def result(self):
+        """Waits for the call and returns its result
+
+        Raises:
+            BaseException: Exception raised by the function
+        """
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._result
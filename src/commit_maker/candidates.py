@@ -0,0 +1,73 @@
+# Speculative generation of several commit message candidates
+import queue
+import threading
+from typing import Callable, List, Optional
+
+
+class CandidatePool:
+    """Generates candidates in background threads, so the next candidate is
+    usually ready by the time the user asks for it.
+
+    Threads are daemonic: leaving the picker does not wait for generations
+    that are still running."""
+
+    def __init__(
+        self,
+        generate: Callable[[], Optional[str]],
+        concurrency: int,
+    ):
+        """Initialization
+
+        Args:
+            generate (callable): Generates one message, returns None on
+                failure
+            concurrency (int): Maximum simultaneous generations
+        """
+        self._generate = generate
+        self._semaphore = threading.Semaphore(max(concurrency, 1))
+        self._results: "queue.Queue[Optional[str]]" = queue.Queue()
+        self.in_flight = 0
+        self.failed = 0
+        self.messages: List[str] = []
+
+    def request(self, count: int) -> None:
+        """Starts generation of more candidates
+
+        Args:
+            count (int): Number of candidates
+        """
+        for _ in range(count):
+            self.in_flight += 1
+            threading.Thread(target=self._worker, daemon=True).start()
+
+    def _worker(self) -> None:
+        with self._semaphore:
+            try:
+                message = self._generate()
+            except Exception:
+                message = None
+        self._results.put(message)
+
+    def collect(self, wait_for: int = 0) -> List[str]:
+        """Takes finished candidates
+
+        Args:
+            wait_for (int, optional): Block until this many new candidates
+                are ready or nothing is in flight. Defaults to 0.
+
+        Returns:
+            list[str]: New candidates, also appended to `messages`
+        """
+        new: List[str] = []
+        while self.in_flight:
+            try:
+                message = self._results.get(block=len(new) < wait_for)
+            except queue.Empty:
+                break
+            self.in_flight -= 1
+            if message:
+                new.append(message)
+            else:
+                self.failed += 1
+        self.messages.extend(new)
+        return new
@@ -0,0 +1,458 @@
+# Long-lived daemon: keeps backend sessions, the Ollama model list and the
+# summary cache warm and generates messages for thin clients (see
+# daemon_client.py) over a Unix domain socket. The protocol is one JSON
+# request line per connection, answered by JSON event lines.
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .backends import get_backend
+from .daemon_client import forwarded_env, socket_path
+from .generation import (
+    build_prompt,
+    count_trim,
+    diff_options,
+    encoding_key,
+    finish_message,
+    format_token_report,
+    message_cache_key,
+    output_limits,
+    resilient_client,
+    token_report,
+)
+from .git_state import collect_repo_state
+from .hedging import DeadlineExceeded
+from .prompts import commit_prompt
+from .rate_limit import QUEUE_NOTICE
+from .response_cache import ResponseCache
+from .summary_cache import SummaryCache
+
+# How long the Ollama model list is trusted
+MODELS_TTL = 30.0
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves generation requests, one thread per connection"""
+
+    daemon_threads = True
+
+    def __init__(self, path: str, parser, idle_timeout: float = 0):
+        """Initialization
+
+        Args:
+            path (str): Socket path, created with owner-only permissions
+            parser (argparse.ArgumentParser): Parser of the CLI options
+            idle_timeout (float, optional): Exit after this many seconds
+                without requests, 0 to run until stopped. Defaults to 0.
+        """
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(path, DaemonHandler)
+        finally:
+            os.umask(old_umask)
+        self.path = path
+        self.parser = parser
+        self.idle_timeout = idle_timeout
+        self.clients: Dict[Tuple[str, Optional[str]], object] = {}
+        self.summary_cache = SummaryCache()
+        self.served = 0
+        self.watcher = None
+        # Events of speculative generations in flight, by cache key
+        self._pending: Dict[str, threading.Event] = {}
+        self._models: Optional[Tuple[float, List[str]]] = None
+        self._lock = threading.Lock()
+        self._summary_lock = threading.Lock()
+        self._active = 0
+        self._last_request = time.monotonic()
+
+    def watch(self, repos: List[str], argv: List[str], log=None) -> None:
+        """Pre-generates messages whenever the index of a repository settles
+
+        Args:
+            repos (list[str]): Repository roots
+            argv (list[str]): `commit_maker` options for the messages
+            log (callable, optional): Receives progress lines
+        """
+        from .watcher import IndexWatcher
+
+        # Our own `git status` must not rewrite the index it is watching
+        os.environ["GIT_OPTIONAL_LOCKS"] = "0"
+        self.watcher = IndexWatcher(self, repos, argv, log=log)
+
+    def serve(self) -> None:
+        """Serves until stopped or idle for `idle_timeout`"""
+        if self.idle_timeout:
+            threading.Thread(target=self._watch_idle, daemon=True).start()
+        if self.watcher:
+            self.watcher.start()
+        try:
+            self.serve_forever()
+        finally:
+            if self.watcher:
+                self.watcher.stop()
+            self.server_close()
+            for client in self.clients.values():
+                client.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def _watch_idle(self) -> None:
+        while True:
+            time.sleep(min(self.idle_timeout, 5))
+            with self._lock:
+                idle = time.monotonic() - self._last_request
+                if not self._active and idle > self.idle_timeout:
+                    break
+        self.shutdown()
+
+    def _ollama_models(self, client) -> Optional[List[str]]:
+        with self._lock:
+            cached = self._models
+        if cached and time.monotonic() - cached[0] < MODELS_TTL:
+            return cached[1]
+        if not client.is_served():
+            return None
+        models = client.list_models()
+        with self._lock:
+            self._models = (time.monotonic(), models)
+        return models
+
+    def backend(self, args):
+        """Warm client for the options
+
+        Args:
+            args (argparse.Namespace): Parsed CLI options
+
+        Returns:
+            Backend | None: Client, None if the CLI has to decide (model
+                choice, errors)
+        """
+        pool_size = max(4, args.concurrency)
+        if not args.local_models:
+            if args.model or not os.environ.get("MISTRAL_API_KEY"):
+                return None
+            key = ("mistral", None)
+        else:
+            with self._lock:
+                probe = self.clients.get(("ollama", None))
+                if probe is None:
+                    probe = get_backend("ollama").from_options(
+                        pool_size=pool_size
+                    )
+                    self.clients[("ollama", None)] = probe
+            models = self._ollama_models(probe)
+            if not models:
+                return None
+            model = args.model or (models[0] if len(models) == 1 else None)
+            if model not in models:
+                return None
+            key = ("ollama", model)
+        with self._lock:
+            client = self.clients.get(key)
+            if client is None:
+                client = get_backend(key[0]).from_options(
+                    model=key[1], pool_size=pool_size
+                )
+                self.clients[key] = client
+        return client
+
+    def fallback(self, args):
+        """Warm --fallback client, None without the option"""
+        if not args.fallback:
+            return None
+        key = ("fallback", args.fallback)
+        with self._lock:
+            client = self.clients.get(key)
+            if client is None:
+                name, _, model = args.fallback.partition(":")
+                client = get_backend(name).from_options(
+                    model=model or None, pool_size=max(4, args.concurrency)
+                )
+                self.clients[key] = client
+        return client
+
+    def generate(self, request: Dict, emit: Callable[..., None]) -> None:
+        """Handles one request
+
+        Args:
+            request (dict): `argv`, `cwd`, `env` (see `FORWARDED_ENV`),
+                `regenerate` and `speculative` (set by the index watcher)
+            emit (callable): Sends an event to the client
+        """
+        try:
+            args = self.parser.parse_args(request["argv"])
+        except SystemExit:
+            return emit("fallback")
+        cwd = request["cwd"]
+        # Requests of the index watcher come without an environment
+        env = request.get("env")
+        if env is not None and env != forwarded_env():
+            return emit("fallback")
+        if (
+            args.workspace
+            or args.repos
+            or args.candidates > 1
+            or args.trace
+            or args.profile
+            or args.json
+            or args.stdin
+            or not os.path.isdir(os.path.join(cwd, ".git"))
+        ):
+            return emit("fallback")
+        client = self.backend(args)
+        if client is None:
+            return emit("fallback")
+        client = resilient_client(client, args, self.fallback(args))
+
+        use_cache = not args.no_cache
+        state = collect_repo_state(
+            args.exclude,
+            with_tree=use_cache,
+            cwd=cwd,
+            max_diff_bytes=args.max_diff_bytes,
+            diff_options=diff_options(args),
+            plan=not args.full_diff,
+        )
+        if not state.diff:
+            # Offering `git add -A` is interactive
+            return emit("fallback")
+        if state.truncated:
+            emit(
+                "notice",
+                text=f"Diff of {len(state.truncated)} file(s) is truncated "
+                "by --max-diff-bytes",
+            )
+        if state.unstaged:
+            emit("notice", text="Note: You have unstaged changes!")
+
+        cache = ResponseCache() if use_cache and state.tree else None
+        cache_key = message_cache_key(
+            state.tree,
+            client.model,
+            args.exclude,
+            args.language,
+            args.max_symbols,
+            args.wish,
+            args.temperature,
+            args.max_input_tokens,
+            args.split,
+            encoding_key(args),
+        )
+        speculative = request.get("speculative", False)
+        if cache and not request.get("regenerate") and not speculative:
+            with self._lock:
+                pending = self._pending.get(cache_key)
+            if pending is not None:
+                emit("notice", text="Waiting for the pre-generated message")
+                pending.wait()
+        if cache and not request.get("regenerate"):
+            candidates = cache.get(cache_key)
+            if candidates:
+                return emit(
+                    "done",
+                    message=candidates[-1],
+                    dry_run=args.dry_run,
+                    cached=True,
+                )
+
+        if speculative:
+            if not cache:
+                return emit("fallback")
+            with self._lock:
+                if cache_key in self._pending:
+                    return emit("fallback")
+                self._pending[cache_key] = threading.Event()
+            try:
+                self._generate(
+                    args,
+                    client,
+                    state,
+                    cache,
+                    cache_key,
+                    cwd,
+                    emit,
+                    speculative=True,
+                )
+            finally:
+                with self._lock:
+                    self._pending.pop(cache_key).set()
+        else:
+            self._generate(args, client, state, cache, cache_key, cwd, emit)
+
+    def _generate(
+        self,
+        args,
+        client,
+        state,
+        cache,
+        cache_key,
+        cwd,
+        emit,
+        speculative: bool = False,
+    ) -> None:
+        system_prompt = commit_prompt(
+            args.language, args.max_symbols, args.wish
+        )
+        if args.split:
+            with self._summary_lock:
+                prompt = build_prompt(
+                    client,
+                    state,
+                    system_prompt,
+                    max_input_tokens=args.max_input_tokens,
+                    split_by=args.split,
+                    chunk_timeout=args.chunk_timeout,
+                    concurrency=args.concurrency,
+                    summary_cache=(
+                        None if args.no_cache else self.summary_cache
+                    ),
+                    compact=args.compact,
+                    encoding=encoding_key(args),
+                )
+        else:
+            prompt = build_prompt(
+                client,
+                state,
+                system_prompt,
+                max_input_tokens=args.max_input_tokens,
+                compact=args.compact,
+            )
+        if args.token_report:
+            emit(
+                "notice",
+                text=format_token_report(
+                    token_report(
+                        state,
+                        args.compact,
+                        args.exclude,
+                        cwd=cwd,
+                        max_diff_bytes=args.max_diff_bytes,
+                    )
+                ),
+            )
+        if prompt.failed_chunks:
+            emit(
+                "notice",
+                text=f"No summary for {len(prompt.failed_chunks)} chunk(s), "
+                "their stats are used instead",
+            )
+        if prompt.packed_tokens:
+            emit(
+                "notice",
+                text="Diff is too large, packed into "
+                f"~{prompt.packed_tokens} tokens",
+            )
+        chunks = []
+        try:
+            for chunk in client.stream(
+                messages=prompt.messages,
+                temperature=args.temperature,
+                timeout=args.timeout,
+                **output_limits(args.max_symbols),
+            ):
+                chunks.append(chunk)
+                emit("chunk", text=chunk)
+        except DeadlineExceeded as e:
+            return emit("error", text=str(e))
+        message, trimmed = finish_message("".join(chunks), args.max_symbols)
+        if not message:
+            return emit("error", text="No message generated")
+        if not speculative:
+            # Pre-generated messages may never be shown
+            count_trim(trimmed)
+        queued = getattr(client, "queue_time", 0.0)
+        if queued >= QUEUE_NOTICE:
+            emit(
+                "notice",
+                text=f"Waited {queued:.1f}s in the rate limit queue",
+            )
+        if trimmed:
+            emit(
+                "notice",
+                text=f"Trimmed to {len(message)} of {args.max_symbols} "
+                "symbols",
+            )
+        if cache:
+            cache.append(cache_key, message)
+        emit("done", message=message, dry_run=args.dry_run, cached=False)
+
+    def begin(self) -> None:
+        with self._lock:
+            self._active += 1
+            self._last_request = time.monotonic()
+
+    def end(self, served: bool = True) -> None:
+        with self._lock:
+            self._active -= 1
+            self.served += served
+            self._last_request = time.monotonic()
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    server: DaemonServer
+
+    def handle(self) -> None:
+        def emit(event: str, **data) -> None:
+            self.wfile.write(
+                json.dumps({"event": event, **data}).encode("utf-8") + b"\n"
+            )
+            self.wfile.flush()
+
+        self.server.begin()
+        try:
+            request = json.loads(self.rfile.readline())
+            if request.get("command") == "stop":
+                emit("done", message=None, dry_run=True)
+                threading.Thread(target=self.server.shutdown).start()
+                return
+            self.server.generate(request, emit)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away (e.g. Ctrl+C)
+            pass
+        except Exception as e:
+            try:
+                emit("error", text=f"Daemon error: {e}")
+            except OSError:
+                pass
+        finally:
+            self.server.end()
+
+
+def is_running(path: str) -> bool:
+    """Checks whether a daemon answers on the socket
+
+    Args:
+        path (str): Socket path
+
+    Returns:
+        bool: True if something accepts connections on it
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        try:
+            connection.connect(path)
+            return True
+        except OSError:
+            return False
+
+
+def stop(path: Optional[str] = None) -> bool:
+    """Asks the running daemon to exit
+
+    Args:
+        path (str, optional): Socket path. Defaults to `socket_path()`.
+
+    Returns:
+        bool: True if a daemon was stopped
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        try:
+            connection.connect(path or socket_path())
+            connection.sendall(b'{"command": "stop"}\n')
+            connection.recv(1024)
+            return True
+        except OSError:
+            return False
@@ -0,0 +1,162 @@
+# Thin client of `commit_maker daemon`. Imported on every generation once the
+# options are parsed, so it only uses light standard library modules.
+import json
+import os
+import socket
+import subprocess
+import sys
+from typing import Dict, List, Optional
+
+from .colored import colored
+
+# Environment of the caller that changes the result. The daemon generates
+# with its own environment, so it runs the command in-process when these
+# differ.
+FORWARDED_ENV = (
+    "MISTRAL_API_KEY",
+    "MISTRAL_BASE_URL",
+    "MISTRAL_RATE_LIMIT",
+    "MISTRAL_TOKENS_PER_MINUTE",
+    "MISTRAL_QUEUE_TIMEOUT",
+    "OLLAMA_HOST",
+    "XDG_CACHE_HOME",
+)
+
+
+def forwarded_env() -> Dict[str, Optional[str]]:
+    """Values of `FORWARDED_ENV` in this process"""
+    return {name: os.environ.get(name) for name in FORWARDED_ENV}
+
+
+def _paint(text: str, color: str, bold: bool = True) -> str:
+    # Plain text when the output is piped, e.g. into an editor
+    return colored(text, color, bold) if sys.stdout.isatty() else text
+
+
+def socket_path() -> str:
+    """Socket of the daemon
+
+    Returns:
+        str: `$COMMIT_MAKER_SOCKET`, `$XDG_RUNTIME_DIR/commit_maker.sock` or
+            `commit_maker.sock` in the cache directory
+    """
+    if os.environ.get("COMMIT_MAKER_SOCKET"):
+        return os.environ["COMMIT_MAKER_SOCKET"]
+    base = os.environ.get("XDG_RUNTIME_DIR") or os.path.join(
+        os.environ.get("XDG_CACHE_HOME")
+        or os.path.join(os.path.expanduser("~"), ".cache"),
+        "commit_maker",
+    )
+    return os.path.join(base, "commit_maker.sock")
+
+
+def request(path: str, payload: Dict) -> Optional[Dict]:
+    """Sends one request and prints the events of the answer
+
+    Args:
+        path (str): Socket of the daemon
+        payload (dict): Request
+
+    Returns:
+        dict | None: Final `done` event, None if the daemon asked to run
+            the command in-process
+
+    Raises:
+        OSError: The daemon is not reachable
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(path)
+        connection.sendall(json.dumps(payload).encode("utf-8") + b"\n")
+        streaming = False
+        for line in connection.makefile("rb"):
+            event = json.loads(line)
+            kind = event["event"]
+            if kind == "fallback":
+                return None
+            if kind == "notice":
+                if streaming:
+                    # Notices after the answer, e.g. about trimming
+                    print()
+                    streaming = False
+                print(_paint(event["text"], "yellow", False))
+            elif kind == "chunk":
+                if not streaming:
+                    print(
+                        _paint("Generating commit message:", "magenta"),
+                        end=" ",
+                    )
+                    streaming = True
+                print(
+                    _paint(event["text"], "yellow", False),
+                    end="",
+                    flush=True,
+                )
+            elif kind == "error":
+                if streaming:
+                    print()
+                print(_paint(event["text"], "red", False))
+                return {"message": None, "dry_run": True}
+            elif kind == "done":
+                if streaming:
+                    print()
+                elif event.get("cached"):
+                    print(
+                        _paint("Cached commit message:", "magenta"),
+                        _paint(event["message"], "yellow", False),
+                    )
+                return event
+    raise OSError("daemon closed the connection")
+
+
+def run(argv: List[str]) -> bool:
+    """Runs the command through the daemon if it is running. Options are
+    parsed by the caller first, so `--help`, `--version`, `--json` and
+    `--stdin` never get here.
+
+    Args:
+        argv (list[str]): Command line arguments
+
+    Returns:
+        bool: True if the daemon handled the command, False if it must run
+            in-process
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        return False
+    path = socket_path()
+    if not os.path.exists(path):
+        return False
+    payload = {
+        "argv": argv,
+        "cwd": os.getcwd(),
+        "env": forwarded_env(),
+        "regenerate": False,
+    }
+    while True:
+        try:
+            done = request(path, payload)
+        except (OSError, ValueError):
+            # Stale socket or a daemon that went away. A first request is
+            # simply run in-process
+            if not payload["regenerate"]:
+                return False
+            print(_paint("Daemon is not available!", "red"))
+            return True
+        if done is None:
+            return False
+        if done["dry_run"] or not done["message"]:
+            return True
+        answer = input(
+            "Commit with message "
+            + _paint(f"'{done['message']}'", "yellow")
+            + "? [y/N/r]: "
+        )
+        if answer != "r":
+            break
+        payload["regenerate"] = True
+    if answer == "y":
+        subprocess.run(
+            ["git", "commit", "-m", done["message"]],
+            encoding="utf-8",
+        )
+        print(_paint("Commit created successfully!", "green"))
+    return True
@@ -0,0 +1,289 @@
+# Packing of the staged diff into a token budget
+import fnmatch
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+# Files that are generated or vendored. They are described last and only
+# when there is budget left over after the source files.
+GENERATED_PATTERNS = [
+    "*.lock",
+    "package-lock.json",
+    "npm-shrinkwrap.json",
+    "pnpm-lock.yaml",
+    "go.sum",
+    "*.min.js",
+    "*.min.css",
+    "*.map",
+    "*.snap",
+    "*_pb2.py",
+    "*_pb2_grpc.py",
+    "*.pb.go",
+    "*.generated.*",
+    "dist/*",
+    "build/*",
+    "vendor/*",
+    "node_modules/*",
+    "third_party/*",
+]
+
+# Marks a file diff that was cut while the staged diff was read, see
+# `git_state.DiffCapture`
+TRUNCATED_MARKER = "\\ Diff truncated"
+
+# Marks a file that is described by its stats only, see `diff_plan`
+OMITTED_MARKER = "\\ Diff omitted"
+
+# Changed lines that look like declarations are kept even when the rest of
+# the hunk body does not fit.
+SIGNATURE_RE = re.compile(
+    r"\s*(?:export\s+|pub(?:\(\w+\))?\s+|public\s+|private\s+|protected\s+"
+    r"|static\s+|async\s+)*"
+    r"(?:def|class|function|func|fn|interface|struct|enum|trait|impl|type"
+    r"|module|namespace|package|import|from)\b"
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count of the text (about 4 characters per token)
+
+    Args:
+        text (str): Text
+
+    Returns:
+        int: Estimated number of tokens
+    """
+    return (len(text) + 3) // 4
+
+
+def compact_diff(diff: str) -> str:
+    """Drops file header lines that say nothing new to the model: blob ids
+    (`index ...`) and the `---`/`+++` names repeating `diff --git`
+
+    Args:
+        diff (str): Output of `git diff`
+
+    Returns:
+        str: Diff without those lines
+    """
+    kept = []
+    in_header = False
+    for line in diff.splitlines(keepends=True):
+        if line.startswith("diff --git "):
+            in_header = True
+        elif line.startswith("@@"):
+            in_header = False
+        elif in_header and line.startswith(("index ", "--- ", "+++ ")):
+            continue
+        kept.append(line)
+    return "".join(kept)
+
+
+def is_generated(path: str) -> bool:
+    """Checks whether the file looks generated or vendored
+
+    Args:
+        path (str): Path of the file relative to the repository root
+
+    Returns:
+        bool: True for lockfiles, bundles, vendored code etc.
+    """
+    name = path.rsplit("/", 1)[-1]
+    for pattern in GENERATED_PATTERNS:
+        if pattern.endswith("/*"):
+            directory = pattern[:-1]
+            if path.startswith(directory) or f"/{directory}" in path:
+                return True
+        elif fnmatch.fnmatch(name, pattern):
+            return True
+    return False
+
+
+@dataclass
+class Hunk:
+    """Single `@@ ... @@` hunk of a file diff"""
+
+    header: str
+    lines: List[str] = field(default_factory=list)
+
+    def render(self, full: bool) -> str:
+        """Renders the hunk
+
+        Args:
+            full (bool): Render the whole body, otherwise only the header
+                and the changed lines that look like signatures
+
+        Returns:
+            str: Hunk text
+        """
+        if full:
+            return "\n".join([self.header] + self.lines) + "\n"
+        signatures = [
+            line
+            for line in self.lines
+            if line[:1] in ("+", "-") and SIGNATURE_RE.match(line[1:])
+        ]
+        rendered = [self.header] + signatures
+        omitted = len(self.lines) - len(signatures)
+        if omitted:
+            rendered.append(f"... {omitted} lines omitted")
+        return "\n".join(rendered) + "\n"
+
+
+@dataclass
+class FileDiff:
+    """Diff of a single file"""
+
+    path: str
+    header: List[str] = field(default_factory=list)
+    hunks: List[Hunk] = field(default_factory=list)
+
+    @property
+    def added(self) -> int:
+        return sum(
+            line.startswith("+") for hunk in self.hunks for line in hunk.lines
+        )
+
+    @property
+    def removed(self) -> int:
+        return sum(
+            line.startswith("-") for hunk in self.hunks for line in hunk.lines
+        )
+
+    @property
+    def generated(self) -> bool:
+        return is_generated(self.path)
+
+    @property
+    def truncated(self) -> bool:
+        # The marker follows the last line that was kept
+        tail = self.hunks[-1].lines if self.hunks else self.header
+        return bool(tail) and tail[-1].startswith(TRUNCATED_MARKER)
+
+    @property
+    def omitted(self) -> bool:
+        return any(line.startswith(OMITTED_MARKER) for line in self.header)
+
+    def stat(self) -> str:
+        """One-line summary of the file change"""
+        for line in self.header:
+            if line.startswith(OMITTED_MARKER):
+                return f"{self.path} | {line[len(OMITTED_MARKER) + 2:]}"
+        if any(line.startswith("Binary files") for line in self.header):
+            return f"{self.path} | binary"
+        if self.truncated:
+            return (
+                f"{self.path} | truncated, "
+                f"+{self.added} -{self.removed} shown"
+            )
+        return f"{self.path} | +{self.added} -{self.removed}"
+
+    def render(self, full_hunks: List[bool]) -> str:
+        """Renders the file diff
+
+        Args:
+            full_hunks (list[bool]): Which hunks are rendered in full
+
+        Returns:
+            str: File diff text
+        """
+        return "\n".join(self.header) + "\n" + "".join(
+            hunk.render(full) for hunk, full in zip(self.hunks, full_hunks)
+        )
+
+
+def parse_diff(diff: str) -> List[FileDiff]:
+    """Splits unified `git diff` output into files and hunks
+
+    Args:
+        diff (str): Output of `git diff`
+
+    Returns:
+        list[FileDiff]: Parsed files
+    """
+    files: List[FileDiff] = []
+    current = None
+    for line in diff.splitlines():
+        if line.startswith("diff --git "):
+            path = line.split(" b/", 1)[-1]
+            current = FileDiff(path=path, header=[line])
+            files.append(current)
+        elif current is None:
+            continue
+        elif line.startswith("@@"):
+            current.hunks.append(Hunk(header=line))
+        elif current.hunks:
+            current.hunks[-1].lines.append(line)
+        else:
+            if line.startswith("+++ b/"):
+                current.path = line[len("+++ b/"):].rstrip("\t")
+            current.header.append(line)
+    return files
+
+
+def pack_diff(diff: str, max_tokens: int) -> str:
+    """Fits the diff into a token budget.
+
+    Source files go before generated ones, and hunk headers with signature
+    lines go before hunk bodies. Files that do not fit even as a skeleton
+    are listed with their stats at the end.
+
+    Args:
+        diff (str): Output of `git diff`
+        max_tokens (int): Token budget for the diff
+
+    Returns:
+        str: Packed diff, unchanged if it already fits
+    """
+    if estimate_tokens(diff) <= max_tokens:
+        return diff
+    files = parse_diff(diff)
+    order = sorted(files, key=lambda f: f.generated)
+    # Stats are reserved up front, so every file is at least mentioned
+    used = sum(estimate_tokens(f.stat() + "\n") for f in files)
+    chosen: Dict[int, List[bool]] = {}
+
+    # Skeletons of source files
+    for file in order:
+        if file.generated:
+            continue
+        flags = [False] * len(file.hunks)
+        cost = estimate_tokens(file.render(flags))
+        if used + cost <= max_tokens:
+            chosen[id(file)] = flags
+            used += cost
+
+    # Full hunk bodies, in the same priority order
+    for file in order:
+        flags = chosen.get(id(file))
+        if flags is None:
+            continue
+        for i, hunk in enumerate(file.hunks):
+            extra = estimate_tokens(hunk.render(True)) - estimate_tokens(
+                hunk.render(False)
+            )
+            if used + extra <= max_tokens:
+                flags[i] = True
+                used += extra
+
+    # Generated files only in full and only with leftover budget
+    for file in order:
+        if not file.generated:
+            continue
+        flags = [True] * len(file.hunks)
+        cost = estimate_tokens(file.render(flags))
+        if used + cost <= max_tokens:
+            chosen[id(file)] = flags
+            used += cost
+
+    packed = [
+        file.render(chosen[id(file)]) for file in files if id(file) in chosen
+    ]
+    omitted = [file.stat() for file in files if id(file) not in chosen]
+    if omitted:
+        packed.append(
+            "Files omitted from diff (path | added/removed lines):\n"
+            + "\n".join(omitted)
+            + "\n"
+        )
+    return "".join(packed)
@@ -0,0 +1,244 @@
+# Planning of the staged diff: the cheap `git diff --numstat` runs first,
+# files that are not worth describing (binaries, lockfiles, generated code)
+# are left out of the full `git diff` and sent as one-line stats instead.
+import fnmatch
+import json
+import os
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence
+
+from .diff_packer import OMITTED_MARKER, FileDiff, is_generated
+
+# Project config with fnmatch patterns, e.g.
+# {"stats_only": ["fixtures/*"], "full_diff": ["*.snap"]}
+CONFIG_FILE = ".commit_maker.json"
+
+# Attributes read with `git check-attr`
+ATTRIBUTES = ["linguist-generated", "diff"]
+
+# Largest exclusion pathspecs passed on the command line; beyond that the
+# files are dropped while the diff is read (ARG_MAX is 128 KiB per argument
+# list on some systems)
+MAX_EXCLUSION_BYTES = 32 * 1024
+
+
+@dataclass
+class FileStat:
+    """One file of `git diff --numstat`"""
+
+    path: str
+    # None for binary files
+    added: Optional[int]
+    removed: Optional[int]
+    # Source of a rename or copy
+    old_path: Optional[str] = None
+    # Why only the stats are sent, None if the full diff is
+    reason: Optional[str] = None
+
+    def stat(self) -> str:
+        """Stats for the model, e.g. `+12 -3, generated`"""
+        if self.added is None:
+            return "binary"
+        return f"+{self.added} -{self.removed}, {self.reason}"
+
+    def stub(self) -> str:
+        """File diff of the stats, in place of the full one"""
+        old_path = self.old_path or self.path
+        return (
+            f"diff --git a/{old_path} b/{self.path}\n"
+            f"{OMITTED_MARKER}: {self.stat()}\n"
+        )
+
+
+def numstat_command(excluded_files: Sequence[str]) -> List[str]:
+    """`git diff --staged --numstat` with excluded files as pathspecs"""
+    command = ["git", "diff", "--staged", "--numstat", "-z", "-M"]
+    if excluded_files:
+        command.extend(["--", "."])
+        command.extend([f":!{file}" for file in excluded_files])
+    return command
+
+
+def parse_numstat(output: str) -> List[FileStat]:
+    """Parses `git diff --numstat -z`
+
+    Args:
+        output (str): Output of the command
+
+    Returns:
+        list[FileStat]: Changed files
+    """
+    stats = []
+    fields = iter(output.split("\0"))
+    for entry in fields:
+        if not entry:
+            continue
+        added, removed, path = entry.split("\t", 2)
+        old_path = None
+        if not path:
+            # Renames and copies give both paths as separate fields
+            old_path, path = next(fields), next(fields)
+        binary = added == "-"
+        stats.append(
+            FileStat(
+                path=path,
+                added=None if binary else int(added),
+                removed=None if binary else int(removed),
+                old_path=old_path,
+            )
+        )
+    return stats
+
+
+def file_stat(file: FileDiff) -> FileStat:
+    """Numstat of a parsed file diff, for diffs that do not come from the
+    local index"""
+    binary = any(line.startswith("Binary files") for line in file.header)
+    old_path = next(
+        (
+            line[len("rename from "):]
+            for line in file.header
+            if line.startswith("rename from ")
+        ),
+        None,
+    )
+    return FileStat(
+        path=file.path,
+        added=None if binary else file.added,
+        removed=None if binary else file.removed,
+        old_path=old_path,
+    )
+
+
+def check_attr_command() -> List[str]:
+    """`git check-attr` of the planning attributes for the paths given on
+    stdin, see `check_attr_input`"""
+    return ["git", "check-attr", "--stdin", "-z", *ATTRIBUTES]
+
+
+def check_attr_input(paths: Sequence[str]) -> str:
+    """Stdin of `check_attr_command`: NUL-terminated paths, so that change
+    sets of any size fit"""
+    return "".join(f"{path}\0" for path in paths)
+
+
+def parse_check_attr(output: str) -> Dict[str, Dict[str, str]]:
+    """Parses `git check-attr -z`
+
+    Returns:
+        dict[str, dict[str, str]]: Values of the attributes by path, without
+            unspecified ones
+    """
+    attributes: Dict[str, Dict[str, str]] = {}
+    fields = output.split("\0")
+    for i in range(0, len(fields) - 2, 3):
+        path, name, value = fields[i:i + 3]
+        if value != "unspecified":
+            attributes.setdefault(path, {})[name] = value
+    return attributes
+
+
+def load_config(root: Optional[str] = None) -> Dict[str, List[str]]:
+    """Reads `stats_only` and `full_diff` patterns of the project config
+
+    Args:
+        root (str, optional): Repository directory. Defaults to the current.
+
+    Returns:
+        dict[str, list[str]]: Patterns, empty without a readable config
+    """
+    try:
+        with open(
+            os.path.join(root or ".", CONFIG_FILE), encoding="utf-8"
+        ) as f:
+            config = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(config, dict):
+        return {}
+    return {
+        key: [str(pattern) for pattern in config.get(key, [])]
+        for key in ("stats_only", "full_diff")
+    }
+
+
+def _matches(path: str, patterns: Sequence[str]) -> bool:
+    # Patterns without a slash also match the file name in any directory
+    name = path.rsplit("/", 1)[-1]
+    return any(
+        fnmatch.fnmatch(path, pattern)
+        or ("/" not in pattern and fnmatch.fnmatch(name, pattern))
+        for pattern in patterns
+    )
+
+
+def classify(
+    stats: Sequence[FileStat],
+    attributes: Dict[str, Dict[str, str]],
+    config: Dict[str, List[str]],
+) -> None:
+    """Sets `reason` of the files that are sent as stats only. The project
+    config wins over `.gitattributes`, which wins over the built-in
+    patterns; binary files are always sent as stats.
+
+    Args:
+        stats (list[FileStat]): Changed files
+        attributes (dict): Result of `parse_check_attr`
+        config (dict): Result of `load_config`
+    """
+    for file in stats:
+        values = attributes.get(file.path, {})
+        generated = values.get("linguist-generated")
+        if file.added is None:
+            file.reason = "binary"
+        elif _matches(file.path, config.get("full_diff", [])):
+            continue
+        elif _matches(file.path, config.get("stats_only", [])):
+            file.reason = "project config"
+        elif values.get("diff") == "unset":
+            file.reason = "-diff"
+        elif generated in ("set", "true"):
+            file.reason = "generated"
+        elif generated in ("unset", "false"):
+            continue
+        elif is_generated(file.path):
+            file.reason = "lockfile or generated"
+
+
+def stats_only(
+    stats: Sequence[FileStat],
+    attributes: Dict[str, Dict[str, str]],
+    config: Dict[str, List[str]],
+) -> List[FileStat]:
+    """Classifies the files and keeps those sent as stats only
+
+    Args:
+        stats (list[FileStat]): Changed files
+        attributes (dict): Result of `parse_check_attr`
+        config (dict): Result of `load_config`
+
+    Returns:
+        list[FileStat]: Files with a `reason`
+    """
+    classify(stats, attributes, config)
+    return [file for file in stats if file.reason]
+
+
+def planned_exclusions(planned: Sequence[FileStat]) -> List[str]:
+    """Literal top-level `:(exclude)` pathspecs of the files sent as stats.
+    Both paths of a rename are excluded, or git would show the other one as
+    added or deleted.
+
+    Returns:
+        list[str]: Pathspecs, empty if they exceed `MAX_EXCLUSION_BYTES`;
+            the files are then dropped from the diff output instead
+    """
+    paths = []
+    for file in planned:
+        paths.append(file.path)
+        if file.old_path:
+            paths.append(file.old_path)
+    exclusions = [f":(top,exclude,literal){path}" for path in paths]
+    if sum(len(pathspec) + 1 for pathspec in exclusions) > MAX_EXCLUSION_BYTES:
+        return []
+    return exclusions
@@ -0,0 +1,415 @@
+# Building of the model request for staged changes, shared by the CLI and
+# the daemon
+import copy
+import json
+import os
+import tempfile
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from .diff_packer import compact_diff, estimate_tokens, pack_diff
+from .git_state import (
+    MAX_DIFF_BYTES,
+    DiffOptions,
+    RepoState,
+    read_staged_diff,
+)
+from .rate_limit import file_lock
+from .response_cache import ResponseCache, default_cache_dir
+
+# A blank line in the answer starts explanations, not the message
+MESSAGE_STOP = ["\n\n"]
+
+
+@dataclass
+class Prompt:
+    """Messages for the model and how the changes were shortened"""
+
+    messages: List[Dict[str, str]]
+    # Estimated tokens of the packed diff, 0 if the diff fit as is
+    packed_tokens: int = 0
+    # Map-reduce chunks described by their stats only
+    failed_chunks: List[str] = field(default_factory=list)
+
+
+def build_prompt(
+    client,
+    state: RepoState,
+    system_prompt: str,
+    max_input_tokens: int = 0,
+    split_by: Optional[str] = None,
+    chunk_timeout: Optional[float] = 60,
+    concurrency: int = 4,
+    summary_cache=None,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+    compact: bool = False,
+    header: Optional[str] = None,
+    encoding: Optional[Dict] = None,
+) -> Prompt:
+    """Builds messages for the staged changes: the packed diff, or with
+    `split_by` map-reduce summaries of its chunks
+
+    Args:
+        client (Backend): AI backend, used for summaries
+        state (RepoState): Repository state
+        system_prompt (str): Prompt for commit message generation
+        max_input_tokens (int, optional): Token budget, 0 for no limit.
+            Defaults to 0.
+        split_by (str, optional): `file` or `dir` for map-reduce
+        chunk_timeout (float, optional): Deadline for one chunk summary.
+            Defaults to 60.
+        concurrency (int, optional): Maximum simultaneous summaries.
+            Defaults to 4.
+        summary_cache (SummaryCache, optional): Cache of chunk summaries
+        on_progress (callable, optional): Called with (done, total) chunks
+        compact (bool, optional): Short status and diff headers. Defaults
+            to False.
+        header (str, optional): Text sent before the changes instead of
+            the git status, e.g. the original message of a reworded commit
+        encoding (dict, optional): `encoding_key` of the options, keeps
+            summaries of differently encoded diffs apart in the cache
+
+    Returns:
+        Prompt: Messages for the model
+    """
+    prompt = Prompt(messages=[])
+    max_input_tokens = input_token_budget(client, max_input_tokens)
+    status, state_diff = encode_state(state, compact)
+    if header is None:
+        header = "Git status: " + status
+    if split_by:
+        from .map_reduce import summarize_diff
+
+        summaries, prompt.failed_chunks = summarize_diff(
+            client,
+            state_diff,
+            by=split_by,
+            chunk_timeout=chunk_timeout,
+            concurrency=concurrency,
+            max_chunk_tokens=max_input_tokens,
+            on_progress=on_progress,
+            cache=summary_cache,
+            blobs=state.blobs,
+            encoding=encoding,
+            truncated=state.truncated,
+        )
+        changes = "Summaries of changes: " + summaries
+    else:
+        diff = state_diff
+        if max_input_tokens:
+            budget = max_input_tokens - estimate_tokens(system_prompt + header)
+            diff = pack_diff(diff, budget)
+            if diff != state_diff:
+                prompt.packed_tokens = estimate_tokens(diff)
+        changes = "Git diff: " + diff
+    prompt.messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": header + changes},
+    ]
+    return prompt
+
+
+def input_token_budget(client, max_input_tokens: int) -> int:
+    """--max-input-tokens lowered to what fits the context of the model
+
+    Args:
+        client (Backend): AI backend, local ones know their context length
+        max_input_tokens (int): Token budget, 0 for no limit
+
+    Returns:
+        int: Token budget, 0 for no limit
+    """
+    budget = client.input_budget() if hasattr(client, "input_budget") else None
+    if budget is None:
+        return max_input_tokens
+    return min(max_input_tokens, budget) if max_input_tokens else budget
+
+
+def estimate_prompt_tokens(
+    state: RepoState,
+    system_prompt: str,
+    max_input_tokens: int,
+    compact: bool = False,
+) -> int:
+    """Expected size of the prompt before it is built, e.g. to load a local
+    model with a fitting context
+
+    Returns:
+        int: Estimated tokens
+    """
+    status, diff = encode_state(state, compact)
+    tokens = estimate_tokens(system_prompt + status + diff)
+    return min(tokens, max_input_tokens) if max_input_tokens else tokens
+
+
+def encode_state(state: RepoState, compact: bool) -> Tuple[str, str]:
+    """Status and diff as they are sent to the model
+
+    Args:
+        state (RepoState): Repository state
+        compact (bool): Short status and diff headers
+
+    Returns:
+        tuple[str, str]: Status and diff
+    """
+    if compact:
+        return state.short_status, compact_diff(state.diff)
+    return state.status, state.diff
+
+
+def diff_options(args) -> Optional[DiffOptions]:
+    """--compact, --unified and --ignore-whitespace as `DiffOptions`
+
+    Args:
+        args (argparse.Namespace): Parsed CLI options
+
+    Returns:
+        DiffOptions | None: Options, None for the git defaults
+    """
+    if not (
+        args.compact or args.unified is not None or args.ignore_whitespace
+    ):
+        return None
+    options = DiffOptions.compact() if args.compact else DiffOptions()
+    if args.unified is not None:
+        options.context = args.unified
+    options.ignore_whitespace = args.ignore_whitespace
+    return options
+
+
+def encoding_key(args) -> Optional[Dict]:
+    """Prompt encoding options for `message_cache_key`, None for the
+    default encoding"""
+    options = diff_options(args)
+    key = dict(asdict(options), compact=args.compact) if options else {}
+    if args.full_diff:
+        key["full_diff"] = True
+    return key or None
+
+
+def token_report(
+    state: RepoState,
+    compact: bool,
+    excluded_files: Sequence[str],
+    cwd: Optional[str] = None,
+    max_diff_bytes: int = MAX_DIFF_BYTES,
+) -> Tuple[int, int]:
+    """Estimated tokens of the status and diff before packing, as encoded
+    and with the default encoding. The default diff is read again for it,
+    under the same cap.
+
+    Args:
+        state (RepoState): Repository state
+        compact (bool): Short status and diff headers
+        excluded_files (list[str]): Files excluded from the diff
+        cwd (str, optional): Repository directory
+        max_diff_bytes (int, optional): --max-diff-bytes. Defaults to
+            8 MiB.
+
+    Returns:
+        tuple[int, int]: Encoded and default tokens
+    """
+    status, diff = encode_state(state, compact)
+    default_diff = read_staged_diff(excluded_files, cwd, max_diff_bytes)
+    return (
+        estimate_tokens(status + diff),
+        estimate_tokens(state.status + default_diff),
+    )
+
+
+def format_token_report(tokens: Tuple[int, int]) -> str:
+    """One line of --token-report"""
+    encoded, default = tokens
+    saved = (default - encoded) / default * 100 if default else 0.0
+    return (
+        f"Status and diff: ~{encoded} tokens, ~{default} with the default "
+        f"encoding ({saved:.0f}% saved)"
+    )
+
+
+def output_limits(max_symbols: int) -> Dict:
+    """Generation cap for a message of `max_symbols` characters: about two
+    characters per token (Cyrillic text takes more tokens than English),
+    plus a margin so that trimming has a word boundary to cut at
+
+    Args:
+        max_symbols (int): --max-symbols, 0 for no cap
+
+    Returns:
+        dict: `max_tokens` and `stop` arguments of the backend
+    """
+    if not max_symbols:
+        return {}
+    return {"max_tokens": max_symbols // 2 + 16, "stop": list(MESSAGE_STOP)}
+
+
+def trim_message(message: str, max_symbols: int) -> str:
+    """Deterministically shortens an over-long message: to the last
+    sentence end that keeps at least half of it, otherwise to the last
+    whole word
+
+    Args:
+        message (str): Generated message
+        max_symbols (int): --max-symbols, 0 for no limit
+
+    Returns:
+        str: Message of at most `max_symbols` characters
+    """
+    message = message.strip()
+    if not max_symbols or len(message) <= max_symbols:
+        return message
+    # One character more shows whether the limit falls between words
+    window = message[: max_symbols + 1]
+    ends = [window.rfind(mark) + 1 for mark in (". ", "! ", "? ")]
+    ends.append(window.rfind("\n", 0, max_symbols))
+    end = max(ends)
+    if end >= max_symbols // 2:
+        return window[:end].strip()
+    if not window[-1].isspace():
+        space = window.rfind(" ", 0, max_symbols)
+        if space > 0:
+            window = window[:space]
+    return window[:max_symbols].rstrip(" ,;:-")
+
+
+def trim_stats(path: Optional[str] = None) -> Dict[str, int]:
+    """Generated and trimmed messages counted across runs
+
+    Args:
+        path (str, optional): Counter file. Defaults to
+            `default_cache_dir()/output_stats.json`.
+
+    Returns:
+        dict[str, int]: `generated` and `trimmed` totals
+    """
+    path = path or os.path.join(default_cache_dir(), "output_stats.json")
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"generated": 0, "trimmed": 0}
+
+
+def count_trim(trimmed: bool, path: Optional[str] = None) -> Dict[str, int]:
+    """Counts a generated message in `trim_stats`. Only the CLI counts, and
+    not with --no-cache; the file is locked for concurrent processes.
+
+    Args:
+        trimmed (bool): Whether this message was trimmed
+        path (str, optional): Counter file. Defaults to
+            `default_cache_dir()/output_stats.json`.
+
+    Returns:
+        dict[str, int]: `generated` and `trimmed` totals
+    """
+    path = path or os.path.join(default_cache_dir(), "output_stats.json")
+    stats = trim_stats(path)
+    try:
+        with file_lock(path + ".lock"):
+            stats = trim_stats(path)
+            stats["generated"] += 1
+            stats["trimmed"] += trimmed
+            fd, tmp = tempfile.mkstemp(
+                dir=os.path.dirname(path), suffix=".tmp"
+            )
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(stats, f)
+            os.replace(tmp, path)
+    except OSError:
+        pass
+    return stats
+
+
+def finish_message(
+    message: Optional[str], max_symbols: int
+) -> Tuple[Optional[str], bool]:
+    """Trims a generated message to --max-symbols. Free of side effects,
+    the CLI counts trimmed messages itself with `count_trim`
+
+    Args:
+        message (str | None): Generated message
+        max_symbols (int): --max-symbols, 0 for no limit
+
+    Returns:
+        tuple[str | None, bool]: Message, None if it is empty, and whether
+            it was trimmed
+    """
+    if not message or not message.strip():
+        return None, False
+    trimmed = trim_message(message, max_symbols)
+    changed = trimmed != message.strip()
+    return trimmed or None, changed
+
+
+def resilient_client(client, args, secondary=None):
+    """Applies --retries and --deadline to the client and pairs it with the
+    --fallback backend
+
+    Args:
+        client (Backend): Main backend
+        args (argparse.Namespace): Parsed CLI options
+        secondary (Backend, optional): Ready --fallback client. Created
+            from the option by default.
+
+    Returns:
+        Backend: Copy of the client with the policy or a `HedgedBackend`
+    """
+    from .http_session import RetryPolicy
+
+    retry = RetryPolicy(attempts=args.retries + 1, deadline=args.deadline)
+    # Shallow copies with their own policy: the daemon shares one client
+    # (and its session) between concurrent requests with different options
+    client = copy.copy(client)
+    client.retry = retry
+    if not args.fallback:
+        return client
+    from .backends import get_backend
+    from .hedging import HedgedBackend
+
+    if secondary is None:
+        name, _, model = args.fallback.partition(":")
+        secondary = get_backend(name).from_options(
+            model=model or None, pool_size=max(4, args.concurrency)
+        )
+    else:
+        secondary = copy.copy(secondary)
+    secondary.retry = retry
+    return HedgedBackend(
+        client,
+        secondary,
+        hedge_after=args.hedge_after,
+        deadline=args.deadline,
+    )
+
+
+def message_cache_key(
+    tree: str,
+    model: Optional[str],
+    excluded_files: Sequence[str],
+    language: str,
+    max_symbols: int,
+    wish: Optional[str],
+    temperature: float,
+    max_input_tokens: int,
+    split_by: Optional[str],
+    encoding: Optional[Dict] = None,
+) -> str:
+    """Key of generated messages in `ResponseCache`
+
+    Returns:
+        str: Key
+    """
+    # Keys of the default encoding stay as they were before it was added
+    extra = {"encoding": encoding} if encoding else {}
+    return ResponseCache.key(
+        **extra,
+        tree=tree,
+        exclude=sorted(excluded_files),
+        model=model,
+        language=language,
+        max_symbols=max_symbols,
+        wish=wish,
+        temperature=temperature,
+        max_input_tokens=max_input_tokens,
+        split=split_by,
+    )
@@ -0,0 +1,765 @@
+# Collection of the repository state in a minimal number of git calls
+import asyncio
+import fnmatch
+import subprocess
+from dataclasses import dataclass, field
+from typing import (
+    BinaryIO,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+from . import trace
+from .diff_packer import TRUNCATED_MARKER, parse_diff
+from .diff_plan import (
+    FileStat,
+    check_attr_command,
+    check_attr_input,
+    file_stat,
+    load_config,
+    numstat_command,
+    parse_check_attr,
+    parse_numstat,
+    planned_exclusions,
+    stats_only,
+)
+
+# Default cap of the staged diff kept in memory
+MAX_DIFF_BYTES = 8 * 1024 * 1024
+READ_CHUNK = 64 * 1024
+
+CHANGE_TYPES = {
+    "M": "modified",
+    "T": "typechange",
+    "A": "new file",
+    "D": "deleted",
+    "R": "renamed",
+    "C": "copied",
+    "U": "unmerged",
+}
+
+
+@dataclass
+class RepoState:
+    """Staged, unstaged and untracked changes of the repository"""
+
+    branch: str = ""
+    # (change type, path) pairs
+    staged: List[Tuple[str, str]] = field(default_factory=list)
+    unstaged: List[Tuple[str, str]] = field(default_factory=list)
+    untracked: List[str] = field(default_factory=list)
+    diff: str = ""
+    # Hash of the tree object for the index, empty if it was not requested
+    tree: str = ""
+    # (HEAD blob, index blob) of every staged path
+    blobs: Dict[str, Tuple[str, str]] = field(default_factory=dict)
+    # Paths whose diff was cut or left out by the diff size cap
+    truncated: List[str] = field(default_factory=list)
+    # Status given by the caller, e.g. with a diff read from stdin. It is
+    # sent as is instead of the one built from the entries
+    status_text: str = ""
+
+    @property
+    def has_changes(self) -> bool:
+        return bool(self.staged or self.unstaged or self.untracked)
+
+    @property
+    def status(self) -> str:
+        """Status in the form of `git status` output, without hints"""
+        if self.status_text:
+            return self.status_text
+        lines = [f"On branch {self.branch}"] if self.branch else []
+        for title, entries in (
+            ("Changes to be committed:", self.staged),
+            ("Changes not staged for commit:", self.unstaged),
+        ):
+            if entries:
+                lines.append(title)
+                lines.extend(
+                    f"  {CHANGE_TYPES.get(change, change)}: {path}"
+                    for change, path in entries
+                )
+        if self.untracked:
+            lines.append("Untracked files:")
+            lines.extend(f"  {path}" for path in self.untracked)
+        return "\n".join(lines) + "\n"
+
+    @property
+    def short_status(self) -> str:
+        """Compact status: branch and one `XY path` line per entry, as in
+        `git status --short`"""
+        if self.status_text:
+            return self.status_text
+        lines = [f"## {self.branch}"] if self.branch else []
+        lines.extend(f"{change}  {path}" for change, path in self.staged)
+        lines.extend(f" {change} {path}" for change, path in self.unstaged)
+        lines.extend(f"?? {path}" for path in self.untracked)
+        return "\n".join(lines) + "\n"
+
+
+@dataclass
+class DiffOptions:
+    """How the staged diff is encoded for the model"""
+
+    # Lines of context around changes, None for the git default of 3
+    context: Optional[int] = None
+    # Copies are detected too (-C), renames always are (-M)
+    find_copies: bool = False
+    # Changes in whitespace only are left out (-w)
+    ignore_whitespace: bool = False
+
+    @classmethod
+    def compact(cls) -> "DiffOptions":
+        """Options of the compact encoding"""
+        return cls(context=1, find_copies=True)
+
+    def args(self) -> List[str]:
+        """Options of `git diff`"""
+        args = ["-M"]
+        if self.find_copies:
+            args.append("-C")
+        if self.context is not None:
+            args.append(f"-U{self.context}")
+        if self.ignore_whitespace:
+            args.append("-w")
+        return args
+
+
+def run_git_commands(
+    *commands: Sequence[str],
+    cwd: Optional[str] = None,
+) -> List[str]:
+    """Runs independent git commands concurrently
+
+    Args:
+        *commands (list[str]): Commands
+        cwd (str, optional): Repository directory. Defaults to the current.
+
+    Returns:
+        list[str]: Stdout of every command, in the same order
+    """
+    tracer = trace.active()
+    started = tracer.now() if tracer else 0.0
+    processes = [
+        subprocess.Popen(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            encoding="utf-8",
+            errors="replace",
+            cwd=cwd,
+        )
+        for command in commands
+    ]
+    # Outputs are read one by one, the rest of the processes keep running
+    outputs = []
+    for command, process in zip(commands, processes):
+        outputs.append(process.communicate()[0])
+        if tracer:
+            tracer.record(
+                trace.Span(
+                    "git",
+                    " ".join(command[:2]),
+                    started,
+                    tracer.now() - started,
+                    {"cwd": cwd or "."},
+                )
+            )
+    return outputs
+
+
+def run_git_input(
+    command: Sequence[str], data: str, cwd: Optional[str] = None
+) -> str:
+    """Runs a git command that reads its arguments from stdin
+
+    Args:
+        command (list[str]): Command
+        data (str): Stdin
+        cwd (str, optional): Repository directory. Defaults to the current.
+
+    Returns:
+        str: Stdout
+    """
+    with trace.span("git", " ".join(command[:2]), cwd=cwd or "."):
+        return subprocess.run(
+            command,
+            input=data,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            encoding="utf-8",
+            errors="replace",
+            cwd=cwd,
+        ).stdout
+
+
+def parse_porcelain_v2(output: str) -> RepoState:
+    """Parses `git status --porcelain=v2 -z --branch`
+
+    Args:
+        output (str): Output of the command
+
+    Returns:
+        RepoState: State without the diff, with blob ids of staged paths
+    """
+    state = RepoState()
+    entries = iter(output.split("\0"))
+    for entry in entries:
+        if entry.startswith("# branch.head "):
+            state.branch = entry[len("# branch.head "):]
+        elif entry.startswith(("1 ", "2 ", "u ")):
+            kind, xy = entry[0], entry[2:4]
+            # Ordinary entries have 8 fields before the path, renamed and
+            # copied ones have 9 and unmerged ones 10
+            fields = entry.split(" ", {"1": 8, "2": 9, "u": 10}[kind])
+            path = fields[-1]
+            if kind == "2":
+                path = f"{next(entries)} -> {path}"
+            if kind == "u":
+                state.staged.append(("U", path))
+                continue
+            if xy[0] != ".":
+                state.staged.append((xy[0], path))
+                # Keyed by the new path, as in the diff
+                state.blobs[fields[-1]] = (fields[6], fields[7])
+            if xy[1] != ".":
+                state.unstaged.append((xy[1], path))
+        elif entry.startswith("? "):
+            state.untracked.append(entry[2:])
+    return state
+
+
+def state_from_diff(
+    diff: str,
+    status: str = "",
+    excluded_files: Sequence[str] = (),
+    plan: bool = False,
+) -> RepoState:
+    """State for a diff produced elsewhere, e.g. read from stdin. Staged
+    entries are taken from the file headers of the diff.
+
+    Args:
+        diff (str): Output of `git diff`
+        status (str, optional): Status text sent instead of the one built
+            from the entries
+        excluded_files (list[str], optional): Files whose diffs are left out
+        plan (bool, optional): Replace diffs of binaries, lockfiles and
+            generated files with their stats, by the built-in patterns and
+            the project config. Defaults to False.
+
+    Returns:
+        RepoState: State without tree and blob ids
+    """
+    files = [
+        file
+        for file in parse_diff(diff)
+        if not any(fnmatch.fnmatch(file.path, name) for name in excluded_files)
+    ]
+    stubs: Dict[str, str] = {}
+    if plan:
+        planned = stats_only(
+            [file_stat(file) for file in files], {}, load_config()
+        )
+        stubs = {file.path: file.stub() for file in planned}
+    if excluded_files or stubs:
+        diff = "".join(
+            stubs.get(file.path) or file.render([True] * len(file.hunks))
+            for file in files
+        )
+    state = RepoState(diff=diff, status_text=status)
+    for file in files:
+        change = "M"
+        for line in file.header:
+            if line.startswith("new file mode"):
+                change = "A"
+            elif line.startswith("deleted file mode"):
+                change = "D"
+            elif line.startswith("rename from"):
+                change = "R"
+            elif line.startswith("copy from"):
+                change = "C"
+        state.staged.append((change, file.path))
+    return state
+
+
+def staged_diff_command(
+    excluded_files: Sequence[str],
+    options: Optional[DiffOptions] = None,
+    exclusions: Sequence[str] = (),
+) -> List[str]:
+    """`git diff --staged` with excluded files as `:!file` pathspecs
+
+    Args:
+        excluded_files (list[str]): Files to exclude
+        options (DiffOptions, optional): Encoding of the diff. Defaults to
+            the git defaults.
+        exclusions (list[str], optional): More pathspecs to exclude, e.g.
+            from `planned_exclusions`
+
+    Returns:
+        list[str]: Command
+    """
+    command = ["git", "diff", "--staged"]
+    if options:
+        command.extend(options.args())
+    if excluded_files or exclusions:
+        command.extend(["--", "."])
+        command.extend([f":!{file}" for file in excluded_files])
+        command.extend(exclusions)
+    return command
+
+
+class DiffCapture:
+    """Keeps at most `max_bytes` of a diff that is fed in chunks as git
+    writes it. A file diff larger than `max_file_bytes` is cut and marked;
+    once the whole cap is used, reading stops and the files that were not
+    reached become marked stubs. Memory does not grow with the diff size
+    beyond the cap."""
+
+    def __init__(self, max_bytes: int, max_file_bytes: int):
+        """Initialization
+
+        Args:
+            max_bytes (int): Cap of the whole diff, 0 for no cap
+            max_file_bytes (int): Cap of one file diff, 0 for no cap
+        """
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.size = 0
+        self.full = False
+        self.paths: List[str] = []
+        self.truncated: List[str] = []
+        # Paths whose file diffs are dropped, e.g. files sent as stats
+        self.skipped: Set[str] = set()
+        self._lines: List[bytes] = []
+        self._partial = b""
+        self._file_size = 0
+        self._skipping = False
+        self._long_line = False
+
+    def feed(self, data: bytes) -> bool:
+        """Adds the next chunk of git output
+
+        Args:
+            data (bytes): Chunk
+
+        Returns:
+            bool: False when the cap is reached and reading can stop
+        """
+        lines = (self._partial + data).split(b"\n")
+        self._partial = lines.pop()
+        for line in lines:
+            if self._long_line:
+                # Rest of a line that was dropped
+                self._long_line = False
+                continue
+            if not self._add(line):
+                return False
+        if self.max_file_bytes and len(self._partial) > self.max_file_bytes:
+            # A single line longer than a whole file diff may be
+            self._add(self._partial)
+            self._partial = b""
+            self._long_line = True
+        return not self.full
+
+    def _add(self, line: bytes) -> bool:
+        size = len(line) + 1
+        over_cap = self.max_bytes and self.size + size > self.max_bytes
+        if line.startswith(b"diff --git "):
+            path = line.decode("utf-8", errors="replace").split(" b/", 1)[-1]
+            if path in self.skipped:
+                self._skipping = True
+                return True
+            if over_cap:
+                # The file becomes a stub in `result()`
+                self.full = True
+                return False
+            self.paths.append(path)
+            self._file_size = 0
+            self._skipping = False
+        elif self._skipping:
+            return True
+        elif over_cap:
+            self._cut("diff size limit reached")
+            self.full = True
+            return False
+        elif (
+            self.max_file_bytes
+            and self._file_size + size > self.max_file_bytes
+        ):
+            self._cut(f"file diff exceeds {self.max_file_bytes} bytes")
+            self._skipping = True
+            return True
+        self._lines.append(line)
+        self.size += size
+        self._file_size += size
+        return True
+
+    def _cut(self, reason: str) -> None:
+        if self.paths and self.paths[-1] not in self.truncated:
+            self._lines.append(f"{TRUNCATED_MARKER}: {reason}".encode())
+            self.truncated.append(self.paths[-1])
+
+    def result(self, staged_paths: Sequence[str] = ()) -> str:
+        """Captured diff text
+
+        Args:
+            staged_paths (list[str], optional): All paths of the diff. When
+                reading stopped early, those that were not reached are
+                appended as stubs.
+
+        Returns:
+            str: Diff
+        """
+        if self._partial and not self.full:
+            self._add(self._partial)
+            self._partial = b""
+        if self.full:
+            seen = set(self.paths)
+            for path in staged_paths:
+                if path not in seen:
+                    self._lines.append(
+                        f"diff --git a/{path} b/{path}\n"
+                        f"{TRUNCATED_MARKER}: diff size limit reached".encode(
+                            "utf-8"
+                        )
+                    )
+                    self.truncated.append(path)
+        if not self._lines:
+            return ""
+        return (b"\n".join(self._lines) + b"\n").decode(
+            "utf-8", errors="replace"
+        )
+
+
+def read_diff(
+    stream: BinaryIO,
+    capture: DiffCapture,
+) -> None:
+    """Feeds the stream to the capture until it ends or the cap is reached
+
+    Args:
+        stream (BinaryIO): Stdout of `git diff`
+        capture (DiffCapture): Capture
+    """
+    while True:
+        chunk = stream.read(READ_CHUNK)
+        if not chunk or not capture.feed(chunk):
+            return
+
+
+def _state_commands(with_tree: bool) -> List[List[str]]:
+    commands = [["git", "status", "--porcelain=v2", "-z", "--branch"]]
+    if with_tree:
+        commands.append(["git", "write-tree"])
+    return commands
+
+
+def _diff_capture(max_diff_bytes: int) -> DiffCapture:
+    # One file may take a quarter of the cap, so a single regenerated
+    # fixture does not push every other file out
+    return DiffCapture(max_diff_bytes, max_diff_bytes // 4)
+
+
+def _plan_capture(
+    capture: DiffCapture, planned: Sequence[FileStat]
+) -> List[str]:
+    # Exclusion pathspecs for the diff command, or with too many files the
+    # capture drops their diffs itself
+    exclusions = planned_exclusions(planned)
+    if planned and not exclusions:
+        capture.skipped.update(file.path for file in planned)
+    return exclusions
+
+
+def capture_diff(
+    command: Sequence[str],
+    capture: DiffCapture,
+    cwd: Optional[str] = None,
+    meanwhile: Optional[Callable] = None,
+):
+    """Streams the output of a diff command into the capture and stops git
+    once the cap is reached
+
+    Args:
+        command (list[str]): Diff command
+        capture (DiffCapture): Capture
+        cwd (str, optional): Repository directory. Defaults to the current.
+        meanwhile (callable, optional): Run after git is started, e.g. other
+            git commands
+
+    Returns:
+        Result of `meanwhile`, None without it
+    """
+    result = None
+    with trace.span("git", "git diff", cwd=cwd or ".") as span:
+        process = subprocess.Popen(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            cwd=cwd,
+        )
+        try:
+            if meanwhile is not None:
+                result = meanwhile()
+            read_diff(process.stdout, capture)
+        finally:
+            if capture.full:
+                process.kill()
+            process.stdout.close()
+            process.wait()
+        span.attrs["bytes"] = capture.size
+    return result
+
+
+def read_staged_diff(
+    excluded_files: Sequence[str] = (),
+    cwd: Optional[str] = None,
+    max_diff_bytes: int = MAX_DIFF_BYTES,
+) -> str:
+    """Staged diff with the default encoding, capped like the one of
+    `collect_repo_state`
+
+    Args:
+        excluded_files (list[str], optional): Files to exclude from the diff
+        cwd (str, optional): Repository directory. Defaults to the current.
+        max_diff_bytes (int, optional): Cap of the diff in bytes, 0 for no
+            cap. Defaults to 8 MiB.
+
+    Returns:
+        str: Diff
+    """
+    capture = _diff_capture(max_diff_bytes)
+    capture_diff(staged_diff_command(excluded_files), capture, cwd)
+    return capture.result()
+
+
+def read_capped_diff(
+    stream: BinaryIO, max_diff_bytes: int = MAX_DIFF_BYTES
+) -> Tuple[str, List[str]]:
+    """Diff produced elsewhere, e.g. piped to stdin, read with the cap of
+    `collect_repo_state`. Reading stops once the cap is reached.
+
+    Args:
+        stream (BinaryIO): Diff
+        max_diff_bytes (int, optional): Cap of the diff in bytes, 0 for no
+            cap. Defaults to 8 MiB.
+
+    Returns:
+        tuple[str, list[str]]: Diff and the paths cut by the cap
+    """
+    capture = _diff_capture(max_diff_bytes)
+    read_diff(stream, capture)
+    return capture.result(), capture.truncated
+
+
+def _state_from_outputs(
+    outputs: List[str],
+    capture: DiffCapture,
+    excluded_files: Sequence[str],
+    with_tree: bool,
+    planned: Sequence[FileStat] = (),
+) -> RepoState:
+    state = parse_porcelain_v2(outputs[0])
+    stubbed = {file.path for file in planned}
+    state.diff = capture.result(
+        [
+            path
+            for path in state.blobs
+            if path not in stubbed
+            and not any(fnmatch.fnmatch(path, file) for file in excluded_files)
+        ]
+    ) + "".join(file.stub() for file in planned)
+    state.truncated = capture.truncated
+    if with_tree:
+        state.tree = outputs[1].strip()
+    return state
+
+
+def collect_repo_state(
+    excluded_files: Sequence[str] = (),
+    with_tree: bool = False,
+    cwd: Optional[str] = None,
+    max_diff_bytes: int = MAX_DIFF_BYTES,
+    diff_options: Optional[DiffOptions] = None,
+    plan: bool = False,
+) -> RepoState:
+    """Collects the repository state: one porcelain status pass, one staged
+    diff and optionally `git write-tree`, run concurrently. The diff is
+    read as a stream and git is stopped once `max_diff_bytes` are kept.
+
+    With `plan`, `git diff --numstat` runs instead of the diff in the first
+    pass, and binaries, lockfiles and generated files (see `diff_plan`) are
+    left out of the full diff and described by their stats.
+
+    Args:
+        excluded_files (list[str], optional): Files to exclude from the diff
+        with_tree (bool, optional): Also get the hash of the staged tree.
+            Defaults to False.
+        cwd (str, optional): Repository directory. Defaults to the current.
+        max_diff_bytes (int, optional): Cap of the diff in bytes, 0 for no
+            cap. Defaults to 8 MiB.
+        diff_options (DiffOptions, optional): Encoding of the diff
+        plan (bool, optional): Plan the diff by its numstat. Defaults to
+            False.
+
+    Returns:
+        RepoState: Repository state
+    """
+    planned: List[FileStat] = []
+    outputs = None
+    if plan:
+        numstat, *outputs = run_git_commands(
+            numstat_command(excluded_files),
+            *_state_commands(with_tree),
+            cwd=cwd,
+        )
+        stats = parse_numstat(numstat)
+        if stats:
+            attributes = run_git_input(
+                check_attr_command(),
+                check_attr_input([file.path for file in stats]),
+                cwd=cwd,
+            )
+            planned = stats_only(
+                stats, parse_check_attr(attributes), load_config(cwd)
+            )
+    capture = _diff_capture(max_diff_bytes)
+    exclusions = _plan_capture(capture, planned)
+
+    def status() -> List[str]:
+        # Runs while git writes the diff, unless the numstat pass ran it
+        if outputs is not None:
+            return outputs
+        return run_git_commands(*_state_commands(with_tree), cwd=cwd)
+
+    outputs = capture_diff(
+        staged_diff_command(excluded_files, diff_options, exclusions),
+        capture,
+        cwd,
+        meanwhile=status,
+    )
+    return _state_from_outputs(
+        outputs, capture, excluded_files, with_tree, planned
+    )
+
+
+async def run_git_commands_async(
+    *commands: Sequence[str],
+    cwd: Optional[str] = None,
+) -> List[str]:
+    """asyncio version of `run_git_commands`, for event loops that also
+    drive HTTP requests
+
+    Args:
+        *commands (list[str]): Commands
+        cwd (str, optional): Repository directory. Defaults to the current.
+
+    Returns:
+        list[str]: Stdout of every command, in the same order
+    """
+
+    async def run(command: Sequence[str]) -> str:
+        with trace.span("git", " ".join(command[:2]), cwd=cwd or "."):
+            process = await asyncio.create_subprocess_exec(
+                *command,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL,
+                cwd=cwd,
+            )
+            try:
+                stdout, _ = await process.communicate()
+            except asyncio.CancelledError:
+                process.kill()
+                raise
+        return stdout.decode("utf-8", errors="replace")
+
+    return list(await asyncio.gather(*(run(command) for command in commands)))
+
+
+async def run_git_input_async(
+    command: Sequence[str], data: str, cwd: Optional[str] = None
+) -> str:
+    """asyncio version of `run_git_input`"""
+    with trace.span("git", " ".join(command[:2]), cwd=cwd or "."):
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            cwd=cwd,
+        )
+        try:
+            stdout, _ = await process.communicate(data.encode("utf-8"))
+        except asyncio.CancelledError:
+            process.kill()
+            raise
+    return stdout.decode("utf-8", errors="replace")
+
+
+async def collect_repo_state_async(
+    excluded_files: Sequence[str] = (),
+    with_tree: bool = False,
+    cwd: Optional[str] = None,
+    max_diff_bytes: int = MAX_DIFF_BYTES,
+    diff_options: Optional[DiffOptions] = None,
+    plan: bool = False,
+) -> RepoState:
+    """asyncio version of `collect_repo_state`"""
+    capture = _diff_capture(max_diff_bytes)
+    planned: List[FileStat] = []
+
+    async def read() -> None:
+        if plan:
+            numstat = (
+                await run_git_commands_async(
+                    numstat_command(excluded_files), cwd=cwd
+                )
+            )[0]
+            stats = parse_numstat(numstat)
+            if stats:
+                attributes = await run_git_input_async(
+                    check_attr_command(),
+                    check_attr_input([file.path for file in stats]),
+                    cwd=cwd,
+                )
+                planned.extend(
+                    stats_only(
+                        stats, parse_check_attr(attributes), load_config(cwd)
+                    )
+                )
+        exclusions = _plan_capture(capture, planned)
+        with trace.span("git", "git diff", cwd=cwd or ".") as span:
+            process = await asyncio.create_subprocess_exec(
+                *staged_diff_command(excluded_files, diff_options, exclusions),
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL,
+                cwd=cwd,
+            )
+            try:
+                while True:
+                    chunk = await process.stdout.read(READ_CHUNK)
+                    if not chunk or not capture.feed(chunk):
+                        break
+            except asyncio.CancelledError:
+                process.kill()
+                raise
+            if capture.full:
+                process.kill()
+            await process.wait()
+            span.attrs["bytes"] = capture.size
+
+    outputs, _ = await asyncio.gather(
+        run_git_commands_async(*_state_commands(with_tree), cwd=cwd),
+        read(),
+    )
+    return _state_from_outputs(
+        outputs, capture, excluded_files, with_tree, planned
+    )
@@ -0,0 +1,358 @@
+# Hedged requests: a second backend races the first one when it is slower
+# than usual to answer, or takes over when it fails
+import copy
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+
+from . import trace
+from .backends import AsyncBackendMixin
+from .http_session import DeadlineExceeded
+from .response_cache import default_cache_dir
+
+# Hedge delay until enough latencies of the primary are known
+DEFAULT_HEDGE_AFTER = 10.0
+
+
+class LatencyHistory:
+    """Recent times to the first chunk of every backend and model, kept in
+    one JSON file between runs"""
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        max_samples: int = 50,
+        min_samples: int = 5,
+    ):
+        """Initialization
+
+        Args:
+            path (str, optional): History file. Defaults to
+                `default_cache_dir()/latency.json`.
+            max_samples (int, optional): Latencies kept per key. Defaults
+                to 50.
+            min_samples (int, optional): Latencies needed for a percentile.
+                Defaults to 5.
+        """
+        self.path = path or os.path.join(default_cache_dir(), "latency.json")
+        self.max_samples = max_samples
+        self.min_samples = min_samples
+        self._samples: Optional[Dict[str, List[float]]] = None
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict[str, List[float]]:
+        if self._samples is None:
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    self._samples = json.load(f)
+            except (OSError, ValueError):
+                self._samples = {}
+        return self._samples
+
+    def percentile(self, key: str, q: float = 0.9) -> Optional[float]:
+        """Latency that `q` of the recent requests did not exceed
+
+        Args:
+            key (str): Backend and model
+            q (float, optional): Fraction. Defaults to 0.9.
+
+        Returns:
+            float | None: Seconds, None while there are too few samples
+        """
+        with self._lock:
+            samples = sorted(self._load().get(key, []))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(int(len(samples) * q), len(samples) - 1)]
+
+    def add(self, key: str, seconds: float) -> None:
+        """Remembers a latency and writes the history
+
+        Args:
+            key (str): Backend and model
+            seconds (float): Time to the first chunk
+        """
+        with self._lock:
+            samples = self._load().setdefault(key, [])
+            samples.append(round(seconds, 3))
+            del samples[: -self.max_samples]
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                fd, tmp = tempfile.mkstemp(
+                    dir=os.path.dirname(self.path), suffix=".tmp"
+                )
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump(self._samples, f)
+                os.replace(tmp, self.path)
+            except OSError:
+                # Only the hedge delay depends on it
+                pass
+
+
+def latency_key(client) -> str:
+    """Key of the client in `LatencyHistory`"""
+    return f"{type(client).__name__}:{client.model}"
+
+
+class HedgedBackend(AsyncBackendMixin):
+    """Streams from the primary backend and, if it has produced nothing
+    within the hedge delay, from the secondary one too, keeping whichever
+    answers first. A primary that fails without answering is replaced by the
+    secondary right away.
+
+    The hedge delay is `hedge_after` or, by default, a percentile of the
+    recent latencies of the primary."""
+
+    def __init__(
+        self,
+        primary,
+        secondary,
+        hedge_after: Optional[float] = None,
+        deadline: Optional[float] = None,
+        history: Optional[LatencyHistory] = None,
+        percentile: float = 0.9,
+    ):
+        """Initialization
+
+        Args:
+            primary (Backend): Backend asked first
+            secondary (Backend): Backend for hedging and fallback
+            hedge_after (float, optional): Fixed hedge delay in seconds.
+                Defaults to the learned one.
+            deadline (float, optional): Seconds for the whole answer
+            history (LatencyHistory, optional): Latencies of the primary.
+                Defaults to `LatencyHistory()`.
+            percentile (float, optional): Percentile of the latencies used
+                as the delay. Defaults to 0.9.
+        """
+        self.primary = primary
+        self.secondary = secondary
+        self.hedge_after = hedge_after
+        self.deadline = deadline
+        self.history = history or LatencyHistory()
+        self.percentile = percentile
+        self.hedged = 0
+        self._error: Optional[str] = None
+        self._winner = None
+
+    def __copy__(self) -> "HedgedBackend":
+        # Copies of both backends: results of a call (`usage`, `last_error`)
+        # are kept on the clients. Sessions and the history stay shared.
+        return HedgedBackend(
+            copy.copy(self.primary),
+            copy.copy(self.secondary),
+            hedge_after=self.hedge_after,
+            deadline=self.deadline,
+            history=self.history,
+            percentile=self.percentile,
+        )
+
+    @property
+    def model(self) -> Optional[str]:
+        return self.primary.model
+
+    @property
+    def quiet(self) -> bool:
+        return self.primary.quiet
+
+    @quiet.setter
+    def quiet(self, value: bool) -> None:
+        self.primary.quiet = self.secondary.quiet = value
+
+    @property
+    def last_error(self) -> Optional[str]:
+        """Expired deadline, else error of the secondary if it failed too,
+        else of the primary"""
+        return (
+            self._error
+            or self.secondary.last_error
+            or self.primary.last_error
+        )
+
+    @property
+    def usage(self) -> Optional[Dict[str, int]]:
+        """Reported usage of the backend that answered"""
+        return getattr(self._winner, "usage", None)
+
+    def delay(self) -> float:
+        """Seconds to wait for the primary before hedging"""
+        if self.hedge_after is not None:
+            return self.hedge_after
+        learned = self.history.percentile(
+            latency_key(self.primary), self.percentile
+        )
+        return DEFAULT_HEDGE_AFTER if learned is None else learned
+
+    def input_budget(self) -> Optional[int]:
+        """Prompt tokens that fit the context of both backends"""
+        budgets = [
+            client.input_budget()
+            for client in (self.primary, self.secondary)
+            if hasattr(client, "input_budget")
+        ]
+        budgets = [budget for budget in budgets if budget is not None]
+        return min(budgets) if budgets else None
+
+    def connection_stats(self) -> Dict[str, int]:
+        stats = dict(self.primary.connection_stats())
+        for key, value in self.secondary.connection_stats().items():
+            stats[key] = stats.get(key, 0) + value
+        return stats
+
+    def close(self) -> None:
+        self.primary.close()
+        self.secondary.close()
+
+    def message(
+        self,
+        messages: List[Dict[str, str]],
+        timeout: Optional[int],
+        temperature: float,
+        max_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+    ) -> Optional[str]:
+        """Whole answer of the faster backend
+
+        Returns:
+            str | None: Answer, None if both backends failed or the deadline
+                expired
+        """
+        try:
+            answer = "".join(
+                self.stream(messages, timeout, temperature, max_tokens, stop)
+            )
+        except DeadlineExceeded:
+            return None
+        return answer.strip() or None
+
+    def stream(
+        self,
+        messages: List[Dict[str, str]],
+        timeout: Optional[int],
+        temperature: float,
+        max_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+    ) -> Iterator[str]:
+        """Streams the answer of the backend that produces a chunk first
+
+        Args:
+            messages (list[dict[str]]): Messages
+            timeout (int | None): Timeout of one request
+            temperature (float): Model temperature
+            max_tokens (int, optional): Cap of the answer
+            stop (list[str], optional): Stop sequences
+
+        Yields:
+            str: Chunks of the answer
+
+        Raises:
+            DeadlineExceeded: The deadline expired, also after some chunks
+                were yielded
+        """
+        self._error = None
+        self._winner = None
+        chunks: "queue.Queue" = queue.Queue()
+        cancelled = {
+            id(self.primary): threading.Event(),
+            id(self.secondary): threading.Event(),
+        }
+        end = object()
+
+        def produce(client) -> None:
+            answer = client.stream(
+                messages=messages,
+                timeout=timeout,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stop=stop,
+            )
+            try:
+                for chunk in answer:
+                    if cancelled[id(client)].is_set():
+                        break
+                    chunks.put((client, chunk))
+            except DeadlineExceeded as e:
+                # The backend ran out of the same deadline mid-answer
+                chunks.put((client, e))
+            finally:
+                answer.close()
+                chunks.put((client, end))
+
+        def start(client) -> None:
+            thread = threading.Thread(
+                target=produce, args=(client,), daemon=True
+            )
+            thread.start()
+
+        started = time.monotonic()
+        expires = started + self.deadline if self.deadline else None
+        hedge_at = started + self.delay()
+        start(self.primary)
+        running = {id(self.primary)}
+        finished = set()
+        winner = None
+        try:
+            while True:
+                now = time.monotonic()
+                waits = [expires - now] if expires else []
+                if winner is None and len(running) == 1:
+                    waits.append(hedge_at - now)
+                wait = max(min(waits), 0) if waits else None
+                if expires and now >= expires:
+                    self._error = f"Deadline of {self.deadline}s exceeded"
+                    raise DeadlineExceeded(self._error)
+                try:
+                    client, chunk = chunks.get(timeout=wait)
+                except queue.Empty:
+                    if winner is None and len(running) == 1:
+                        self._hedge(start, running, "slow")
+                    continue
+                if isinstance(chunk, DeadlineExceeded):
+                    if client is winner:
+                        self._error = str(chunk)
+                        raise DeadlineExceeded(self._error)
+                    continue
+                if chunk is end:
+                    finished.add(id(client))
+                    if client is winner or (
+                        len(running) == 2 and finished == running
+                    ):
+                        return
+                    if winner is None and len(running) == 1:
+                        # The primary failed before answering
+                        self._hedge(start, running, "failed")
+                    continue
+                if winner is None:
+                    winner = self._winner = client
+                    for other in (self.primary, self.secondary):
+                        if other is not client:
+                            cancelled[id(other)].set()
+                    # First chunks of the primary are latencies. When the
+                    # secondary won, the primary is cancelled still waiting:
+                    # its latency is at least the time so far. Leaving such
+                    # hedged requests out would lower the learned delay
+                    # with every slow run
+                    if client is self.primary or (
+                        id(self.primary) not in finished
+                    ):
+                        self.history.add(
+                            latency_key(self.primary),
+                            time.monotonic() - started,
+                        )
+                if client is winner:
+                    yield chunk
+        finally:
+            for event in cancelled.values():
+                event.set()
+
+    def _hedge(self, start, running: set, reason: str) -> None:
+        self.hedged += 1
+        with trace.span(
+            "hedge", latency_key(self.secondary), reason=reason
+        ):
+            start(self.secondary)
+        running.add(id(self.secondary))
@@ -0,0 +1,247 @@
+# Pooled keep-alive HTTP sessions for AI clients
+import email.utils
+import random
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+import requests
+import requests.adapters
+import urllib3.connection
+import urllib3.connectionpool
+
+from . import trace
+
+
+class _TimedHTTPConnection(urllib3.connection.HTTPConnection):
+    def connect(self):
+        with trace.span("http", f"connect {self.host}:{self.port}"):
+            super().connect()
+
+
+class _TimedHTTPSConnection(urllib3.connection.HTTPSConnection):
+    def connect(self):
+        # Includes the TLS handshake
+        with trace.span("http", f"connect {self.host}:{self.port}"):
+            super().connect()
+
+
+class _TimedHTTPConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(urllib3.connectionpool.HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+def make_session(pool_size: int = 4) -> requests.Session:
+    """Creates session that keeps connections alive and reuses them
+
+    Args:
+        pool_size (int, optional): Maximum number of kept-alive connections
+            per host. Defaults to 4.
+
+    Returns:
+        requests.Session: Session
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+    )
+    # New connections show up as `connect` spans in --trace
+    adapter.poolmanager.pool_classes_by_scheme = {
+        "http": _TimedHTTPConnectionPool,
+        "https": _TimedHTTPSConnectionPool,
+    }
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# Statuses worth another attempt: rate limited or a server-side failure
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class DeadlineExceeded(TimeoutError):
+    """--deadline ran out before the answer was complete. A partial answer
+    is not a message."""
+
+
+@dataclass
+class RetryPolicy:
+    """How failed requests are retried"""
+
+    # Attempts in total, 1 disables retries
+    attempts: int = 3
+    # Upper bound of the first backoff, doubled on every attempt
+    backoff: float = 0.5
+    max_backoff: float = 8.0
+    # Seconds for all attempts and the streamed answer together, None for
+    # no limit
+    deadline: Optional[float] = None
+
+    def check_deadline(self, started: float) -> None:
+        """Fails a streamed answer that is still coming when the deadline
+        has passed. Checked between chunks, so a stalled read is bounded by
+        the timeout of its attempt instead.
+
+        Args:
+            started (float): `time.monotonic()` before the first attempt
+
+        Raises:
+            DeadlineExceeded: The deadline has passed
+        """
+        if (
+            self.deadline is not None
+            and time.monotonic() - started >= self.deadline
+        ):
+            raise DeadlineExceeded(f"Deadline of {self.deadline}s exceeded")
+
+    def delay(self, attempt: int) -> float:
+        """Backoff before the next attempt, with full jitter so that
+        clients failing together do not retry together
+
+        Args:
+            attempt (int): Failed attempts so far, from 1
+
+        Returns:
+            float: Seconds
+        """
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        )
+
+
+def retry_after(response: requests.Response) -> Optional[float]:
+    """Delay asked for by the `Retry-After` header
+
+    Args:
+        response (requests.Response): Response
+
+    Returns:
+        float | None: Seconds, None if the header is missing or invalid
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(date.timestamp() - time.time(), 0.0)
+
+
+def post_with_retries(
+    session: requests.Session,
+    url: str,
+    retry: RetryPolicy,
+    timeout: Optional[float] = None,
+    **kwargs,
+) -> requests.Response:
+    """POST that is repeated on connection errors, timeouts and
+    `RETRY_STATUSES`, honouring `Retry-After` and the deadline of the policy
+
+    Args:
+        session (requests.Session): Session
+        url (str): URL
+        retry (RetryPolicy): Retry policy
+        timeout (float, optional): Timeout of one attempt
+        **kwargs: Arguments of `requests.Session.post`
+
+    Returns:
+        requests.Response: Last response, possibly an error one
+
+    Raises:
+        requests.exceptions.RequestException: The last attempt failed
+            without a response
+    """
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        attempt_timeout = timeout
+        if retry.deadline is not None:
+            remaining = retry.deadline - (time.monotonic() - started)
+            if remaining <= 0:
+                raise requests.exceptions.Timeout(
+                    f"Deadline of {retry.deadline}s exceeded"
+                )
+            attempt_timeout = min(timeout or remaining, remaining)
+        attempt += 1
+        response = None
+        try:
+            response = session.post(url, timeout=attempt_timeout, **kwargs)
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+        ):
+            if attempt >= retry.attempts:
+                raise
+        else:
+            if (
+                response.status_code not in RETRY_STATUSES
+                or attempt >= retry.attempts
+            ):
+                return response
+        wait = retry_after(response) if response is not None else None
+        if wait is None:
+            wait = retry.delay(attempt)
+        if (
+            retry.deadline is not None
+            and time.monotonic() - started + wait >= retry.deadline
+        ):
+            # No time for another attempt
+            if response is not None:
+                return response
+            raise requests.exceptions.Timeout(
+                f"Deadline of {retry.deadline}s exceeded"
+            )
+        if response is not None:
+            response.close()
+        with trace.span(
+            "retry",
+            url,
+            attempt=attempt,
+            status=response.status_code if response is not None else None,
+        ):
+            time.sleep(wait)
+
+
+def response_span(span: trace.Span, response: requests.Response) -> None:
+    """Adds status and time to the first byte of the response to the span
+
+    Args:
+        span (trace.Span): Span of the request
+        response (requests.Response): Response, possibly still streaming
+    """
+    span.attrs["status"] = response.status_code
+    span.attrs["first_byte"] = response.elapsed.total_seconds()
+
+
+def connection_stats(session: requests.Session) -> Dict[str, int]:
+    """Counts requests made through the session and connections opened for
+    them. Every request above the number of opened connections went over a
+    reused connection.
+
+    Args:
+        session (requests.Session): Session created by `make_session`
+
+    Returns:
+        dict[str, int]: `requests`, `connections` and `reused` counters
+    """
+    stats = {"requests": 0, "connections": 0}
+    adapters = {id(adapter): adapter for adapter in session.adapters.values()}
+    for adapter in adapters.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats["requests"] += pool.num_requests
+            stats["connections"] += pool.num_connections
+    stats["reused"] = max(stats["requests"] - stats["connections"], 0)
+    return stats
@@ -1,42 +1,227 @@
 # CLI utility that generates commit messages using AI.
+# Rich, requests and the AI clients are imported only on the code paths that
+# need them, so `--version` and `--help` start fast (git hooks call us a lot).
 import argparse
-import importlib
 import os
 import subprocess
-
-import requests
-import rich.console
+import sys
 
 from .colored import colored
-from .custom_int_prompt import CustomIntPrompt
 # from .cut_think_part import cut_think
-from .mistral import MistralAI
-from .ollama import Ollama
-from .rich_custom_formatter import CustomFormatter
+
+
+class LazyObject:
+    """Proxy that creates the wrapped object on first attribute access"""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._object = None
+
+    def __getattr__(self, name):
+        if self._object is None:
+            self._object = self._factory()
+        return getattr(self._object, name)
+
+
+def _make_console():
+    import rich.console
+
+    return rich.console.Console()
+
+
+def _make_prompt():
+    from .custom_int_prompt import CustomIntPrompt
+
+    return CustomIntPrompt()
+
+
+def _make_help_formatter(prog: str) -> argparse.HelpFormatter:
+    from .rich_custom_formatter import CustomFormatter
+
+    return CustomFormatter(prog)
+
+
+class VersionAction(argparse.Action):
+    """`--version` that resolves the package version only when called"""
+
+    def __init__(self, option_strings, dest=argparse.SUPPRESS, **kwargs):
+        super().__init__(option_strings, dest=dest, nargs=0, **kwargs)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        from importlib.metadata import version
+
+        sys.stdout.write(f"{parser.prog} {version('commit-maker')}\n")
+        parser.exit()
+
 
 # Constants
 mistral_api_key = os.environ.get("MISTRAL_API_KEY")
-console = rich.console.Console()
-prompt = CustomIntPrompt()
+console = LazyObject(_make_console)
+prompt = LazyObject(_make_prompt)
 available_langs = ["en", "ru"]
 
-# Argument parser
+
+def backend_spec(value: str) -> str:
+    """Validates a `BACKEND[:MODEL]` option value"""
+    name, _, model = value.partition(":")
+    if name not in ("mistral", "ollama"):
+        raise argparse.ArgumentTypeError(
+            f"unknown backend {name!r}, use mistral or ollama"
+        )
+    if name == "ollama" and not model:
+        raise argparse.ArgumentTypeError("use ollama:MODEL")
+    return value
+
+
+def add_common_arguments(parser: argparse.ArgumentParser):
+    """Adds options shared by all commands
+
+    Args:
+        parser (argparse.ArgumentParser): Parser of the command
+
+    Returns:
+        tuple: "General parameters" and "Generation parameters" groups, for
+            the options of the command itself
+    """
+    # General parameters
+    general_params = parser.add_argument_group("General parameters")
+    general_params.add_argument(
+        "-l",
+        "--local-models",
+        action="store_true",
+        default=False,
+        help="Use local models",
+    )
+    general_params.add_argument(
+        "-o",
+        "--timeout",
+        type=int,
+        default=None,
+        help="Change timeout for models. Default is None.",
+    )
+    general_params.add_argument(
+        "--retries",
+        type=int,
+        default=2,
+        help="Retries of a model request on 429/5xx and network errors, "
+             "with jittered backoff and Retry-After. Default: 2",
+    )
+    general_params.add_argument(
+        "--deadline",
+        type=float,
+        default=None,
+        help="Seconds for a model answer including retries and hedging. "
+             "Default: no limit",
+    )
+    general_params.add_argument(
+        "--fallback",
+        type=backend_spec,
+        default=None,
+        metavar="BACKEND[:MODEL]",
+        help="Second backend (e.g. ollama:qwen2.5:7b or "
+             "mistral:mistral-small-latest) that takes over when the main "
+             "one fails and races it when it is slower than usual",
+    )
+    general_params.add_argument(
+        "--hedge-after",
+        type=float,
+        default=None,
+        help="Seconds to wait for the first token of the main backend "
+             "before asking --fallback too. Default: p90 of recent requests",
+    )
+    general_params.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        default=False,
+        help="Show HTTP connection reuse after each generation",
+    )
+    general_params.add_argument(
+        "--trace",
+        metavar="FILE",
+        default=None,
+        help="Write timings of git calls, the server probe and model "
+             "requests (with token counts) to FILE as JSON",
+    )
+    general_params.add_argument(
+        "--profile",
+        action="store_true",
+        default=False,
+        help="Print a summary table of timings and tokens/sec at the end",
+    )
+
+    # Generation parameters
+    generation_params = parser.add_argument_group("Generation parameters")
+    generation_params.add_argument(
+        "-t",
+        "--temperature",
+        default=1.0,
+        type=float,
+        help="Model temperature for message generation. "
+             "Range: [0.0, 1.5]. Default: 1.0",
+    )
+    generation_params.add_argument(
+        "-m",
+        "--max-symbols",
+        type=int,
+        default=200,
+        help="Maximum commit message length. Default: 200",
+    )
+    generation_params.add_argument(
+        "-M",
+        "--model",
+        type=str,
+        help="Model to be used by ollama",
+    )
+    generation_params.add_argument(
+        "-e",
+        "--exclude",
+        nargs="+",
+        default=[],
+        help="Files to exclude when generating commit message",
+    )
+    generation_params.add_argument(
+        "-w",
+        "--wish",
+        default=None,
+        type=str,
+        help="Custom wishes/edits for the commit message",
+    )
+    generation_params.add_argument(
+        "--max-input-tokens",
+        type=int,
+        default=16000,
+        help="Token budget for git status and git diff sent to the model. "
+             "Larger diffs are packed: source files and signatures first, "
+             "stats for the rest. 0 disables packing. Default: 16000",
+    )
+    generation_params.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="Maximum simultaneous requests to the model. Default: 4",
+    )
+    generation_params.add_argument(
+        "-L",
+        "--language",
+        choices=available_langs,
+        default="ru",
+        help="Language of generated commit message (en/ru)",
+    )
+    return general_params, generation_params
+
+
+# Argument parser. The plain formatter is used while arguments are added
+# (argparse instantiates it for every argument), the rich one is set below.
 parser = argparse.ArgumentParser(
     prog="commit_maker",
     description="CLI utility that generates commit messages using AI. "
-    "Supports local models/Mistral AI API. Local models use ollama.",
-    formatter_class=CustomFormatter,
-)
-
-# General parameters
-general_params = parser.add_argument_group("General parameters")
-general_params.add_argument(
-    "-l",
-    "--local-models",
-    action="store_true",
-    default=False,
-    help="Use local models",
+    "Supports local models/Mistral AI API. Local models use ollama. "
+    "Run `commit_maker reword --help` to regenerate messages of existing "
+    "commits and `commit_maker daemon --help` to keep a warm background "
+    "process.",
 )
+general_params, generation_params = add_common_arguments(parser)
 general_params.add_argument(
     "-d",
     "--dry-run",
@@ -47,69 +232,963 @@ general_params.add_argument(
 general_params.add_argument(
     "-V",
     "--version",
-    action="version",
-    version=f"%(prog)s {importlib.metadata.version('commit-maker')}",
+    action=VersionAction,
+    help="show program's version number and exit",
 )
 general_params.add_argument(
-    "-o",
-    "--timeout",
-    type=int,
+    "--no-cache",
+    action="store_true",
+    default=False,
+    help="Do not reuse or save generated messages in the local cache",
+)
+general_params.add_argument(
+    "--no-stream",
+    action="store_true",
+    default=False,
+    help="Wait for the whole message instead of showing it as it is "
+         "generated",
+)
+general_params.add_argument(
+    "--json",
+    action="store_true",
+    default=False,
+    help="Non-interactive: print the message, model, timings and token "
+         "counts as JSON instead of asking to commit",
+)
+general_params.add_argument(
+    "--stdin",
+    action="store_true",
+    default=False,
+    help="Non-interactive: generate the message for a diff read from "
+         "stdin, e.g. `git diff main | commit_maker --stdin --json`",
+)
+general_params.add_argument(
+    "--workspace",
+    metavar="DIR",
     default=None,
-    help="Change timeout for models. Default is None.",
+    help="Sweep mode: generate messages for every repository with staged "
+         "changes in DIR and its immediate subdirectories and commit them "
+         "in one batch",
 )
-
-# Generation parameters
-generation_params = parser.add_argument_group("Generation parameters")
-generation_params.add_argument(
-    "-t",
-    "--temperature",
-    default=1.0,
+general_params.add_argument(
+    "--repos",
+    nargs="+",
+    metavar="DIR",
+    default=None,
+    help="Sweep mode for the given repositories",
+)
+general_params.add_argument(
+    "--rate-limit",
     type=float,
-    help="Model temperature for message generation. "
-         "Range: [0.0, 1.5]. Default: 1.0",
+    default=1.0,
+    help="Maximum requests per second in sweep mode, 0 for no limit. "
+         "Default: 1.0",
 )
 generation_params.add_argument(
-    "-m",
-    "--max-symbols",
+    "-c",
+    "--candidates",
     type=int,
-    default=200,
-    help="Maximum commit message length. Default: 200",
+    default=1,
+    help="Generate this many messages concurrently and pick one by number. "
+         "More are prepared in the background while you read. Default: 1",
 )
 generation_params.add_argument(
-    "-M",
-    "--model",
-    type=str,
-    help="Model to be used by ollama",
+    "--max-diff-bytes",
+    type=int,
+    default=8 * 1024 * 1024,
+    help="Stop reading the staged diff after this many bytes; larger "
+         "files are cut and listed as truncated. 0 for no limit. "
+         "Default: 8 MiB",
 )
 generation_params.add_argument(
-    "-e",
-    "--exclude",
-    nargs="+",
-    default=[],
-    help="Files to exclude when generating commit message",
+    "--compact",
+    action="store_true",
+    default=False,
+    help="Compact prompt encoding: short status, 1 line of diff context, "
+         "rename and copy detection, no blob ids and ---/+++ lines",
+)
+generation_params.add_argument(
+    "-U",
+    "--unified",
+    type=int,
+    default=None,
+    metavar="N",
+    help="Lines of diff context. Default: 3, 1 with --compact",
+)
+generation_params.add_argument(
+    "--ignore-whitespace",
+    action="store_true",
+    default=False,
+    help="Leave whitespace-only changes out of the diff",
 )
 generation_params.add_argument(
-    "-w",
-    "--wish",
+    "--full-diff",
+    action="store_true",
+    default=False,
+    help="Send full diffs of binaries, lockfiles and generated files too. "
+         "By default they are found by `git diff --numstat`, built-in "
+         "patterns, .gitattributes (linguist-generated, -diff) and "
+         ".commit_maker.json and described by their stats",
+)
+generation_params.add_argument(
+    "--token-report",
+    action="store_true",
+    default=False,
+    help="Print estimated tokens of the status and diff against the "
+         "default encoding",
+)
+generation_params.add_argument(
+    "--split",
+    choices=["file", "dir"],
     default=None,
-    type=str,
-    help="Custom wishes/edits for the commit message",
+    help="For large change sets: summarize the diff per file or per "
+         "directory concurrently, then write the message from the summaries",
 )
 generation_params.add_argument(
-    "-L",
-    "--language",
-    choices=available_langs,
-    default="ru",
-    help="Language of generated commit message (en/ru)",
+    "--chunk-timeout",
+    type=int,
+    default=60,
+    help="Timeout for summarizing one chunk with --split. Default: 60",
+)
+parser.formatter_class = _make_help_formatter
+
+# Parser of `commit_maker reword`
+reword_parser = argparse.ArgumentParser(
+    prog="commit_maker reword",
+    description="Regenerates messages of existing commits. Commits must "
+    "end at HEAD, e.g. `main..HEAD` or `HEAD~20..HEAD`.",
+)
+reword_parser.add_argument(
+    "range",
+    help="Range of commits to reword",
 )
+reword_general_params, _ = add_common_arguments(reword_parser)
+reword_general_params.add_argument(
+    "-d",
+    "--dry-run",
+    action="store_true",
+    default=False,
+    help="Do not rewrite history, only write the old -> new mapping file",
+)
+reword_general_params.add_argument(
+    "--mapping",
+    default="reword-mapping.json",
+    help="Mapping file written with --dry-run. "
+         "Default: reword-mapping.json",
+)
+reword_parser.formatter_class = _make_help_formatter
+
+# Parser of `commit_maker daemon`
+daemon_parser = argparse.ArgumentParser(
+    prog="commit_maker daemon",
+    allow_abbrev=False,
+    description="Keeps model connections, the Ollama model list and caches "
+    "warm and serves `commit_maker` calls over a Unix socket. While it "
+    "runs, `commit_maker` hands generation off to it. Set "
+    "COMMIT_MAKER_NO_DAEMON=1 to bypass it. Options after --watch that the "
+    "daemon does not know (e.g. `-l -M qwen2.5:12b`) are the `commit_maker` "
+    "options messages are pre-generated with.",
+)
+daemon_parser.add_argument(
+    "--socket",
+    default=None,
+    help="Socket path. Default: $COMMIT_MAKER_SOCKET, "
+         "$XDG_RUNTIME_DIR/commit_maker.sock or the cache directory",
+)
+daemon_parser.add_argument(
+    "--idle-timeout",
+    type=float,
+    default=3600,
+    help="Exit after this many seconds without requests, 0 to run until "
+         "stopped. Default: 3600",
+)
+daemon_parser.add_argument(
+    "--watch",
+    action="append",
+    default=[],
+    metavar="REPO",
+    help="Pre-generate a message whenever the index of the repository "
+         "settles, so the next `commit_maker` run with the same options "
+         "finds it ready. Can be repeated",
+)
+daemon_parser.add_argument(
+    "--stop",
+    action="store_true",
+    default=False,
+    help="Stop the running daemon",
+)
+daemon_parser.formatter_class = _make_help_formatter
+
+
+def generate_commit_message(
+    client,
+    messages: list,
+    temperature: float,
+    timeout,
+    stream: bool = True,
+    max_symbols: int = 0,
+) -> str:
+    """Generates commit message, rendering tokens as they arrive. The answer
+    is capped and trimmed to `max_symbols`.
+
+    Args:
+        client (Backend): AI client
+        messages (list): Messages for the model
+        temperature (float): Model temperature
+        timeout (int | None): Timeout for the model
+        stream (bool, optional): Render tokens live instead of showing a
+            spinner. Defaults to True.
+        max_symbols (int, optional): --max-symbols, 0 for no limit
+
+    Returns:
+        str | None: Commit message, None if nothing was generated
+    """
+    from . import trace
+    from .generation import count_trim, finish_message, output_limits
+    from .hedging import DeadlineExceeded
+    from .rate_limit import QUEUE_NOTICE
+
+    limits = output_limits(max_symbols)
+    with trace.span("phase", "generate") as span:
+        if not stream:
+            with console.status(
+                "[magenta bold]Generating commit message...",
+                spinner_style="magenta",
+            ):
+                answer = client.message(
+                    messages=messages,
+                    temperature=temperature,
+                    timeout=timeout,
+                    **limits,
+                )
+        else:
+            console.print(
+                "[magenta bold]Generating commit message:[/magenta bold] ",
+                end="",
+            )
+            chunks = []
+            try:
+                for chunk in client.stream(
+                    messages=messages,
+                    temperature=temperature,
+                    timeout=timeout,
+                    **limits,
+                ):
+                    chunks.append(chunk)
+                    console.print(
+                        chunk,
+                        end="",
+                        style="yellow",
+                        markup=False,
+                        highlight=False,
+                    )
+            except DeadlineExceeded:
+                chunks = None
+            finally:
+                console.print()
+            if chunks is None:
+                # The answer was cut, it is not offered for commit
+                console.print(f"[red]{client.last_error}[/red]")
+                return None
+            answer = "".join(chunks)
+        message, trimmed = finish_message(answer, max_symbols)
+        span.attrs["trimmed"] = trimmed
+    # Only clients with a shared quota (MISTRAL_RATE_LIMIT) wait for it
+    queued = getattr(client, "queue_time", 0.0)
+    if queued >= QUEUE_NOTICE:
+        console.print(
+            f"[dim]Waited {queued:.1f}s in the rate limit queue[/dim]",
+            highlight=False,
+        )
+    if message:
+        stats = count_trim(trimmed)
+        if trimmed:
+            console.print(
+                f"[dim]Trimmed to {len(message)} of {max_symbols} symbols "
+                f"({stats['trimmed']} of {stats['generated']} messages so "
+                "far)[/dim]",
+                highlight=False,
+            )
+    elif trimmed:
+        console.print(
+            f"[dim]Trimmed to {len(message)} of {max_symbols} symbols[/dim]",
+            highlight=False,
+        )
+    return message
+
+
+def cached_commit_message(cache, cache_key: str):
+    """Shows the latest cached message for the key
+
+    Args:
+        cache (ResponseCache): Response cache
+        cache_key (str): Key of the staged tree and generation parameters
+
+    Returns:
+        str | None: Cached commit message
+    """
+    candidates = cache.get(cache_key)
+    if not candidates:
+        return None
+    console.print(
+        "[magenta bold]Cached commit message:[/magenta bold] ",
+        end="",
+    )
+    console.print(candidates[-1], style="yellow", highlight=False)
+    return candidates[-1]
+
+
+def pick_candidate(pool, size: int, dry_run: bool, on_new=None):
+    """Shows candidates as they are generated and lets the user pick one
+
+    Args:
+        pool (CandidatePool): Pool with requested candidates
+        size (int): Number of candidates to keep generating
+        dry_run (bool): Only show the first `size` candidates
+        on_new (callable, optional): Called with every batch of new
+            candidates
+
+    Returns:
+        str | None: Chosen commit message
+    """
+    wait_for = size if dry_run else (0 if pool.messages else 1)
+    shown = 0
+    while True:
+        with console.status(
+            "[magenta bold]Generating commit messages...",
+            spinner_style="magenta",
+        ):
+            new = pool.collect(wait_for=wait_for)
+        if on_new and new:
+            on_new(new)
+        if not pool.messages:
+            console.print(
+                "[red]Failed to generate commit message![/red]",
+                highlight=False,
+            )
+            return None
+        for i, message in enumerate(pool.messages[shown:], shown + 1):
+            console.print(
+                f"[magenta]{i}.[/magenta] [yellow]{message}[/yellow]",
+                highlight=False,
+            )
+        shown = len(pool.messages)
+        if dry_run:
+            return None
+        choice = input(
+            f"Commit with message [1-{shown}], "
+            + colored("r", "yellow")
+            + " to regenerate, N to cancel: "
+        )
+        if choice == "r":
+            # Replace what was consumed, the rest is still in flight
+            pool.request(size - pool.in_flight)
+            wait_for = 1
+            continue
+        if choice.isdigit() and 1 <= int(choice) <= shown:
+            return pool.messages[int(choice) - 1]
+        return None
+
+
+def print_connection_stats(client) -> None:
+    """Prints how many requests went over reused connections
+
+    Args:
+        client (Backend): AI client
+    """
+    stats = client.connection_stats()
+    console.print(
+        f"HTTP: {stats['requests']} requests, "
+        f"{stats['connections']} connections opened, "
+        f"{stats['reused']} reused",
+        style="dim",
+        highlight=False,
+    )
+
+
+def print_trace_summary(tracer) -> None:
+    """Prints timings grouped by operation and throughput of every model
+    request
+
+    Args:
+        tracer (trace.Tracer): Finished trace
+    """
+    from rich.table import Table
+
+    table = Table(title="Timings", title_justify="left")
+    table.add_column("Kind")
+    table.add_column("Operation")
+    for column in ("Count", "Total, s", "Max, s"):
+        table.add_column(column, justify="right")
+    for group in tracer.summary():
+        table.add_row(
+            group["kind"],
+            group["name"],
+            str(group["count"]),
+            f"{group['total']:.3f}",
+            f"{group['max']:.3f}",
+        )
+    console.print(table)
+
+    model_requests = [
+        span
+        for span in sorted(tracer.spans, key=lambda span: span.start)
+        if span.kind == "http" and "first_byte" in span.attrs
+    ]
+    if not model_requests:
+        return None
+    table = Table(title="Model requests", title_justify="left")
+    table.add_column("Request")
+    table.add_column("Model")
+    for column in ("TTFB, s", "Total, s", "Load, s", "In", "Out", "tok/s"):
+        table.add_column(column, justify="right")
+    for span in model_requests:
+        attrs = span.attrs
+        load = attrs.get("load_duration")
+        prompt_tokens = attrs.get(
+            "prompt_eval_count", attrs.get("prompt_tokens")
+        )
+        output_tokens = attrs.get("eval_count", attrs.get("completion_tokens"))
+        speed = span.tokens_per_second
+        table.add_row(
+            span.name,
+            str(attrs.get("model") or ""),
+            f"{attrs['first_byte']:.3f}",
+            f"{span.duration:.3f}",
+            f"{load / 1e9:.3f}" if load is not None else "",
+            str(prompt_tokens) if prompt_tokens is not None else "",
+            str(output_tokens) if output_tokens is not None else "",
+            f"{speed:.1f}" if speed is not None else "",
+        )
+    console.print(table)
+
+
+def run_traced(command, parsed_args) -> None:
+    """Runs the command, recording a trace with --trace/--profile
+
+    Args:
+        command (callable): Command taking the parsed arguments
+        parsed_args (argparse.Namespace): Parsed arguments
+    """
+    if not (parsed_args.trace or parsed_args.profile):
+        return command(parsed_args)
+
+    from . import trace
+
+    tracer = trace.enable()
+    try:
+        with trace.span("phase", "total"):
+            return command(parsed_args)
+    finally:
+        trace.disable()
+        if parsed_args.trace:
+            tracer.save(parsed_args.trace)
+            console.print(
+                f"Trace written to [yellow]{parsed_args.trace}[/yellow]",
+                highlight=False,
+            )
+        if parsed_args.profile:
+            print_trace_summary(tracer)
+
+
+def make_client(parsed_args):
+    """Creates AI client for non-interactive commands. A local model must be
+    given with --model unless only one is installed.
+
+    Args:
+        parsed_args (argparse.Namespace): Parsed common arguments
+
+    Returns:
+        Backend | None: Client, None if it cannot be created
+    """
+    from .backends import get_backend
+    from .generation import resilient_client
+
+    model = parsed_args.model
+    pool_size = max(4, parsed_args.concurrency)
+    if parsed_args.local_models:
+        client = get_backend("ollama").from_options(pool_size=pool_size)
+        if not client.is_served():
+            console.print("[yellow]Ollama server not running![/yellow]")
+            return None
+        models = client.list_models()
+        if not model and len(models) == 1:
+            model = models[0]
+        if model not in models:
+            console.print(
+                "[red]Choose a model with --model![/red] "
+                f"Available models: [yellow]{', '.join(models)}[/yellow]",
+                highlight=False,
+            )
+            return None
+        client.model = model
+        return resilient_client(client, parsed_args)
+    if not mistral_api_key:
+        console.print(
+            "MISTRAL_API_KEY not found for API usage!",
+            style="red",
+            highlight=False,
+        )
+        return None
+    return resilient_client(
+        get_backend("mistral").from_options(pool_size=pool_size),
+        parsed_args,
+    )
+
+
+def sweep_main(parsed_args) -> None:
+    """`--workspace`/`--repos`: generates messages for staged changes of
+    many repositories concurrently and commits them in one batch
+
+    Args:
+        parsed_args (argparse.Namespace): Parsed arguments
+    """
+    import time
+
+    from .generation import diff_options
+    from .prompts import commit_prompt
+    from .rate_limit import RateLimiter
+    from .sweep import commit, find_repositories, sweep
+
+    repos = list(parsed_args.repos or [])
+    if parsed_args.workspace:
+        repos.extend(find_repositories(parsed_args.workspace))
+    # A repository given in --repos may be found under --workspace too
+    unique = {}
+    for repo in repos:
+        unique.setdefault(os.path.realpath(repo), repo)
+    repos = list(unique.values())
+    if not repos:
+        console.print("[red]No git repositories found![/red]")
+        return None
+    client = make_client(parsed_args)
+    if client is None:
+        return None
+
+    def print_result(result) -> None:
+        if result.status == "generated":
+            console.print(
+                f"[green]✓[/green] {result.path} "
+                f"[dim]({result.collect_time:.2f}s git, "
+                f"{result.generate_time:.2f}s model)[/dim] "
+                f"[yellow]{result.message}[/yellow]",
+                highlight=False,
+            )
+        elif result.status == "failed":
+            console.print(
+                f"[red]✗[/red] {result.path}: {result.error}",
+                highlight=False,
+            )
+        else:
+            console.print(
+                f"[dim]- {result.path}: nothing staged[/dim]",
+                highlight=False,
+            )
+
+    start = time.perf_counter()
+    results = sweep(
+        client,
+        repos,
+        commit_prompt(
+            parsed_args.language,
+            parsed_args.max_symbols,
+            parsed_args.wish,
+        ),
+        temperature=parsed_args.temperature,
+        timeout=parsed_args.timeout,
+        excluded_files=parsed_args.exclude,
+        concurrency=parsed_args.concurrency,
+        max_input_tokens=parsed_args.max_input_tokens,
+        max_diff_bytes=parsed_args.max_diff_bytes,
+        diff_options=diff_options(parsed_args),
+        plan=not parsed_args.full_diff,
+        compact=parsed_args.compact,
+        max_symbols=parsed_args.max_symbols,
+        limiter=RateLimiter(parsed_args.rate_limit),
+        on_result=print_result,
+    )
+    elapsed = time.perf_counter() - start
+    generated = [result for result in results if result.message]
+    failed = sum(result.status == "failed" for result in results)
+    console.print(
+        f"{len(results)} repositories in {elapsed:.2f}s: "
+        f"[green]{len(generated)} generated[/green], "
+        f"[red]{failed} failed[/red], "
+        f"{len(results) - len(generated) - failed} without staged changes",
+        highlight=False,
+    )
+    if parsed_args.verbose:
+        print_connection_stats(client)
+    if parsed_args.dry_run or not generated:
+        return None
+    if (
+        input(
+            f"Commit {len(generated)} repositories with these messages? "
+            "[y/N]: "
+        )
+        == "y"
+    ):
+        for result in generated:
+            if not commit(result):
+                console.print(
+                    f"[red]Commit failed:[/red] {result.path}",
+                    highlight=False,
+                )
+        console.print(
+            "Commits created!",
+            style="green bold",
+            highlight=False,
+        )
+
+
+def daemon_main(argv: list) -> None:
+    """`commit_maker daemon`: serves generation requests of thin clients
+    until stopped or idle
+
+    Args:
+        argv (list): Arguments after `daemon`
+    """
+    parsed_args, watch_argv = daemon_parser.parse_known_args(argv)
+    if watch_argv and not parsed_args.watch:
+        daemon_parser.error(
+            "unrecognized arguments: " + " ".join(watch_argv)
+        )
+    for repo in parsed_args.watch:
+        if not os.path.isdir(os.path.join(repo, ".git")):
+            daemon_parser.error(f"{repo} is not a git repository root")
+    if parsed_args.watch:
+        # Fail early on options `commit_maker` would reject
+        parser.parse_args(watch_argv)
+
+    import socket
+
+    if not hasattr(socket, "AF_UNIX"):
+        console.print("[red]Unix sockets are not supported here![/red]")
+        return None
+
+    from .daemon import DaemonServer, is_running, stop
+    from .daemon_client import socket_path
+
+    path = parsed_args.socket or socket_path()
+    if parsed_args.stop:
+        if stop(path):
+            console.print("Daemon stopped", style="green", highlight=False)
+        else:
+            console.print("[yellow]Daemon is not running[/yellow]")
+        return None
+    if os.path.exists(path):
+        if is_running(path):
+            console.print(
+                f"[yellow]Daemon is already running on {path}[/yellow]",
+                highlight=False,
+            )
+            return None
+        # Left over from a daemon that did not exit cleanly
+        os.remove(path)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    server = DaemonServer(path, parser, idle_timeout=parsed_args.idle_timeout)
+    if parsed_args.watch:
+        server.watch(
+            parsed_args.watch,
+            watch_argv,
+            log=lambda line: console.print(
+                line, highlight=False, markup=False
+            ),
+        )
+        console.print(
+            "Watching [yellow]"
+            + ", ".join(parsed_args.watch)
+            + "[/yellow] for staged changes",
+            highlight=False,
+        )
+    console.print(
+        f"Daemon listening on [yellow]{path}[/yellow]",
+        highlight=False,
+    )
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        pass
+    console.print(
+        f"Daemon stopped after {server.served} request(s)"
+        + (
+            f", {server.watcher.pregenerated} pre-generated message(s)"
+            if server.watcher
+            else ""
+        ),
+        highlight=False,
+    )
+
+
+def reword_main(argv: list) -> None:
+    """`commit_maker reword <rev-range>`: regenerates messages of existing
+    commits and rewrites them in one pass
+
+    Args:
+        argv (list): Arguments after `reword`
+    """
+    return run_traced(reword_commits, reword_parser.parse_args(argv))
+
+
+def reword_commits(parsed_args) -> None:
+    """Body of `commit_maker reword`
+
+    Args:
+        parsed_args (argparse.Namespace): Parsed arguments of `reword`
+    """
+    import json
+
+    from .prompts import commit_prompt
+    from .reword import commits_in_range, generate_messages, rewrite_messages
+
+    rev_range = parsed_args.range
+    try:
+        commits = commits_in_range(rev_range)
+    except subprocess.CalledProcessError as e:
+        console.print(
+            f"[red]Invalid range:[/red] {e.stderr.strip()}",
+            highlight=False,
+        )
+        return None
+    except ValueError as e:
+        console.print(f"[red]Invalid range:[/red] {e}", highlight=False)
+        return None
+
+    client = make_client(parsed_args)
+    if client is None:
+        return None
+
+    with console.status(
+        "[magenta bold]Rewording commits...",
+        spinner_style="magenta",
+    ) as status:
+        new_messages = generate_messages(
+            client,
+            rev_range,
+            commit_prompt(
+                parsed_args.language,
+                parsed_args.max_symbols,
+                parsed_args.wish,
+            ),
+            temperature=parsed_args.temperature,
+            timeout=parsed_args.timeout,
+            concurrency=parsed_args.concurrency,
+            max_input_tokens=parsed_args.max_input_tokens,
+            max_symbols=parsed_args.max_symbols,
+            on_progress=lambda done: status.update(
+                f"[magenta bold]Rewording commits... {done}"
+            ),
+        )
+    if parsed_args.verbose:
+        print_connection_stats(client)
+
+    subjects = dict(
+        line.split(" ", 1)
+        for line in subprocess.run(
+            ["git", "log", "--format=%H %s", rev_range],
+            capture_output=True,
+            text=True,
+            encoding="utf-8",
+        ).stdout.splitlines()
+        if " " in line
+    )
+    mapping = [
+        {
+            "commit": commit,
+            "old": subjects.get(commit, ""),
+            "new": new_messages[commit],
+        }
+        for commit in commits
+        if commit in new_messages
+    ]
+    for entry in mapping:
+        console.print(
+            f"[dim]{entry['commit'][:10]}[/dim] {entry['old']} -> "
+            f"[yellow]{entry['new']}[/yellow]",
+            highlight=False,
+            markup=True,
+        )
+    kept = len(commits) - len(mapping)
+    if kept:
+        console.print(
+            f"[yellow]{kept} commit(s) keep their messages "
+            "(merges or failed generations)[/yellow]",
+            highlight=False,
+        )
+    if parsed_args.dry_run:
+        with open(parsed_args.mapping, "w", encoding="utf-8") as f:
+            json.dump(mapping, f, ensure_ascii=False, indent=2)
+        console.print(
+            f"Mapping written to [yellow]{parsed_args.mapping}[/yellow]",
+            highlight=False,
+        )
+        return None
+    if not mapping:
+        return None
+    if (
+        input(
+            f"Rewrite {len(mapping)} commit message(s)? "
+            + colored("[y/N]", "yellow")
+            + ": "
+        )
+        == "y"
+    ):
+        old_head = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+        try:
+            rewrite_messages(rev_range, new_messages)
+        except subprocess.CalledProcessError as e:
+            # HEAD is only moved by the last step, `update-ref` with the
+            # old value, so a failure anywhere leaves history as it was
+            console.print(
+                f"[red]Rewriting failed:[/red] {(e.stderr or '').strip()}\n"
+                "HEAD was left unchanged.",
+                highlight=False,
+            )
+            sys.exit(1)
+        console.print(
+            "History rewritten! Previous HEAD: "
+            f"[yellow]{old_head}[/yellow]",
+            style="green bold",
+            highlight=False,
+        )
 
 
 # Main function
 
 
 def main() -> None:
-    # Parsing arguments
+    if sys.argv[1:2] == ["reword"]:
+        try:
+            return reword_main(sys.argv[2:])
+        except KeyboardInterrupt:
+            return None
+    if sys.argv[1:2] == ["daemon"]:
+        return daemon_main(sys.argv[2:])
+
+    # Parsing arguments. `--help`, `--version` and invalid options end here,
+    # before the daemon client is imported
     parsed_args = parser.parse_args()
+    if parsed_args.json or parsed_args.stdin:
+        return run_traced(json_main, parsed_args)
+    if not os.environ.get("COMMIT_MAKER_NO_DAEMON"):
+        from .daemon_client import run as run_via_daemon
+
+        try:
+            if run_via_daemon(sys.argv[1:]):
+                return None
+        except KeyboardInterrupt:
+            return None
+    if parsed_args.workspace or parsed_args.repos:
+        try:
+            return run_traced(sweep_main, parsed_args)
+        except KeyboardInterrupt:
+            return None
+    return run_traced(commit_main, parsed_args)
+
+
+def json_main(parsed_args) -> None:
+    """--json/--stdin: one message for the staged changes or a diff from
+    stdin, without prompts. The result is printed as JSON with --json, as
+    the bare message otherwise; the exit status is 1 without a message.
+
+    Args:
+        parsed_args (argparse.Namespace): Parsed arguments
+    """
+    import json
+    import time
+
+    from .api import GenerationOptions, GenerationResult, MessageGenerator
+    from .generation import diff_options
+    from .git_state import (
+        collect_repo_state,
+        read_capped_diff,
+        state_from_diff,
+    )
+
+    backend = "mistral"
+    if parsed_args.local_models:
+        backend = (
+            f"ollama:{parsed_args.model}" if parsed_args.model else "ollama"
+        )
+    started = time.perf_counter()
+    if parsed_args.stdin:
+        diff, truncated = read_capped_diff(
+            sys.stdin.buffer, parsed_args.max_diff_bytes
+        )
+        state = state_from_diff(
+            diff,
+            excluded_files=parsed_args.exclude,
+            plan=not parsed_args.full_diff,
+        )
+        state.truncated = truncated
+    else:
+        state = collect_repo_state(
+            parsed_args.exclude,
+            max_diff_bytes=parsed_args.max_diff_bytes,
+            diff_options=diff_options(parsed_args),
+            plan=not parsed_args.full_diff,
+        )
+    collected = time.perf_counter() - started
+    generator = MessageGenerator(GenerationOptions.from_args(parsed_args))
+    try:
+        result = generator.generate_for_state(state, backend=backend)
+    except ValueError as e:
+        # No API key, no model and the like
+        result = GenerationResult(
+            message=None,
+            backend=backend,
+            model=parsed_args.model,
+            error=str(e),
+        )
+    finally:
+        generator.close()
+    result.timings["collect"] = collected
+    if parsed_args.json:
+        print(json.dumps(result.to_dict(), ensure_ascii=False))
+    elif result.message:
+        print(result.message)
+    else:
+        print(result.error, file=sys.stderr)
+    if not result.message:
+        sys.exit(1)
+
+
+def commit_main(parsed_args) -> None:
+    """Interactive generation of a message for the staged changes
+
+    Args:
+        parsed_args (argparse.Namespace): Parsed arguments
+    """
+    import copy
+
+    from . import trace
+    from .background import BackgroundCall
+    from .candidates import CandidatePool
+    from .backends import get_backend
+    from .diff_packer import estimate_tokens
+    from .generation import (
+        build_prompt,
+        count_trim,
+        diff_options,
+        encoding_key,
+        estimate_prompt_tokens,
+        finish_message,
+        format_token_report,
+        message_cache_key,
+        output_limits,
+        resilient_client,
+        token_report,
+    )
+    from .git_state import collect_repo_state
+    from .ollama_probe import OllamaProbe
+    from .prompts import commit_prompt
+    from .response_cache import ResponseCache
+    from .summary_cache import SummaryCache
+
     use_local_models = parsed_args.local_models
     max_symbols = parsed_args.max_symbols
     model = parsed_args.model
@@ -119,17 +1198,21 @@ def main() -> None:
     wish = parsed_args.wish
     timeout = parsed_args.timeout
     lang = parsed_args.language
+    stream = not parsed_args.no_stream
+    verbose = parsed_args.verbose
+    use_cache = not parsed_args.no_cache
+    max_input_tokens = parsed_args.max_input_tokens
+    max_diff_bytes = parsed_args.max_diff_bytes
+    split_by = parsed_args.split
+    concurrency = parsed_args.concurrency
+    chunk_timeout = parsed_args.chunk_timeout
+    candidates = parsed_args.candidates
+    pool_size = max(4, concurrency, candidates)
+    compact = parsed_args.compact
+    encoding = diff_options(parsed_args)
 
     # AI prompt
-    prompt_for_ai = f"""You are a git commit message generator.
-    Generate a single commit message in
-    {"Russian" if lang == "ru" else "English"} that:
-    Clearly summarizes the purpose of the changes.
-    Does not exceed {max_symbols} characters.
-    Uses information from git status and git diff.
-    Takes into account user preferences: {wish}.
-    Output only the commit message — plain text, no markdown, no
-    explanations, no formatting."""
+    prompt_for_ai = commit_prompt(lang, max_symbols, wish)
 
     try:
         if not use_local_models and not mistral_api_key:
@@ -140,64 +1223,47 @@ def main() -> None:
             )
             return
 
-        # Get git version if available
-        git_version = subprocess.run(  # noqa
-            ["git", "--version"],
-            capture_output=True,
-            text=True,
-            encoding="utf-8",
-        ).stdout
-
         # Check if .git exists
         dot_git = ".git" in os.listdir("./")
 
         # If .git exists
         if dot_git:
-            # Get commit differences
-            git_status = subprocess.run(
-                ["git", "status"],
-                capture_output=True,
-                text=True,
-                encoding="utf-8",
-            )
-
-            new_files = subprocess.run(
-                ["git", "ls-files", "--others", "--exclude-standard"],
-                capture_output=True,
-                text=True,
-                encoding="utf-8",
-            )
-
-            if excluded_files:
-                git_diff_command = ["git", "diff", "--staged", "--", "."]
-                git_diff_command.extend([f":!{file}" for file in excluded_files])  # noqa
-            else:
-                git_diff_command = ["git", "diff", "--staged"]
-
-            git_diff = subprocess.run(
-                git_diff_command,
-                capture_output=True,
-                text=True,
-                encoding="utf-8",
-            )
+            if use_local_models:
+                # Probe Ollama while git state is collected. The same
+                # client (and its kept-alive connection) is used for
+                # generation later
+                client = get_backend("ollama").from_options(
+                    pool_size=pool_size
+                )
+                ollama_probe = BackgroundCall(OllamaProbe(client).models)
+                warm_up = None
+                if model:
+                    # The model loads while git state is collected, with
+                    # the smallest context; it is reloaded below only if
+                    # the diff needs a larger one
+                    client.model = model
+                    warm_up = BackgroundCall(
+                        client.warm_up,
+                        prompt_tokens=estimate_tokens(prompt_for_ai),
+                    )
 
-            if (
-                (not new_files.stdout)
-                and (not git_diff.stdout)
-                and (
-                    not subprocess.run(
-                        ["git", "diff"],
-                        capture_output=True,
-                        encoding="utf-8",
-                    ).stdout
+            # Get staged, unstaged and untracked changes
+            with trace.span("phase", "collect"):
+                repo_state = collect_repo_state(
+                    excluded_files,
+                    with_tree=use_cache,
+                    max_diff_bytes=max_diff_bytes,
+                    diff_options=encoding,
+                    plan=not parsed_args.full_diff,
                 )
-            ):  # Check for no changes
+
+            if not repo_state.has_changes:  # Check for no changes
                 console.print(
                     "[red]No changes added![/red]",
                     highlight=False,
                 )
                 return None
-            if not git_diff.stdout:
+            if not repo_state.diff:
                 if not dry_run:
                     if (
                         input(
@@ -226,17 +1292,21 @@ def main() -> None:
                         highlight=False,
                     )
                     return None
-                git_diff = subprocess.run(
-                    ["git", "diff", "--staged"],
-                    capture_output=True,
-                    text=True,
-                    encoding="utf-8",
+                with trace.span("phase", "collect"):
+                    repo_state = collect_repo_state(
+                        excluded_files,
+                        with_tree=use_cache,
+                        max_diff_bytes=max_diff_bytes,
+                        diff_options=encoding,
+                        plan=not parsed_args.full_diff,
+                    )
+            if repo_state.truncated:
+                console.print(
+                    f"[yellow]Diff of {len(repo_state.truncated)} file(s) "
+                    "is truncated by --max-diff-bytes[/yellow]",
+                    highlight=False,
                 )
-            if subprocess.run(
-                ["git", "diff"],
-                capture_output=True,
-                encoding="utf-8",
-            ).stdout:
+            if repo_state.unstaged:
                 console.print(
                     "[red]Note: You have unstaged changes![/red]"
                     " To add more files, press "
@@ -246,48 +1316,46 @@ def main() -> None:
                 )
 
             if use_local_models:
-                # Check Ollama installation
-                try:
-                    subprocess.run(
-                        ["ollama", "--version"],
-                        text=True,
-                        capture_output=True,
-                    )
-                except FileNotFoundError:
-                    console.print(
-                        "Ollama is not installed!",
-                        style="red bold",
-                    )
-                    return None
-
-                # Check if Ollama is running
-                ollama_served = (
-                    requests.get("http://localhost:11434").status_code == 200
+                expected_tokens = estimate_prompt_tokens(
+                    repo_state, prompt_for_ai, max_input_tokens, compact
                 )
+                if model:
+                    # Reloads the model while the model list is checked if
+                    # this diff needs a larger context than it is loading
+                    # with; otherwise sends nothing
+                    warm_up = BackgroundCall(
+                        client.warm_up, prompt_tokens=expected_tokens
+                    )
+                # Model list from the probe started before git collection
+                ollama_list_of_models = ollama_probe.result()
 
-                if ollama_served:
-                    # Get list of models from Ollama
-                    ollama_models_json = requests.get(
-                        "http://localhost:11434/api/tags"
-                    ).json()
-                    if ollama_models_json["models"]:
-                        ollama_list_of_models = [
-                            i["model"] for i in ollama_models_json["models"]
-                        ]
-                    else:
+                if ollama_list_of_models is None:
+                    # Check Ollama installation
+                    try:
+                        subprocess.run(
+                            ["ollama", "--version"],
+                            text=True,
+                            capture_output=True,
+                        )
+                    except FileNotFoundError:
                         console.print(
-                            "[yellow]Ollama model list is empty!"
-                            "[/yellow] To install models, visit "
-                            "https://ollama.com/models",
-                            highlight=False,
+                            "Ollama is not installed!",
+                            style="red bold",
                         )
                         return None
-                else:
                     console.print(
                         "[yellow]Ollama server not running\n"
                         "or not installed![/yellow]"
                     )
                     return None
+                if not ollama_list_of_models:
+                    console.print(
+                        "[yellow]Ollama model list is empty!"
+                        "[/yellow] To install models, visit "
+                        "https://ollama.com/models",
+                        highlight=False,
+                    )
+                    return None
             else:
                 ollama_list_of_models = 0
 
@@ -355,36 +1423,173 @@ def main() -> None:
                 )
             # Create AI client
             if use_local_models:
-                client = Ollama(model=model)
+                client.model = model
+                if warm_up is None:
+                    warm_up = BackgroundCall(
+                        client.warm_up, prompt_tokens=expected_tokens
+                    )
             else:
-                client = MistralAI(
-                    api_key=mistral_api_key,
-                    model="mistral-large-latest",
+                client = get_backend("mistral").from_options(
+                    pool_size=pool_size
                 )
-            if not dry_run:
+            client = resilient_client(client, parsed_args)
+            # Without a tree hash (e.g. unmerged index) nothing is cached
+            cache = ResponseCache() if repo_state.tree else None
+            cache_key = message_cache_key(
+                repo_state.tree,
+                client.model,
+                excluded_files,
+                lang,
+                max_symbols,
+                wish,
+                temperature,
+                max_input_tokens,
+                split_by,
+                encoding_key(parsed_args),
+            )
+
+            def build_messages() -> list:
+                # Built on first generation, a cached message needs neither
+                # packing nor map-reduce summaries
+                summary_cache = None
+                if split_by:
+                    summary_cache = SummaryCache() if use_cache else None
+                    with trace.span("phase", "summarize"), console.status(
+                        "[magenta bold]Summarizing changes...",
+                        spinner_style="magenta",
+                    ) as status:
+                        prompt = build_prompt(
+                            client,
+                            repo_state,
+                            prompt_for_ai,
+                            max_input_tokens=max_input_tokens,
+                            split_by=split_by,
+                            chunk_timeout=chunk_timeout,
+                            concurrency=concurrency,
+                            summary_cache=summary_cache,
+                            on_progress=lambda done, total: status.update(
+                                "[magenta bold]Summarizing changes... "
+                                f"{done}/{total}"
+                            ),
+                            compact=compact,
+                            encoding=encoding_key(parsed_args),
+                        )
+                else:
+                    prompt = build_prompt(
+                        client,
+                        repo_state,
+                        prompt_for_ai,
+                        max_input_tokens=max_input_tokens,
+                        compact=compact,
+                    )
+                if parsed_args.token_report:
+                    console.print(
+                        "[dim]"
+                        + format_token_report(
+                            token_report(
+                                repo_state,
+                                compact,
+                                excluded_files,
+                                max_diff_bytes=max_diff_bytes,
+                            )
+                        )
+                        + "[/dim]",
+                        highlight=False,
+                    )
+                if summary_cache and summary_cache.hits and verbose:
+                    console.print(
+                        f"[dim]Reused {summary_cache.hits} cached "
+                        "summaries[/dim]",
+                        highlight=False,
+                    )
+                if prompt.failed_chunks:
+                    console.print(
+                        f"[yellow]No summary for {len(prompt.failed_chunks)} "
+                        "chunk(s), their stats are used instead: "
+                        f"{', '.join(prompt.failed_chunks)}[/yellow]",
+                        highlight=False,
+                    )
+                if prompt.packed_tokens:
+                    console.print(
+                        "[yellow]Diff is too large, packed into "
+                        f"~{prompt.packed_tokens} tokens[/yellow]",
+                        highlight=False,
+                    )
+                return prompt.messages
+
+            messages = None
+            if candidates > 1:
+                messages = build_messages()
+
+                def generate_candidate():
+                    # Candidates are generated in parallel, each with its own
+                    # copy for the results of its request
+                    message = copy.copy(client).message(
+                        messages=messages,
+                        temperature=temperature,
+                        timeout=timeout,
+                        **output_limits(max_symbols),
+                    )
+                    message, trimmed = finish_message(message, max_symbols)
+                    if message:
+                        count_trim(trimmed)
+                    return message
+
+                def remember(new):
+                    for message in new:
+                        cache.append(cache_key, message)
+
+                pool = CandidatePool(generate_candidate, candidates)
+                if cache:
+                    pool.messages.extend(cache.get(cache_key))
+                pool.request(candidates)
+                commit_message = pick_candidate(
+                    pool,
+                    candidates,
+                    dry_run,
+                    on_new=remember if cache else None,
+                )
+                if verbose:
+                    print_connection_stats(client)
+                if commit_message:
+                    with trace.span("phase", "commit"):
+                        subprocess.run(
+                            ["git", "commit", "-m", f"{commit_message}"],
+                            encoding="utf-8",
+                        )
+                    console.print(
+                        "Commit created successfully!",
+                        style="green bold",
+                        highlight=False,
+                    )
+            elif not dry_run:
                 retry = True
+                # Cached message is offered once, "r" always regenerates
+                commit_message = (
+                    cached_commit_message(cache, cache_key) if cache else None
+                )
                 while retry:
-                    with console.status(
-                        "[magenta bold]Generating commit message...",
-                        spinner_style="magenta",
-                    ):
-                        commit_message = client.message(
-                            messages=[
-                                {
-                                    "role": "system",
-                                    "content": prompt_for_ai,
-                                },
-                                {
-                                    "role": "user",
-                                    "content": "Git status: "
-                                    + git_status.stdout
-                                    + "Git diff: "
-                                    + git_diff.stdout,
-                                },
-                            ],
+                    if commit_message is None:
+                        if messages is None:
+                            messages = build_messages()
+                        commit_message = generate_commit_message(
+                            client,
+                            messages=messages,
                             temperature=temperature,
                             timeout=timeout,
+                            stream=stream,
+                            max_symbols=max_symbols,
                         )
+                        if verbose:
+                            print_connection_stats(client)
+                        if cache and commit_message:
+                            cache.append(cache_key, commit_message)
+                        if not commit_message:
+                            # Never offer to commit an empty message
+                            console.print(
+                                "[red]No commit message generated![/red]"
+                            )
+                            return None
                     commit_with_message_from_ai = input(
                         "Commit with message "
                         + colored(f"'{commit_message}'", "yellow")
@@ -393,39 +1598,40 @@ def main() -> None:
                     if commit_with_message_from_ai != "r":
                         retry = False
                         break
+                    commit_message = None
                 if commit_with_message_from_ai == "y":
-                    subprocess.run(
-                        ["git", "commit", "-m", f"{commit_message}"],
-                        encoding="utf-8",
-                    )
+                    with trace.span("phase", "commit"):
+                        subprocess.run(
+                            ["git", "commit", "-m", f"{commit_message}"],
+                            encoding="utf-8",
+                        )
                     console.print(
                         "Commit created successfully!",
                         style="green bold",
                         highlight=False,
                     )
             else:
-                with console.status(
-                    "[magenta bold]Generating commit message...",
-                    spinner_style="magenta",
-                ):
-                    commit_message = client.message(
-                        messages=[
-                            {
-                                "role": "system",
-                                "content": prompt_for_ai,
-                            },
-                            {
-                                "role": "user",
-                                "content": "Git status: "
-                                + git_status.stdout
-                                + "Git diff: "
-                                + git_diff.stdout,
-                            },
-                        ],
-                        temperature=temperature,
-                        timeout=timeout,
+                if cache and cached_commit_message(cache, cache_key):
+                    return None
+                messages = build_messages()
+                commit_message = generate_commit_message(
+                    client,
+                    messages=messages,
+                    temperature=temperature,
+                    timeout=timeout,
+                    stream=stream,
+                    max_symbols=max_symbols,
+                )
+                if verbose:
+                    print_connection_stats(client)
+                if cache and commit_message:
+                    cache.append(cache_key, commit_message)
+                if not commit_message:
+                    console.print("[red]No commit message generated![/red]")
+                elif not stream:
+                    console.print(
+                        commit_message, style="yellow", highlight=False
                     )
-                console.print(commit_message, style="yellow", highlight=False)
                 return None
 
         # If .git does not exist
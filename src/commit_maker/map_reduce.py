@@ -0,0 +1,196 @@
+# Map-reduce generation for large change sets: the staged diff is split
+# into chunks that are summarized concurrently, the summaries are then
+# reduced into one commit message by the usual generation step.
+import asyncio
+import concurrent.futures
+import os
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from .diff_packer import FileDiff, pack_diff, parse_diff
+from .summary_cache import SummaryCache
+
+SUMMARY_PROMPT = """You summarize a part of a git diff for a commit message.
+Describe what was changed in {name} and why, in one or two short sentences
+in English. Output only the summary — plain text, no markdown."""
+
+
+def split_diff(diff: str, by: str = "file") -> List[Tuple[str, str, str]]:
+    """Splits the diff into chunks
+
+    Args:
+        diff (str): Output of `git diff`
+        by (str, optional): `file` for a chunk per file, `dir` for a chunk
+            per directory. Defaults to "file".
+
+    Returns:
+        list[tuple[str, str, str]]: (name, diff, stats) of every chunk
+    """
+    return [
+        (name, "".join(_render(file) for file in files), _stats(files))
+        for name, files in _group_files(diff, by).items()
+    ]
+
+
+def _group_files(diff: str, by: str) -> Dict[str, List[FileDiff]]:
+    groups: Dict[str, List[FileDiff]] = {}
+    for file in parse_diff(diff):
+        name = file.path if by == "file" else os.path.dirname(file.path)
+        groups.setdefault(name or ".", []).append(file)
+    return groups
+
+
+def _render(file: FileDiff) -> str:
+    return file.render([True] * len(file.hunks))
+
+
+def _stats(files: List[FileDiff]) -> str:
+    return "; ".join(file.stat() for file in files)
+
+
+async def summarize_diff_async(
+    client,
+    diff: str,
+    by: str = "file",
+    temperature: float = 0.3,
+    chunk_timeout: Optional[float] = 60,
+    concurrency: int = 4,
+    max_chunk_tokens: int = 0,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+    cache: Optional[SummaryCache] = None,
+    blobs: Optional[Dict[str, Tuple[str, str]]] = None,
+    encoding: Optional[Dict] = None,
+    truncated: Sequence[str] = (),
+) -> Tuple[str, List[str]]:
+    """Summarizes chunks of the diff concurrently, at most `concurrency`
+    requests at a time. Chunks that fail or miss their deadline are
+    represented by their stats, so one bad chunk does not fail the whole
+    message.
+
+    With a cache, chunks whose files all have known blob ids are looked up
+    first and only new or changed chunks are sent to the model.
+
+    Args:
+        client (Backend): AI backend
+        diff (str): Output of `git diff`
+        by (str, optional): `file` or `dir`. Defaults to "file".
+        temperature (float, optional): Temperature for summaries.
+            Defaults to 0.3.
+        chunk_timeout (float, optional): Deadline for one chunk in seconds.
+            Defaults to 60.
+        concurrency (int, optional): Maximum simultaneous requests.
+            Defaults to 4.
+        max_chunk_tokens (int, optional): Token budget of one chunk, 0 for
+            no limit. Defaults to 0.
+        on_progress (callable, optional): Called with (done, total) after
+            every finished chunk
+        cache (SummaryCache, optional): Cache of chunk summaries, saved
+            before returning
+        blobs (dict[str, tuple[str, str]], optional): (old blob, new blob)
+            by path, see `RepoState.blobs`
+        encoding (dict, optional): Encoding of the diff, see
+            `generation.encoding_key`. Part of the cache keys.
+        truncated (list[str], optional): Paths cut by the diff size cap,
+            see `RepoState.truncated`. Part of the cache keys.
+
+    Returns:
+        tuple[str, list[str]]: Summaries text for the final prompt and
+            names of the chunks that failed
+    """
+    groups = _group_files(diff, by)
+    chunks = [
+        (name, "".join(_render(file) for file in files), _stats(files))
+        for name, files in groups.items()
+    ]
+    keys: Dict[str, str] = {}
+    if cache is not None and blobs:
+        for name, files in groups.items():
+            if all(file.path in blobs for file in files):
+                # A summary of a compacted or cut diff is not one of the
+                # full diff. Keys of full default diffs stay as they were
+                extra: Dict = {"encoding": encoding} if encoding else {}
+                if any(file.path in truncated for file in files):
+                    extra["truncated"] = True
+                keys[name] = cache.key(
+                    [(file.path, *blobs[file.path]) for file in files],
+                    model=client.model,
+                    by=by,
+                    temperature=temperature,
+                    max_chunk_tokens=max_chunk_tokens,
+                    **extra,
+                )
+    # Chunks of files described by their stats only are not sent
+    omitted = {
+        name
+        for name, files in groups.items()
+        if all(file.omitted for file in files)
+    }
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+    done = 0
+
+    async def summarize(name: str, chunk: str) -> Optional[str]:
+        nonlocal done
+        if name in omitted:
+            done += 1
+            if on_progress:
+                on_progress(done, len(chunks))
+            return None
+        if name in keys:
+            summary = cache.get(keys[name])
+            if summary:
+                done += 1
+                if on_progress:
+                    on_progress(done, len(chunks))
+                return summary
+        if max_chunk_tokens:
+            chunk = pack_diff(chunk, max_chunk_tokens)
+        try:
+            async with semaphore:
+                return await client.amessage(
+                    messages=[
+                        {
+                            "role": "system",
+                            "content": SUMMARY_PROMPT.format(name=name),
+                        },
+                        {"role": "user", "content": chunk},
+                    ],
+                    temperature=temperature,
+                    deadline=chunk_timeout,
+                )
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            done += 1
+            if on_progress:
+                on_progress(done, len(chunks))
+
+    summaries = await asyncio.gather(
+        *(summarize(name, chunk) for name, chunk, _ in chunks)
+    )
+
+    lines, failed = [], []
+    for (name, _, stats), summary in zip(chunks, summaries):
+        if name in omitted:
+            lines.append(f"- {name}: {stats}")
+        elif summary:
+            lines.append(f"- {name}: {summary.strip()}")
+            if name in keys:
+                cache.put(keys[name], summary.strip())
+        else:
+            failed.append(name)
+            lines.append(f"- {name}: (no summary) {stats}")
+    if cache is not None:
+        cache.save()
+    return "\n".join(lines) + "\n", failed
+
+
+def summarize_diff(*args, **kwargs) -> Tuple[str, List[str]]:
+    """Blocking version of `summarize_diff_async`. Called from a running
+    event loop (e.g. a bot using the library API), it runs the coroutine on
+    a worker thread with a loop of its own."""
+    coroutine = summarize_diff_async(*args, **kwargs)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, coroutine).result()
@@ -1,13 +1,54 @@
 # Класс для использования API Mistral AI
-from typing import Optional, List, Dict
+import hashlib
+import json
+import os
+import time
+from typing import Dict, Iterator, List, Optional
 
 import requests
 import rich.console
 
+from . import trace
+from .backends import AsyncBackendMixin, register_backend, report_error
+from .diff_packer import estimate_tokens
+from .http_session import (
+    DeadlineExceeded,
+    RetryPolicy,
+    connection_stats,
+    make_session,
+    post_with_retries,
+    response_span,
+)
+from .rate_limit import QueueTimeout, SharedRateLimiter
+
 console = rich.console.Console()
 
+# Оценка длины ответа для квоты токенов, если max_tokens не задан
+ANSWER_ESTIMATE = 512
+
+
+def _usage(usage: Optional[dict]) -> Optional[Dict[str, int]]:
+    """Расход токенов из поля `usage` ответа"""
+    if not usage or "prompt_tokens" not in usage:
+        return None
+    return {
+        "prompt_tokens": usage["prompt_tokens"],
+        "completion_tokens": usage.get("completion_tokens", 0),
+    }
+
+
+def _limits(max_tokens: Optional[int], stop: Optional[List[str]]) -> Dict:
+    """Поля запроса, ограничивающие ответ"""
+    limits = {}
+    if max_tokens:
+        limits["max_tokens"] = max_tokens
+    if stop:
+        limits["stop"] = stop
+    return limits
 
-class MistralAI:
+
+@register_backend("mistral")
+class MistralAI(AsyncBackendMixin):
     """Класс для общения с MistralAI.
     Написан с помощью requests."""
 
@@ -15,13 +56,18 @@ class MistralAI:
         self,
         api_key: str,
         model: str = "mistral-medium-latest",
+        pool_size: int = 4,
+        base_url: str = "https://api.mistral.ai",
     ):
         """Инициализация класса
 
         Args:
             api_key (str): Апи ключ MistralAI
+            pool_size (int, optional): Размер пула keep-alive соединений.
+                Defaults to 4.
+            base_url (str, optional): Адрес API.
         """
-        self.url = "https://api.mistral.ai/v1/chat/completions"
+        self.url = f"{base_url}/v1/chat/completions"
         self.api_key = api_key
         self.headers = {
             "Content-Type": "application/json",
@@ -29,12 +75,89 @@ class MistralAI:
             "Authorization": f"Bearer {api_key}",
         }
         self.model = model
+        self.session = make_session(pool_size)
+        # Повторы запросов при 429/5xx и сетевых ошибках
+        self.retry = RetryPolicy()
+        # Не печатать ошибки запросов (библиотека, --json), только хранить
+        # последнюю
+        self.quiet = False
+        self.last_error: Optional[str] = None
+        # Расход токенов последнего ответа по данным сервера
+        self.usage: Optional[Dict[str, int]] = None
+        # Общая для всех процессов квота запросов, см. from_options
+        self.limiter: Optional[SharedRateLimiter] = None
+        # Время ожидания последнего запроса в очереди квоты, в сек.
+        self.queue_time = 0.0
+
+    @classmethod
+    def from_options(
+        cls,
+        model: Optional[str] = None,
+        pool_size: int = 4,
+    ) -> "MistralAI":
+        """Создание клиента из параметров командной строки. Ключ берется из
+        переменной окружения MISTRAL_API_KEY, адрес API (например, для
+        прокси) - из MISTRAL_BASE_URL.
+
+        Квота, общая для всех процессов пользователя: MISTRAL_RATE_LIMIT
+        (запросов в секунду), MISTRAL_TOKENS_PER_MINUTE и
+        MISTRAL_QUEUE_TIMEOUT (наибольшее ожидание в очереди, в сек.,
+        по умолчанию 60)"""
+        client = cls(
+            api_key=os.environ.get("MISTRAL_API_KEY", ""),
+            model=model or "mistral-large-latest",
+            pool_size=pool_size,
+            base_url=os.environ.get(
+                "MISTRAL_BASE_URL", "https://api.mistral.ai"
+            ).rstrip("/"),
+        )
+        rate = float(os.environ.get("MISTRAL_RATE_LIMIT") or 0)
+        tokens_per_minute = int(
+            os.environ.get("MISTRAL_TOKENS_PER_MINUTE") or 0
+        )
+        if rate or tokens_per_minute:
+            # Квота привязана к ключу, сам ключ в файл не пишется
+            key_hash = hashlib.sha256(client.api_key.encode()).hexdigest()
+            client.limiter = SharedRateLimiter(
+                f"{client.url}#{key_hash[:16]}",
+                rate=rate,
+                tokens_per_minute=tokens_per_minute,
+                max_wait=float(os.environ.get("MISTRAL_QUEUE_TIMEOUT") or 60),
+            )
+        return client
+
+    def _wait_for_quota(
+        self, messages: List[Dict[str, str]], max_tokens: Optional[int]
+    ) -> None:
+        """Ждет своей очереди в общей квоте запросов и токенов
+
+        Raises:
+            QueueTimeout: Ожидание превысило бы MISTRAL_QUEUE_TIMEOUT
+        """
+        self.queue_time = 0.0
+        if self.limiter is None:
+            return
+        tokens = estimate_tokens(
+            "".join(message["content"] for message in messages)
+        ) + (max_tokens or ANSWER_ESTIMATE)
+        with trace.span("queue", "mistral quota", tokens=tokens):
+            self.queue_time = self.limiter.acquire(tokens)
+
+    def connection_stats(self) -> Dict[str, int]:
+        """Статистика запросов и переиспользованных соединений"""
+        return connection_stats(self.session)
+
+    def close(self) -> None:
+        """Закрывает соединения сессии"""
+        self.session.close()
 
     def message(
         self,
         messages: List[Dict[str, str]],
         timeout: Optional[int],
         temperature: float,
+        max_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
     ) -> str:
         """Функция для общения с моделью
 
@@ -43,6 +166,8 @@ class MistralAI:
             timeout (int): Таймаут(время ожидания, в сек.)
             role (str, optional): Роль сообщения. Defaults to "user".
             temperature (float, optional): Температура общения. Defaults to 0.7. #noqa
+            max_tokens (int, optional): Ограничение длины ответа
+            stop (list[str], optional): Стоп-последовательности
 
         Returns:
             str: _description_
@@ -52,17 +177,109 @@ class MistralAI:
             "messages": messages,
             "temperature": temperature,
         }
+        data.update(_limits(max_tokens, stop))
+        self.usage = None
+        try:
+            self._wait_for_quota(messages, max_tokens)
+            with trace.span(
+                "http", "POST /v1/chat/completions", model=self.model
+            ) as span:
+                response = post_with_retries(
+                    self.session,
+                    self.url,
+                    self.retry,
+                    json=data,
+                    headers=self.headers,
+                    timeout=timeout,
+                )
+                response_span(span, response)
+                response.raise_for_status()
+                answer = response.json()
+                span.attrs.update(answer.get("usage") or {})
+                self.usage = _usage(answer.get("usage"))
+            return answer["choices"][0]["message"]["content"]
+
+        except requests.exceptions.RequestException as e:
+            report_error(self, console, e)
+        except QueueTimeout as e:
+            report_error(self, console, e, traceback=False)
+        except KeyError as e:
+            report_error(self, console, e)
+
+    def stream(
+        self,
+        messages: List[Dict[str, str]],
+        timeout: Optional[int],
+        temperature: float,
+        max_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+    ) -> Iterator[str]:
+        """Потоковая генерация ответа. API отдает SSE-события вида
+        `data: {...}`, поток завершается событием `data: [DONE]`.
+
+        Args:
+            messages (list[dict[str]]): Список сообщений
+            timeout (int): Таймаут(время ожидания, в сек.)
+            temperature (float, optional): Температура общения
+            max_tokens (int, optional): Ограничение длины ответа
+            stop (list[str], optional): Стоп-последовательности
+
+        Yields:
+            str: Очередной фрагмент ответа модели
+
+        Raises:
+            DeadlineExceeded: Ответ не получен целиком до --deadline
+        """
+        data = {
+            "model": self.model,
+            "messages": messages,
+            "temperature": temperature,
+            "stream": True,
+        }
+        data.update(_limits(max_tokens, stop))
+        headers = dict(self.headers, Accept="text/event-stream")
+        self.usage = None
         try:
-            response = requests.post(
-                url=self.url,
+            self._wait_for_quota(messages, max_tokens)
+            started = time.monotonic()
+            with trace.span(
+                "http", "POST /v1/chat/completions", model=self.model
+            ) as span, post_with_retries(
+                self.session,
+                self.url,
+                self.retry,
                 json=data,
-                headers=self.headers,
+                headers=headers,
                 timeout=timeout,
-            )
-            response.raise_for_status()
-            return response.json()["choices"][0]["message"]["content"]
+                stream=True,
+            ) as response:
+                response_span(span, response)
+                response.raise_for_status()
+                for raw_line in response.iter_lines():
+                    self.retry.check_deadline(started)
+                    line = raw_line.decode("utf-8")
+                    if not line.startswith("data:"):
+                        continue
+                    payload = line[len("data:"):].strip()
+                    if payload == "[DONE]":
+                        break
+                    event = json.loads(payload)
+                    # Последнее событие содержит расход токенов
+                    span.attrs.update(event.get("usage") or {})
+                    if event.get("usage"):
+                        self.usage = _usage(event["usage"])
+                    delta = event["choices"][0]["delta"]
+                    content = delta.get("content")
+                    if content:
+                        yield content
 
-        except requests.exceptions.RequestException:
-            console.print_exception()
-        except KeyError:
-            console.print_exception()
+        except DeadlineExceeded as e:
+            # Часть ответа уже отдана, поэтому это не конец ответа, а ошибка
+            self.last_error = str(e)
+            raise
+        except requests.exceptions.RequestException as e:
+            report_error(self, console, e)
+        except QueueTimeout as e:
+            report_error(self, console, e, traceback=False)
+        except (KeyError, IndexError, ValueError) as e:
+            report_error(self, console, e)
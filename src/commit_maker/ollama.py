@@ -1,33 +1,359 @@
 # Класс для использования API Ollama
-from typing import Optional, List, Dict
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
 
 import requests
 import rich.console
 
+from . import trace
+from .backends import AsyncBackendMixin, register_backend, report_error
+from .diff_packer import estimate_tokens
+from .http_session import (
+    DeadlineExceeded,
+    RetryPolicy,
+    connection_stats,
+    make_session,
+    post_with_retries,
+    response_span,
+)
+from .response_cache import default_cache_dir
+
 console = rich.console.Console()
 
+# Размеры контекста, из которых выбирается num_ctx
+CONTEXT_BUCKETS = (2048, 4096, 8192, 16384, 32768, 65536, 131072)
+# Токены, оставляемые под ответ модели
+ANSWER_RESERVE = 512
+# Запас на неточность оценки числа токенов (4 символа на токен)
+ESTIMATE_MARGIN = 1.25
+# Сколько доверять сохраненной длине контекста модели, в секундах
+CONTEXT_TTL = 24 * 60 * 60
+# Таймаут предзагрузки модели (соединение, ответ), в секундах. Загрузка
+# большой модели занимает десятки секунд, но зависший сервер не должен
+# держать фоновый поток и соединение пула до конца процесса
+WARM_UP_TIMEOUT = (5, 120)
+
+# Длины контекста, уже известные процессу, по (адрес сервера, модель)
+_context_lengths: Dict[str, Optional[int]] = {}
+# num_ctx, с которым модель загружена через warm_up. Общий для копий
+# клиента с разными политиками повторов
+_loaded_num_ctx: Dict[str, int] = {}
+_context_lock = threading.Lock()
+
+
+class ContextOverflowError(ValueError):
+    """Запрос не помещается в контекст модели"""
+
+
+def _context_cache_path() -> str:
+    return os.path.join(default_cache_dir(), "ollama_context.json")
+
+
+def _load_context_cache() -> Dict[str, Dict]:
+    try:
+        with open(_context_cache_path(), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_context_cache(key: str, length: int) -> None:
+    cached = _load_context_cache()
+    cached[key] = {"length": length, "time": time.time()}
+    path = _context_cache_path()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(cached, f)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
 
-class Ollama:
+def _usage(answer: dict) -> Optional[Dict[str, int]]:
+    """Расход токенов из последнего ответа Ollama"""
+    if "prompt_eval_count" not in answer or "eval_count" not in answer:
+        return None
+    return {
+        "prompt_tokens": answer["prompt_eval_count"],
+        "completion_tokens": answer["eval_count"],
+    }
+
+
+def _eval_stats(span: trace.Span, answer: dict) -> None:
+    """Добавляет к спану статистику генерации из ответа Ollama"""
+    span.attrs.update(
+        (key, answer[key]) for key in trace.OLLAMA_STATS if key in answer
+    )
+
+
+@register_backend("ollama")
+class Ollama(AsyncBackendMixin):
     """Класс для общения с локальными моделями Ollama.
     Написан с помощью requests."""
 
     def __init__(
         self,
-        model: str,
+        model: Optional[str] = None,
+        base_url: str = "http://localhost:11434",
+        pool_size: int = 4,
     ):
-        """Инициализация класса"""
+        """Инициализация класса
+
+        Args:
+            model (str, optional): Модель. Можно задать позже, после
+                получения списка моделей. Defaults to None.
+            base_url (str, optional): Адрес сервера Ollama.
+            pool_size (int, optional): Размер пула keep-alive соединений.
+                Defaults to 4.
+        """
         self.model = model
-        self.url = "http://localhost:11434/api/chat"
+        self.base_url = base_url
+        self.url = f"{base_url}/api/chat"
         self.headers = {
             "Content-Type": "application/json",
             "Accept": "application/json",
         }
+        self.session = make_session(pool_size)
+        # Повторы запросов при 429/5xx и сетевых ошибках
+        self.retry = RetryPolicy()
+        # Не печатать ошибки запросов (библиотека, --json), только хранить
+        # последнюю
+        self.quiet = False
+        self.last_error: Optional[str] = None
+        # Расход токенов последнего ответа по данным сервера
+        self.usage: Optional[Dict[str, int]] = None
+
+    @classmethod
+    def from_options(
+        cls,
+        model: Optional[str] = None,
+        pool_size: int = 4,
+    ) -> "Ollama":
+        """Создание клиента из параметров командной строки. Адрес сервера
+        берется из переменной окружения OLLAMA_HOST, как у самой Ollama"""
+        host = os.environ.get("OLLAMA_HOST", "").rstrip("/")
+        if host and "://" not in host:
+            host = f"http://{host}"
+        return cls(
+            model=model,
+            base_url=host or "http://localhost:11434",
+            pool_size=pool_size,
+        )
+
+    def is_served(self) -> bool:
+        """Проверяет, запущен ли сервер Ollama
+
+        Returns:
+            bool: True, если сервер отвечает
+        """
+        try:
+            return self.session.get(self.base_url, timeout=5).status_code == 200
+        except requests.exceptions.RequestException:
+            # Не только отказ в соединении: завис или отвечает не по HTTP
+            return False
+
+    def list_models(self) -> List[str]:
+        """Список установленных моделей
+
+        Returns:
+            list[str]: Имена моделей
+        """
+        response = self.session.get(f"{self.base_url}/api/tags", timeout=5)
+        response.raise_for_status()
+        return [i["model"] for i in response.json()["models"]]
+
+    def _key(self) -> str:
+        # Ключ модели в кэшах длины контекста: (адрес сервера, модель)
+        return f"{self.base_url} {self.model}"
+
+    def context_length(self) -> Optional[int]:
+        """Максимальная длина контекста модели из `/api/show`. Запрашивается
+        один раз на модель, результат хранится на диске сутки
+
+        Returns:
+            int | None: Длина в токенах, None, если она неизвестна
+        """
+        key = self._key()
+        with _context_lock:
+            if key in _context_lengths:
+                return _context_lengths[key]
+            cached = _load_context_cache().get(key)
+            if cached and time.time() - cached["time"] < CONTEXT_TTL:
+                length = cached["length"]
+            else:
+                length = self._show_context_length()
+                if length:
+                    _save_context_cache(key, length)
+            _context_lengths[key] = length
+        return length
+
+    def _show_context_length(self) -> Optional[int]:
+        try:
+            with trace.span(
+                "http", "POST /api/show", model=self.model
+            ) as span:
+                response = self.session.post(
+                    url=f"{self.base_url}/api/show",
+                    json={"model": self.model},
+                    headers=self.headers,
+                    timeout=5,
+                )
+                response_span(span, response)
+                response.raise_for_status()
+                info = response.json().get("model_info") or {}
+        except (requests.exceptions.RequestException, ValueError):
+            return None
+        # Ключ зависит от архитектуры, например `llama.context_length`
+        for key, value in info.items():
+            if key.endswith(".context_length"):
+                return int(value)
+        return None
+
+    def input_budget(self) -> Optional[int]:
+        """Сколько токенов запроса помещается в контекст модели вместе с
+        ответом
+
+        Returns:
+            int | None: Токены, None, если длина контекста неизвестна
+        """
+        limit = self.context_length()
+        if limit is None:
+            return None
+        return int((limit - ANSWER_RESERVE) / ESTIMATE_MARGIN)
+
+    def num_ctx(
+        self, prompt_tokens: int, answer_tokens: Optional[int] = None
+    ) -> Optional[int]:
+        """Наименьший размер контекста из `CONTEXT_BUCKETS`, в который
+        помещаются запрос и ответ
+
+        Args:
+            prompt_tokens (int): Оценка числа токенов запроса
+            answer_tokens (int, optional): Ограничение ответа. Defaults to
+                `ANSWER_RESERVE`.
+
+        Returns:
+            int | None: num_ctx, None, если длина контекста неизвестна
+
+        Raises:
+            ContextOverflowError: Запрос не помещается даже в полный контекст
+        """
+        limit = self.context_length()
+        if limit is None:
+            return None
+        answer_tokens = answer_tokens or ANSWER_RESERVE
+        if prompt_tokens + answer_tokens > limit:
+            raise ContextOverflowError(
+                f"Prompt of ~{prompt_tokens} tokens does not fit the "
+                f"{limit}-token context of {self.model}, lower "
+                "--max-input-tokens or use --split"
+            )
+        needed = int(prompt_tokens * ESTIMATE_MARGIN) + answer_tokens
+        for bucket in CONTEXT_BUCKETS:
+            if bucket >= needed:
+                return min(bucket, limit)
+        return limit
+
+    def _options(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        max_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+    ) -> Optional[Dict]:
+        """Параметры генерации с num_ctx под размер запроса
+
+        Returns:
+            dict | None: Параметры, None, если запрос не помещается
+        """
+        options = {"temperature": temperature}
+        if max_tokens:
+            options["num_predict"] = max_tokens
+        if stop:
+            options["stop"] = stop
+        try:
+            num_ctx = self.num_ctx(
+                estimate_tokens(
+                    "".join(message["content"] for message in messages)
+                ),
+                max_tokens,
+            )
+        except ContextOverflowError as e:
+            report_error(self, console, e, traceback=False)
+            return None
+        if num_ctx:
+            # Больший контекст уже загруженной модели не стоит ничего, а
+            # смена num_ctx заставила бы Ollama перезагрузить модель
+            with _context_lock:
+                loaded = _loaded_num_ctx.get(self._key(), 0)
+            options["num_ctx"] = max(num_ctx, loaded)
+        return options
+
+    def warm_up(
+        self, keep_alive: str = "5m", prompt_tokens: Optional[int] = None
+    ) -> bool:
+        """Загружает модель в память заранее (пустой запрос к
+        `/api/generate`), чтобы первая генерация не ждала загрузки
+
+        Args:
+            keep_alive (str, optional): Сколько держать модель в памяти.
+                Defaults to "5m".
+            prompt_tokens (int, optional): Ожидаемый размер запроса. Модель
+                загружается с тем же num_ctx, что и у генерации, иначе
+                Ollama перезагрузит ее. Если модель уже загружается с
+                контекстом не меньше нужного, запрос не отправляется
+
+        Returns:
+            bool: True, если модель загружена
+        """
+        data = {"model": self.model, "keep_alive": keep_alive}
+        if prompt_tokens is not None:
+            budget = self.input_budget()
+            if budget is not None:
+                num_ctx = self.num_ctx(min(prompt_tokens, budget))
+                with _context_lock:
+                    if _loaded_num_ctx.get(self._key(), 0) >= num_ctx:
+                        return True
+                    _loaded_num_ctx[self._key()] = num_ctx
+                data["options"] = {"num_ctx": num_ctx}
+        try:
+            with trace.span(
+                "http", "POST /api/generate", model=self.model
+            ) as span:
+                response = self.session.post(
+                    url=f"{self.base_url}/api/generate",
+                    json=data,
+                    headers=self.headers,
+                    timeout=WARM_UP_TIMEOUT,
+                )
+                response_span(span, response)
+                if response.status_code == 200:
+                    _eval_stats(span, response.json())
+            return response.status_code == 200
+        except (requests.exceptions.RequestException, ValueError):
+            return False
+
+    def connection_stats(self) -> Dict[str, int]:
+        """Статистика запросов и переиспользованных соединений"""
+        return connection_stats(self.session)
+
+    def close(self) -> None:
+        """Закрывает соединения сессии"""
+        self.session.close()
 
     def message(
         self,
         messages: List[Dict[str, str]],
         timeout: Optional[int],
         temperature: float,
+        max_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
     ) -> str:
         """Функция сообщения
 
@@ -36,31 +362,122 @@ class Ollama:
             timeout (int): Таймаут ожидания сообщения
             model (str): Модель, с которой будем общаться
             temperature (float, optional): Температура общения. Defaults to 0.7
+            max_tokens (int, optional): Ограничение длины ответа (num_predict)
+            stop (list[str], optional): Стоп-последовательности
 
         Returns:
             str: Json-ответ/Err
         """
+        self.usage = None
+        options = self._options(messages, temperature, max_tokens, stop)
+        if options is None:
+            return None
         data = {
             "model": self.model,
             "messages": messages,
-            "options": {
-                "temperature": temperature,
-            },
+            "options": options,
             "think": False,
             "stream": False,
         }
 
         try:
-            response = requests.post(
-                url=self.url,
+            with trace.span(
+                "http", "POST /api/chat", model=self.model
+            ) as span:
+                response = post_with_retries(
+                    self.session,
+                    self.url,
+                    self.retry,
+                    json=data,
+                    headers=self.headers,
+                    timeout=timeout,
+                )
+                response_span(span, response)
+                # выбросит ошибку при плохом статусе
+                response.raise_for_status()
+                answer = response.json()
+                _eval_stats(span, answer)
+                self.usage = _usage(answer)
+            return answer["message"]["content"]
+
+        except requests.exceptions.RequestException as e:
+            report_error(self, console, e)
+        except KeyError as e:
+            report_error(self, console, e)
+
+    def stream(
+        self,
+        messages: List[Dict[str, str]],
+        timeout: Optional[int],
+        temperature: float,
+        max_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+    ) -> Iterator[str]:
+        """Потоковая генерация ответа. Ollama отдает NDJSON: по одному
+        json-объекту на строку, последний содержит `"done": true`.
+
+        Args:
+            messages (list[dict[str]]): Список сообщений
+            timeout (int): Таймаут ожидания сообщения
+            temperature (float, optional): Температура общения
+            max_tokens (int, optional): Ограничение длины ответа (num_predict)
+            stop (list[str], optional): Стоп-последовательности
+
+        Yields:
+            str: Очередной фрагмент ответа модели
+
+        Raises:
+            DeadlineExceeded: Ответ не получен целиком до --deadline
+        """
+        self.usage = None
+        options = self._options(messages, temperature, max_tokens, stop)
+        if options is None:
+            return
+        data = {
+            "model": self.model,
+            "messages": messages,
+            "options": options,
+            "think": False,
+            "stream": True,
+        }
+
+        started = time.monotonic()
+        try:
+            with trace.span(
+                "http", "POST /api/chat", model=self.model
+            ) as span, post_with_retries(
+                self.session,
+                self.url,
+                self.retry,
                 json=data,
                 headers=self.headers,
                 timeout=timeout,
-            )
-            response.raise_for_status()  # выбросит ошибку при плохом статусе
-            return response.json()["message"]["content"]
+                stream=True,
+            ) as response:
+                response_span(span, response)
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    self.retry.check_deadline(started)
+                    if not line:
+                        continue
+                    chunk = json.loads(line)
+                    if "error" in chunk:
+                        raise requests.exceptions.RequestException(
+                            chunk["error"]
+                        )
+                    content = chunk["message"]["content"]
+                    if content:
+                        yield content
+                    if chunk.get("done"):
+                        _eval_stats(span, chunk)
+                        self.usage = _usage(chunk)
+                        break
 
-        except requests.exceptions.RequestException:
-            console.print_exception()
-        except KeyError:
-            console.print_exception()
+        except DeadlineExceeded as e:
+            # Часть ответа уже отдана, поэтому это не конец ответа, а ошибка
+            self.last_error = str(e)
+            raise
+        except requests.exceptions.RequestException as e:
+            report_error(self, console, e)
+        except (KeyError, ValueError) as e:
+            report_error(self, console, e)
@@ -0,0 +1,99 @@
+# Cached probe of the Ollama server and its model list
+import json
+import os
+import tempfile
+import time
+from typing import List, Optional
+
+import requests
+
+from . import trace
+from .background import BackgroundCall
+from .response_cache import default_cache_dir
+
+
+class OllamaProbe:
+    """Keeps the result of the server probe and `/api/tags` on disk for a
+    short time. A fresh cached result is returned at once and refreshed in
+    the background for the next run."""
+
+    def __init__(self, client, path: Optional[str] = None, ttl: float = 30.0):
+        """Initialization
+
+        Args:
+            client (Ollama): Ollama client
+            path (str, optional): Cache file. Defaults to
+                `default_cache_dir()/ollama_models.json`.
+            ttl (float, optional): How long the cached result is trusted,
+                in seconds. Defaults to 30.
+        """
+        self.client = client
+        self.path = path or os.path.join(
+            default_cache_dir(), "ollama_models.json"
+        )
+        self.ttl = ttl
+        self.refreshing: Optional[BackgroundCall] = None
+
+    def load(self) -> Optional[List[str]]:
+        """Cached model list if it is fresh
+
+        Returns:
+            list[str] | None: Models, None if there is no fresh result
+        """
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                cached = json.load(f)
+            if (
+                cached["base_url"] == self.client.base_url
+                and time.time() - cached["time"] < self.ttl
+            ):
+                return cached["models"]
+        except (OSError, ValueError, KeyError):
+            pass
+        return None
+
+    def refresh(self) -> Optional[List[str]]:
+        """Probes the server and saves the result
+
+        Returns:
+            list[str] | None: Models, None if the server is not running
+        """
+        if not self.client.is_served():
+            return None
+        try:
+            models = self.client.list_models()
+        except (requests.exceptions.RequestException, KeyError, ValueError):
+            return None
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(
+                dir=os.path.dirname(self.path), suffix=".tmp"
+            )
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(
+                    {
+                        "base_url": self.client.base_url,
+                        "time": time.time(),
+                        "models": models,
+                    },
+                    f,
+                )
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+        return models
+
+    def models(self) -> Optional[List[str]]:
+        """Model list: cached one (refreshed in the background) or a fresh
+        probe
+
+        Returns:
+            list[str] | None: Models, None if the server is not running
+        """
+        with trace.span("probe", "ollama") as span:
+            cached = self.load()
+            span.attrs["cached"] = cached is not None
+            if cached is None:
+                return self.refresh()
+        self.refreshing = BackgroundCall(self.refresh)
+        return cached
@@ -0,0 +1,23 @@
+# Prompts for commit message generation
+
+
+def commit_prompt(lang: str, max_symbols: int, wish) -> str:
+    """System prompt for commit message generation
+
+    Args:
+        lang (str): Language of the message (en/ru)
+        max_symbols (int): Maximum message length
+        wish (str | None): Custom wishes/edits for the message
+
+    Returns:
+        str: Prompt
+    """
+    return f"""You are a git commit message generator.
+    Generate a single commit message in
+    {"Russian" if lang == "ru" else "English"} that:
+    Clearly summarizes the purpose of the changes.
+    Does not exceed {max_symbols} characters.
+    Uses information from git status and git diff.
+    Takes into account user preferences: {wish}.
+    Output only the commit message — plain text, no markdown, no
+    explanations, no formatting."""
@@ -0,0 +1,208 @@
+# Client-side rate limiting of requests to AI APIs
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Tuple
+
+from .response_cache import default_cache_dir
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    import msvcrt
+
+    fcntl = None
+
+# Waits in the queue that are worth mentioning to the user, in seconds
+QUEUE_NOTICE = 0.5
+
+
+class RateLimiter:
+    """Spaces requests of all threads of the process evenly, at most `rate`
+    requests per second"""
+
+    def __init__(self, rate: float):
+        """Initialization
+
+        Args:
+            rate (float): Requests per second, 0 for no limit
+        """
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def reserve(self) -> float:
+        """Takes the next free slot without waiting for it
+
+        Returns:
+            float: How long the caller has to wait for the slot, in seconds
+        """
+        if not self.interval:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next, now)
+            self._next = slot + self.interval
+        return slot - now
+
+    def acquire(self) -> float:
+        """Waits for the next free slot
+
+        Returns:
+            float: Time spent waiting, in seconds
+        """
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class QueueTimeout(Exception):
+    """A free slot is further away than the caller agreed to wait"""
+
+
+@contextmanager
+def file_lock(path: str) -> Iterator[None]:
+    """Exclusive lock shared by all processes of the machine
+
+    Args:
+        path (str): Lock file, created if missing
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class SharedRateLimiter:
+    """Token buckets of requests per second and model tokens per minute,
+    shared by all processes of the user through a state file under a file
+    lock.
+
+    A caller takes its share of the buckets on arrival and then waits until
+    they would have covered it. Buckets go into debt, so callers are served
+    in the order they arrived and nobody is starved by later ones."""
+
+    def __init__(
+        self,
+        key: str,
+        rate: float = 0.0,
+        tokens_per_minute: int = 0,
+        max_wait: Optional[float] = 60.0,
+        path: Optional[str] = None,
+    ):
+        """Initialization
+
+        Args:
+            key (str): Quota the buckets belong to, e.g. API and key hash
+            rate (float, optional): Requests per second, 0 for no limit.
+                Requests are spaced evenly, without bursts.
+            tokens_per_minute (int, optional): Prompt and answer tokens per
+                minute, 0 for no limit. Up to a minute worth of tokens can
+                be used at once.
+            max_wait (float, optional): Longest wait in the queue, None for
+                no bound. Defaults to 60.
+            path (str, optional): State file. Defaults to
+                `default_cache_dir()/quota.json`.
+        """
+        self.key = key
+        self.path = path or os.path.join(default_cache_dir(), "quota.json")
+        self.max_wait = max_wait
+        # (capacity, refill per second) of every bucket
+        self.buckets: Dict[str, Tuple[float, float]] = {}
+        if rate > 0:
+            self.buckets["requests"] = (1.0, rate)
+        if tokens_per_minute > 0:
+            self.buckets["tokens"] = (
+                float(tokens_per_minute),
+                tokens_per_minute / 60,
+            )
+
+    def reserve(self, tokens: int = 0) -> float:
+        """Takes a place in the queue without waiting for it
+
+        Args:
+            tokens (int, optional): Estimated tokens of the request. More
+                than a minute worth counts as a minute worth.
+
+        Returns:
+            float: How long the caller has to wait, in seconds
+
+        Raises:
+            QueueTimeout: The wait would be longer than `max_wait`. Nothing
+                is taken then.
+        """
+        if not self.buckets:
+            return 0.0
+        try:
+            with file_lock(self.path + ".lock"):
+                try:
+                    with open(self.path, encoding="utf-8") as f:
+                        state = json.load(f)
+                except (OSError, ValueError):
+                    state = {}
+                wait = self._take(state.setdefault(self.key, {}), tokens)
+                fd, tmp = tempfile.mkstemp(
+                    dir=os.path.dirname(self.path), suffix=".tmp"
+                )
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump(state, f)
+                os.replace(tmp, self.path)
+        except OSError:
+            # Without a writable cache directory requests are not limited
+            return 0.0
+        return wait
+
+    def _take(self, buckets: Dict[str, list], tokens: int) -> float:
+        # Levels are stored with the time they were computed at, wall clock
+        # time as it is shared by all processes
+        now = time.time()
+        costs = {"requests": 1.0, "tokens": float(tokens)}
+        levels = {}
+        wait = 0.0
+        for name, (capacity, refill) in self.buckets.items():
+            level, updated = buckets.get(name, (capacity, now))
+            level = min(capacity, level + max(now - updated, 0) * refill)
+            cost = min(costs[name], capacity)
+            levels[name] = level - cost
+            wait = max(wait, (cost - level) / refill)
+        if self.max_wait is not None and wait > self.max_wait:
+            raise QueueTimeout(
+                f"Rate limit queue is {wait:.1f}s long, the limit is "
+                f"{self.max_wait:g}s"
+            )
+        for name, level in levels.items():
+            buckets[name] = [level, now]
+        return wait
+
+    def acquire(self, tokens: int = 0) -> float:
+        """Waits for a place in the queue
+
+        Args:
+            tokens (int, optional): Estimated tokens of the request
+
+        Returns:
+            float: Time spent waiting, in seconds
+
+        Raises:
+            QueueTimeout: The wait would be longer than `max_wait`
+        """
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
@@ -0,0 +1,136 @@
+# On-disk cache of generated commit messages
+import hashlib
+import json
+import os
+import tempfile
+import time
+from typing import List, Optional
+
+
+def default_cache_dir() -> str:
+    """Directory for commit_maker caches
+
+    Returns:
+        str: `$XDG_CACHE_HOME/commit_maker` or `~/.cache/commit_maker`
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "commit_maker")
+
+
+class ResponseCache:
+    """Cache of generated messages keyed by the staged tree and generation
+    parameters. Every key holds the list of candidates generated for it.
+    Entries are evicted by age and, least recently used first, by total
+    size."""
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        max_bytes: int = 5 * 1024 * 1024,
+        max_age: float = 7 * 24 * 60 * 60,
+    ):
+        """Initialization
+
+        Args:
+            path (str, optional): Cache directory. Defaults to
+                `default_cache_dir()/responses`.
+            max_bytes (int, optional): Maximum total size of the cache.
+                Defaults to 5 MB.
+            max_age (float, optional): Maximum age of an entry in seconds.
+                Defaults to 7 days.
+        """
+        self.path = path or os.path.join(default_cache_dir(), "responses")
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    @staticmethod
+    def key(**params) -> str:
+        """Builds cache key from the staged tree hash and generation
+        parameters
+
+        Returns:
+            str: Key
+        """
+        raw = json.dumps(params, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.json")
+
+    def get(self, key: str) -> List[str]:
+        """Cached candidates for the key, oldest first
+
+        Args:
+            key (str): Key from `ResponseCache.key`
+
+        Returns:
+            list[str]: Candidates, empty if there are none
+        """
+        file = self._file(key)
+        try:
+            if time.time() - os.path.getmtime(file) > self.max_age:
+                os.remove(file)
+                return []
+            with open(file, encoding="utf-8") as f:
+                candidates = json.load(f)["candidates"]
+            # Reading counts as use for LRU eviction
+            os.utime(file)
+            return candidates
+        except (OSError, ValueError, KeyError):
+            return []
+
+    def append(self, key: str, message: str) -> None:
+        """Adds new candidate for the key
+
+        Args:
+            key (str): Key from `ResponseCache.key`
+            message (str): Generated commit message
+        """
+        candidates = self.get(key)
+        candidates.append(message)
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"candidates": candidates}, f, ensure_ascii=False)
+            os.replace(tmp, self._file(key))
+            self.evict()
+        except OSError:
+            # The cache is an optimization, generation must not fail on it
+            pass
+
+    def evict(self) -> None:
+        """Removes expired entries, then least recently used entries until
+        the cache fits `max_bytes`"""
+        now = time.time()
+        entries = []
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return
+        for name in names:
+            file = os.path.join(self.path, name)
+            try:
+                stat = os.stat(file)
+            except OSError:
+                continue
+            if now - stat.st_mtime > self.max_age:
+                _remove(file)
+            elif name.endswith(".json"):
+                entries.append((stat.st_mtime, stat.st_size, file))
+        total = sum(size for _, size, _ in entries)
+        for _, size, file in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            _remove(file)
+            total -= size
+
+
+def _remove(file: str) -> None:
+    # Another process may evict the same entry at the same time
+    try:
+        os.remove(file)
+    except OSError:
+        pass
@@ -0,0 +1,246 @@
+# Rewording of existing commits: messages are regenerated for a range of
+# commits on a bounded pool, then the history is rewritten in one pass.
+import concurrent.futures
+import os
+import subprocess
+import threading
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from .generation import build_prompt, finish_message, output_limits
+from .git_state import RepoState
+
+COMMIT_START = "\x1e"
+MESSAGE_END = "\x1f"
+
+
+def git(*args: str, input: Optional[str] = None, env=None) -> str:
+    """Runs git and returns its stdout
+
+    Raises:
+        subprocess.CalledProcessError: git failed
+    """
+    return subprocess.run(
+        ["git", *args],
+        input=input,
+        capture_output=True,
+        text=True,
+        encoding="utf-8",
+        errors="replace",
+        env=env,
+        check=True,
+    ).stdout
+
+
+def commits_in_range(rev_range: str) -> List[str]:
+    """Commits of the range, oldest first
+
+    Raises:
+        ValueError: The range does not end at HEAD
+    """
+    commits = git("rev-list", "--reverse", "--topo-order", rev_range).split()
+    head = git("rev-parse", "HEAD").strip()
+    if head not in commits:
+        raise ValueError(f"range {rev_range} must end at HEAD")
+    return commits
+
+
+def read_commits(rev_range: str) -> Iterator[Tuple[str, str, str]]:
+    """Streams (hash, message, patch) of non-merge commits, oldest first,
+    from a single `git log -p`. Patches of later commits are read while
+    earlier ones are being processed.
+
+    Args:
+        rev_range (str): Range of commits
+
+    Yields:
+        tuple[str, str, str]: Commit hash, its message and its patch
+    """
+    process = subprocess.Popen(
+        [
+            "git",
+            "log",
+            "--reverse",
+            "--no-merges",
+            "-p",
+            "--no-color",
+            f"--format={COMMIT_START}%H%n%B{MESSAGE_END}",
+            rev_range,
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+        encoding="utf-8",
+        errors="replace",
+    )
+    commit_hash, message, patch = None, [], []
+    in_message = False
+    try:
+        for line in process.stdout:
+            if line.startswith(COMMIT_START):
+                if commit_hash:
+                    yield commit_hash, "".join(message).strip(), "".join(patch)
+                commit_hash, message, patch = line[1:].strip(), [], []
+                in_message = True
+            elif in_message:
+                if MESSAGE_END in line:
+                    message.append(line.split(MESSAGE_END, 1)[0])
+                    in_message = False
+                else:
+                    message.append(line)
+            else:
+                patch.append(line)
+        if commit_hash:
+            yield commit_hash, "".join(message).strip(), "".join(patch)
+    finally:
+        process.stdout.close()
+        process.wait()
+
+
+def generate_messages(
+    client,
+    rev_range: str,
+    system_prompt: str,
+    temperature: float,
+    timeout: Optional[int],
+    concurrency: int = 4,
+    max_input_tokens: int = 0,
+    max_symbols: int = 0,
+    on_progress: Optional[Callable[[int], None]] = None,
+) -> Dict[str, str]:
+    """Generates new messages for commits of the range. Extraction of later
+    commits overlaps model calls for earlier ones; the reader stays at most
+    `concurrency` commits ahead of the pool.
+
+    Args:
+        client (Backend): AI client
+        rev_range (str): Range of commits
+        system_prompt (str): Prompt for commit message generation
+        temperature (float): Model temperature
+        timeout (int | None): Timeout for one commit
+        concurrency (int, optional): Maximum simultaneous requests.
+            Defaults to 4.
+        max_input_tokens (int, optional): Token budget of one request, 0
+            for no limit; local models lower it to their context. Defaults
+            to 0.
+        max_symbols (int, optional): Cap and trim length of the messages, 0
+            for no limit. Defaults to 0.
+        on_progress (callable, optional): Called with the number of
+            finished commits
+
+    Returns:
+        dict[str, str]: New messages by commit hash. Commits that failed are
+            missing.
+    """
+
+    def generate(message: str, patch: str) -> Optional[str]:
+        prompt = build_prompt(
+            client,
+            RepoState(diff=patch),
+            system_prompt,
+            max_input_tokens=max_input_tokens,
+            header=f"Original commit message: {message}\n",
+        )
+        answer = client.message(
+            messages=prompt.messages,
+            temperature=temperature,
+            timeout=timeout,
+            **output_limits(max_symbols),
+        )
+        return finish_message(answer, max_symbols)[0]
+
+    concurrency = max(concurrency, 1)
+    slots = threading.BoundedSemaphore(concurrency * 2)
+    new_messages: Dict[str, str] = {}
+    futures = {}
+    done = 0
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        try:
+            for commit_hash, message, patch in read_commits(rev_range):
+                slots.acquire()
+                future = executor.submit(generate, message, patch)
+                future.add_done_callback(lambda _: slots.release())
+                futures[future] = commit_hash
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception:
+                    result = None
+                if result and result.strip():
+                    new_messages[futures[future]] = result.strip()
+                done += 1
+                if on_progress:
+                    on_progress(done)
+        except KeyboardInterrupt:
+            for future in futures:
+                future.cancel()
+            raise
+    return new_messages
+
+
+def rewrite_messages(rev_range: str, new_messages: Dict[str, str]) -> str:
+    """Recreates commits of the range with new messages using
+    `git commit-tree` and moves HEAD once at the end. Trees, authors and
+    dates are kept, so the work tree and the index are not touched.
+
+    Args:
+        rev_range (str): Range of commits ending at HEAD
+        new_messages (dict[str, str]): New messages by commit hash
+
+    Returns:
+        str: Hash of the new HEAD
+
+    Raises:
+        subprocess.CalledProcessError: git failed, HEAD was not moved
+    """
+    old_head = git("rev-parse", "HEAD").strip()
+    log = git(
+        "log",
+        "--reverse",
+        "--topo-order",
+        "--date=raw",
+        "--format=%H%x00%T%x00%P%x00%an%x00%ae%x00%ad%x00%cn%x00%ce%x00%cd"
+        f"%x00%B{COMMIT_START}",
+        rev_range,
+    )
+    rewritten: Dict[str, str] = {}
+    for record in log.split(COMMIT_START):
+        record = record.lstrip("\n")
+        if not record:
+            continue
+        (
+            commit_hash, tree, parents,
+            author_name, author_email, author_date,
+            committer_name, committer_email, committer_date,
+            message,
+        ) = record.split("\0", 9)
+        env = dict(
+            os.environ,
+            GIT_AUTHOR_NAME=author_name,
+            GIT_AUTHOR_EMAIL=author_email,
+            GIT_AUTHOR_DATE=author_date,
+            GIT_COMMITTER_NAME=committer_name,
+            GIT_COMMITTER_EMAIL=committer_email,
+            GIT_COMMITTER_DATE=committer_date,
+        )
+        parent_args = []
+        for parent in parents.split():
+            parent_args.extend(["-p", rewritten.get(parent, parent)])
+        rewritten[commit_hash] = git(
+            "commit-tree",
+            tree,
+            *parent_args,
+            "-F",
+            "-",
+            input=new_messages.get(commit_hash, message),
+            env=env,
+        ).strip()
+    new_head = rewritten[old_head]
+    git(
+        "update-ref",
+        "-m",
+        f"commit_maker reword {rev_range}",
+        "HEAD",
+        new_head,
+        old_head,
+    )
+    return new_head
@@ -0,0 +1,123 @@
+# On-disk index of per-file change summaries for map-reduce generation
+import hashlib
+import json
+import os
+import tempfile
+import time
+from typing import Dict, Optional, Sequence, Tuple
+
+from .response_cache import default_cache_dir
+
+
+class SummaryCache:
+    """Summaries of diff chunks keyed by the blob ids of their files, so
+    re-staging one more file only summarizes that file again.
+
+    The whole index is one JSON file, read once and written once per run.
+    Entries are evicted by age and, least recently used first, by count."""
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        max_entries: int = 5000,
+        max_age: float = 7 * 24 * 60 * 60,
+    ):
+        """Initialization
+
+        Args:
+            path (str, optional): Index file. Defaults to
+                `default_cache_dir()/summaries.json`.
+            max_entries (int, optional): Maximum number of summaries.
+                Defaults to 5000.
+            max_age (float, optional): Maximum age of an unused summary in
+                seconds. Defaults to 7 days.
+        """
+        self.path = path or os.path.join(default_cache_dir(), "summaries.json")
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self._entries: Optional[Dict[str, Dict]] = None
+        self._changed = False
+
+    @staticmethod
+    def key(files: Sequence[Tuple[str, str, str]], **params) -> str:
+        """Builds key of a chunk
+
+        Args:
+            files (list[tuple[str, str, str]]): (path, old blob, new blob)
+                of every file of the chunk
+            **params: Model and other generation parameters
+
+        Returns:
+            str: Key
+        """
+        raw = json.dumps(
+            {"files": sorted(files), **params},
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _load(self) -> Dict[str, Dict]:
+        if self._entries is None:
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def get(self, key: str) -> Optional[str]:
+        """Cached summary for the key
+
+        Args:
+            key (str): Key from `SummaryCache.key`
+
+        Returns:
+            str | None: Summary, None if there is none
+        """
+        entry = self._load().get(key)
+        if not entry or time.time() - entry["used"] > self.max_age:
+            return None
+        # Reading counts as use for LRU eviction
+        entry["used"] = time.time()
+        self._changed = True
+        self.hits += 1
+        return entry["summary"]
+
+    def put(self, key: str, summary: str) -> None:
+        """Stores summary of a chunk
+
+        Args:
+            key (str): Key from `SummaryCache.key`
+            summary (str): Summary
+        """
+        self._load()[key] = {"summary": summary, "used": time.time()}
+        self._changed = True
+
+    def save(self) -> None:
+        """Evicts old entries and writes the index if it changed"""
+        if not self._changed:
+            return
+        now = time.time()
+        entries = sorted(
+            (
+                item
+                for item in self._load().items()
+                if now - item[1]["used"] <= self.max_age
+            ),
+            key=lambda item: item[1]["used"],
+        )
+        self._entries = dict(entries[-self.max_entries:])
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(
+                dir=os.path.dirname(self.path), suffix=".tmp"
+            )
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+            self._changed = False
+        except OSError:
+            # The cache is an optimization, generation must not fail on it
+            pass
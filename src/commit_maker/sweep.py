@@ -0,0 +1,188 @@
+# Sweep over many repositories: staged changes of every repository are
+# collected and described concurrently, then committed in one batch.
+import asyncio
+import os
+import subprocess
+import time
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Sequence
+
+from .generation import build_prompt, finish_message, output_limits
+from .git_state import (
+    MAX_DIFF_BYTES,
+    DiffOptions,
+    RepoState,
+    collect_repo_state_async,
+)
+from .rate_limit import RateLimiter
+
+
+@dataclass
+class RepoResult:
+    """Result of the sweep for one repository"""
+
+    path: str
+    state: Optional[RepoState] = None
+    message: Optional[str] = None
+    error: str = ""
+    collect_time: float = 0.0
+    generate_time: float = 0.0
+
+    @property
+    def status(self) -> str:
+        """`generated`, `skipped` (nothing staged) or `failed`"""
+        if self.message:
+            return "generated"
+        if self.error:
+            return "failed"
+        return "skipped"
+
+
+def find_repositories(workspace: str) -> List[str]:
+    """Git repositories in the workspace: the directory itself and its
+    immediate subdirectories
+
+    Args:
+        workspace (str): Workspace directory
+
+    Returns:
+        list[str]: Paths of repositories, sorted
+    """
+    candidates = [workspace] + [
+        entry.path
+        for entry in os.scandir(workspace)
+        if entry.is_dir() and not entry.name.startswith(".")
+    ]
+    return sorted(
+        path
+        for path in candidates
+        if os.path.exists(os.path.join(path, ".git"))
+    )
+
+
+async def sweep_async(
+    client,
+    repos: Sequence[str],
+    system_prompt: str,
+    temperature: float,
+    timeout: Optional[float],
+    excluded_files: Sequence[str] = (),
+    concurrency: int = 4,
+    max_input_tokens: int = 0,
+    max_diff_bytes: int = MAX_DIFF_BYTES,
+    diff_options: Optional[DiffOptions] = None,
+    plan: bool = False,
+    compact: bool = False,
+    max_symbols: int = 0,
+    limiter: Optional[RateLimiter] = None,
+    on_result: Optional[Callable[[RepoResult], None]] = None,
+) -> List[RepoResult]:
+    """Collects staged changes of every repository and generates messages
+    through the shared client. Git subprocesses and HTTP requests of all
+    repositories are driven by one event loop.
+
+    Args:
+        client (Backend): AI backend shared by all repositories
+        repos (list[str]): Repository paths
+        system_prompt (str): Prompt for commit message generation
+        temperature (float): Model temperature
+        timeout (float | None): Deadline for one request
+        excluded_files (list[str], optional): Files to exclude
+        concurrency (int, optional): Maximum simultaneous requests.
+            Defaults to 4.
+        max_input_tokens (int, optional): Token budget of one request, 0
+            for no limit. Defaults to 0.
+        max_diff_bytes (int, optional): Cap of the staged diff read from
+            every repository, 0 for no cap. Defaults to 8 MiB.
+        diff_options (DiffOptions, optional): Encoding of the diffs
+        plan (bool, optional): Describe binaries, lockfiles and generated
+            files by their stats. Defaults to False.
+        compact (bool, optional): Short status and diff headers. Defaults
+            to False.
+        max_symbols (int, optional): Cap and trim length of the messages, 0
+            for no limit. Defaults to 0.
+        limiter (RateLimiter, optional): Limiter shared by all requests
+        on_result (callable, optional): Called with every finished result
+
+    Returns:
+        list[RepoResult]: Results in the order of `repos`
+    """
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+    async def process(path: str) -> RepoResult:
+        result = RepoResult(path=path)
+        start = time.perf_counter()
+        try:
+            result.state = await collect_repo_state_async(
+                excluded_files,
+                cwd=path,
+                max_diff_bytes=max_diff_bytes,
+                diff_options=diff_options,
+                plan=plan,
+            )
+        except OSError as e:
+            result.error = str(e)
+            return result
+        result.collect_time = time.perf_counter() - start
+        if not result.state.diff:
+            return result
+        prompt = build_prompt(
+            client,
+            result.state,
+            system_prompt,
+            max_input_tokens=max_input_tokens,
+            compact=compact,
+        )
+        async with semaphore:
+            if limiter:
+                await asyncio.sleep(limiter.reserve())
+            start = time.perf_counter()
+            try:
+                message = await client.amessage(
+                    messages=prompt.messages,
+                    temperature=temperature,
+                    deadline=timeout,
+                    **output_limits(max_symbols),
+                )
+            except asyncio.TimeoutError:
+                message = None
+                result.error = "timed out"
+            result.generate_time = time.perf_counter() - start
+        message = finish_message(message, max_symbols)[0]
+        if message:
+            result.message = message
+        elif not result.error:
+            result.error = "no message generated"
+        return result
+
+    async def report(path: str) -> RepoResult:
+        result = await process(path)
+        if on_result:
+            on_result(result)
+        return result
+
+    return list(await asyncio.gather(*(report(path) for path in repos)))
+
+
+def sweep(*args, **kwargs) -> List[RepoResult]:
+    """Blocking version of `sweep_async`"""
+    return asyncio.run(sweep_async(*args, **kwargs))
+
+
+def commit(result: RepoResult) -> bool:
+    """Commits staged changes of the repository with the generated message
+
+    Args:
+        result (RepoResult): Result with a message
+
+    Returns:
+        bool: True if the commit was created
+    """
+    return (
+        subprocess.run(
+            ["git", "commit", "-q", "-m", result.message],
+            cwd=result.path,
+            capture_output=True,
+        ).returncode
+        == 0
+    )
@@ -0,0 +1,171 @@
+# Timing of run phases, git subprocesses and model requests for
+# --trace/--profile. Tracing is off unless `enable()` was called, and spans
+# are then only cheap placeholders.
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, Iterator, List, Optional
+
+# Stats of a finished Ollama request, as reported by the server. Durations
+# are in nanoseconds.
+OLLAMA_STATS = (
+    "total_duration",
+    "load_duration",
+    "prompt_eval_count",
+    "prompt_eval_duration",
+    "eval_count",
+    "eval_duration",
+)
+
+
+@dataclass
+class Span:
+    """Timed operation. Times are in seconds from the start of the trace"""
+
+    kind: str
+    name: str
+    start: float = 0.0
+    duration: float = 0.0
+    attrs: Dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        """Generation speed of a model request, None for other spans"""
+        if self.attrs.get("eval_duration"):
+            # Ollama measures generation on the server
+            return self.attrs["eval_count"] / (
+                self.attrs["eval_duration"] / 1e9
+            )
+        if self.attrs.get("completion_tokens"):
+            # Mistral only reports token counts, generation is the time
+            # after the first byte
+            generation = self.duration - self.attrs.get("first_byte", 0.0)
+            if generation > 0:
+                return self.attrs["completion_tokens"] / generation
+        return None
+
+
+class Tracer:
+    """Collects spans from all threads of the run"""
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, kind: str, name: str, **attrs) -> Iterator[Span]:
+        """Times the block
+
+        Args:
+            kind (str): `phase`, `git`, `probe`, `http`, `retry`, `hedge`
+                or `queue`
+            name (str): What is timed
+            **attrs: Extra data, more can be added to the yielded span
+
+        Yields:
+            Span: Span, recorded when the block exits
+        """
+        span = Span(kind, name, time.perf_counter() - self.origin, attrs=attrs)
+        try:
+            yield span
+        finally:
+            self.record(span)
+
+    def record(self, span: Span) -> None:
+        """Adds the span, setting its duration if it is not set"""
+        if not span.duration:
+            span.duration = time.perf_counter() - self.origin - span.start
+        with self._lock:
+            self.spans.append(span)
+
+    def now(self) -> float:
+        """Seconds from the start of the trace"""
+        return time.perf_counter() - self.origin
+
+    def summary(self) -> List[Dict[str, Any]]:
+        """Spans grouped by kind and name
+
+        Returns:
+            list[dict]: `kind`, `name`, `count`, `total` and `max` of every
+                group, in order of the first span
+        """
+        groups: Dict[tuple, Dict[str, Any]] = {}
+        for span in sorted(self.spans, key=lambda span: span.start):
+            group = groups.setdefault(
+                (span.kind, span.name),
+                {
+                    "kind": span.kind,
+                    "name": span.name,
+                    "count": 0,
+                    "total": 0.0,
+                    "max": 0.0,
+                },
+            )
+            group["count"] += 1
+            group["total"] += span.duration
+            group["max"] = max(group["max"], span.duration)
+        return list(groups.values())
+
+    def save(self, path: str) -> None:
+        """Writes the trace as JSON
+
+        Args:
+            path (str): Output file
+        """
+        spans = []
+        for span in sorted(self.spans, key=lambda span: span.start):
+            data = asdict(span)
+            if span.tokens_per_second is not None:
+                data["tokens_per_second"] = span.tokens_per_second
+            spans.append(data)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"spans": spans, "summary": self.summary()},
+                f,
+                ensure_ascii=False,
+                indent=2,
+            )
+
+
+_tracer: Optional[Tracer] = None
+
+
+def enable() -> Tracer:
+    """Starts tracing of the run
+
+    Returns:
+        Tracer: Active tracer
+    """
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def disable() -> None:
+    """Stops tracing"""
+    global _tracer
+    _tracer = None
+
+
+def active() -> Optional[Tracer]:
+    """Active tracer, None if tracing is off"""
+    return _tracer
+
+
+@contextmanager
+def span(kind: str, name: str, **attrs) -> Iterator[Span]:
+    """`Tracer.span` of the active tracer. Without tracing the block runs
+    with a span that is not recorded."""
+    tracer = _tracer
+    if tracer is None:
+        yield Span(kind, name, attrs=attrs)
+        return
+    with tracer.span(kind, name, **attrs) as current:
+        yield current
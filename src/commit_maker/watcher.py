@@ -0,0 +1,152 @@
+# Speculative pre-generation for `commit_maker daemon --watch`: polls
+# `.git/index` of the watched repositories and, once it stops changing,
+# generates the message for the staged tree in the background. Results go to
+# the response cache under the key the CLI looks up, so a later
+# `commit_maker` run with the same options finds the message ready.
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Tuple
+
+
+class Superseded(Exception):
+    """The index changed while its message was being generated"""
+
+
+@dataclass
+class WatchedRepo:
+    """Polling state of one repository"""
+
+    path: str
+    # (mtime_ns, size) of the index, None before the first poll
+    signature: Optional[Tuple[int, int]] = None
+    # When the index last changed, None once its message was requested
+    changed_at: Optional[float] = None
+    # Bumped on every index change, cancels older generations
+    version: int = 0
+
+    @property
+    def index(self) -> str:
+        return os.path.join(self.path, ".git", "index")
+
+
+def index_signature(path: str) -> Optional[Tuple[int, int]]:
+    """Cheap fingerprint of the index file
+
+    Args:
+        path (str): Path to `.git/index`
+
+    Returns:
+        tuple[int, int] | None: Modification time and size, None if there is
+            no index yet
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class IndexWatcher:
+    """Starts a speculative generation when the index of a watched
+    repository settles, cancelling the previous one for that repository"""
+
+    def __init__(
+        self,
+        server,
+        repos: List[str],
+        argv: List[str],
+        poll_interval: float = 0.5,
+        debounce: float = 1.0,
+        log: Optional[Callable[[str], None]] = None,
+    ):
+        """Initialization
+
+        Args:
+            server (DaemonServer): Daemon that generates the messages
+            repos (list[str]): Repository roots to watch
+            argv (list[str]): `commit_maker` options the messages are
+                generated with
+            poll_interval (float, optional): Seconds between index checks.
+                Defaults to 0.5.
+            debounce (float, optional): Seconds the index must stay unchanged
+                before generating. Defaults to 1.0.
+            log (callable, optional): Receives one line per finished,
+                cancelled or skipped generation
+        """
+        self.server = server
+        self.repos = [WatchedRepo(os.path.abspath(repo)) for repo in repos]
+        self.argv = argv
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self.log = log or (lambda line: None)
+        self.pregenerated = 0
+        self._stopped = threading.Event()
+
+    def start(self) -> "IndexWatcher":
+        """Polls in a daemon thread"""
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._stopped.set()
+        # Running generations stop at their next chunk
+        for repo in self.repos:
+            repo.version += 1
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.poll_interval):
+            now = time.monotonic()
+            for repo in self.repos:
+                self.poll(repo, now)
+
+    def poll(self, repo: WatchedRepo, now: float) -> None:
+        """Checks one repository and starts its generation when due
+
+        Args:
+            repo (WatchedRepo): Repository
+            now (float): `time.monotonic()` of this poll
+        """
+        signature = index_signature(repo.index)
+        if signature != repo.signature:
+            repo.signature = signature
+            repo.changed_at = now
+            repo.version += 1
+        elif (
+            repo.changed_at is not None
+            and now - repo.changed_at >= self.debounce
+        ):
+            repo.changed_at = None
+            threading.Thread(
+                target=self._pregenerate,
+                args=(repo, repo.version),
+                daemon=True,
+            ).start()
+
+    def _pregenerate(self, repo: WatchedRepo, version: int) -> None:
+        def emit(event: str, **data) -> None:
+            if repo.version != version:
+                raise Superseded
+            if event == "done" and not data.get("cached"):
+                self.pregenerated += 1
+                self.log(f"Pre-generated for {repo.path}: {data['message']}")
+            elif event == "error":
+                self.log(f"Pre-generation failed in {repo.path}: "
+                         f"{data['text']}")
+
+        request = {
+            "argv": self.argv,
+            "cwd": repo.path,
+            "regenerate": False,
+            "speculative": True,
+        }
+        self.server.begin()
+        try:
+            self.server.generate(request, emit)
+        except Superseded:
+            self.log(f"Pre-generation cancelled in {repo.path}: index changed")
+        except Exception as e:
+            self.log(f"Pre-generation failed in {repo.path}: {e}")
+        finally:
+            self.server.end(served=False)
@@ -0,0 +1,59 @@
+import threading
+import unittest
+
+from commit_maker.api import GenerationOptions, MessageGenerator
+
+
+class FakeBackend:
+    """Backend that keeps the usage of a request on itself, like the real
+    ones, and answers only once both concurrent requests have started"""
+
+    model = "fake"
+    quiet = True
+    last_error = None
+
+    def __init__(self, barrier: threading.Barrier):
+        self.barrier = barrier
+        self.usage = None
+
+    def input_budget(self):
+        return None
+
+    def stream(
+        self, messages, timeout, temperature, max_tokens=None, stop=None
+    ):
+        prompt = "".join(message["content"] for message in messages)
+        self.usage = {"prompt_tokens": len(prompt), "completion_tokens": 1}
+        self.barrier.wait(timeout=5)
+        yield "Fix the thing"
+
+
+class ConcurrentGenerateTest(unittest.TestCase):
+    def test_usage_is_kept_per_call(self):
+        diffs = [
+            "diff --git a/a.py b/a.py\n+x = 1\n",
+            "diff --git a/b.py b/b.py\n" + "+y = 2\n" * 50,
+        ]
+        backend = FakeBackend(threading.Barrier(len(diffs)))
+        generator = MessageGenerator(GenerationOptions(language="en"))
+        results = [None] * len(diffs)
+
+        def generate(index: int) -> None:
+            results[index] = generator.generate(diffs[index], backend=backend)
+
+        threads = [
+            threading.Thread(target=generate, args=(index,))
+            for index in range(len(diffs))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for result in results:
+            self.assertEqual(result.message, "Fix the thing")
+            self.assertEqual(result.estimated, [])
+        self.assertLess(results[0].prompt_tokens, results[1].prompt_tokens)
+
+
+if __name__ == "__main__":
+    unittest.main()
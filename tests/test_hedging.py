@@ -0,0 +1,57 @@
+import os
+import tempfile
+import time
+import unittest
+
+from commit_maker.hedging import HedgedBackend, LatencyHistory, latency_key
+
+
+class FakeBackend:
+    quiet = True
+    last_error = None
+
+    def __init__(self, model: str):
+        self.model = model
+        self.latency = 0.0
+
+    def stream(
+        self, messages, timeout, temperature, max_tokens=None, stop=None
+    ):
+        time.sleep(self.latency)
+        yield "Fix the thing"
+
+
+class Primary(FakeBackend):
+    pass
+
+
+class Secondary(FakeBackend):
+    pass
+
+
+class LatencyHistoryTest(unittest.TestCase):
+    def test_hedged_requests_keep_the_percentile(self):
+        with tempfile.TemporaryDirectory() as directory:
+            history = LatencyHistory(
+                os.path.join(directory, "latency.json"), max_samples=10
+            )
+            primary = Primary("fake")
+            key = latency_key(primary)
+            for _ in range(10):
+                history.add(key, 0.1)
+            client = HedgedBackend(
+                primary, Secondary("fake"), history=history
+            )
+            # Every other request of the primary is slow and hedged
+            for latency in [0.0, 0.5] * 10:
+                primary.latency = latency
+                answer = client.message(
+                    [{"role": "user", "content": "diff"}], None, 1.0
+                )
+                self.assertEqual(answer, "Fix the thing")
+            self.assertEqual(client.hedged, 10)
+            self.assertGreaterEqual(history.percentile(key), 0.1)
+
+
+if __name__ == "__main__":
+    unittest.main()